@@ -0,0 +1,82 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# Modules that must import without TensorFlow or music21
+LIGHT_MODULES = ['mozart_utils', 'mozart_profile', 'image_dissector', 'xmlencoder', 'xmlencode2', 'xmldecoder',
+                 'primus', 'primus_pack', 'mozart_decoding', 'mozart_model', 'mozart_export', 'mozart_predict',
+                 'mozart_quantize', 'mozart_pipeline', 'mozart_transcribe', 'mozart_evaluate', 'mozart_server',
+                 'mozart_stream', 'mozart_augment', 'mozart_events']
+HEAVY_MODULES = ['tensorflow', 'keras', 'music21']
+CLIS = ['mozart_transcribe.py', 'mozart_evaluate.py', 'mozart_export.py', 'mozart_quantize.py', 'mozart_decoding.py',
+        'primus_pack.py', 'mozart_training.py', 'mozart_server.py', 'mozart_stream.py',
+        'mozart_augment.py', 'mozart_events.py']
+
+_IMPORT = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{'seconds': elapsed, 'heavy': [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+_HELP = """
+import runpy, sys, time
+start = time.perf_counter()
+sys.argv = [{script!r}, '-h']
+try:
+    runpy.run_path({script!r}, run_name='__main__')
+except SystemExit:
+    pass
+sys.stderr.write(str(time.perf_counter() - start))
+"""
+
+
+def _run(code):
+    return subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                          capture_output=True, text=True, check=True)
+
+
+def import_time(module, repeat=3):
+    """ Best time of importing module in a fresh interpreter, and the heavy modules it pulled in. """
+    results = [json.loads(_run(_IMPORT.format(module=module, heavy=HEAVY_MODULES)).stdout) for _ in range(repeat)]
+    return min(r['seconds'] for r in results), results[0]['heavy']
+
+
+def help_time(script, repeat=3):
+    """ Best time of running a command line tool with -h in a fresh interpreter. """
+    return min(float(_run(_HELP.format(script=script)).stderr.strip().splitlines()[-1]) for _ in range(repeat))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the import and --help time of the non-ML parts.')
+    parser.add_argument('-budget_ms', dest='budget_ms', type=float, default=300,
+                        help='Maximum time allowed for an import or a -h, in milliseconds.')
+    parser.add_argument('-repeat', dest='repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    failures = []
+    for module in LIGHT_MODULES:
+        seconds, heavy = import_time(module, args.repeat)
+        print(f'import {module:<20} {seconds * 1000:7.1f} ms' + (f'  loads {", ".join(heavy)}' if heavy else ''))
+        if heavy:
+            failures.append(f'import {module} loads {", ".join(heavy)}')
+        if seconds * 1000 > args.budget_ms:
+            failures.append(f'import {module} takes {seconds * 1000:.0f} ms')
+
+    for script in CLIS:
+        seconds = help_time(script, args.repeat)
+        print(f'{script + " -h":<27} {seconds * 1000:7.1f} ms')
+        if seconds * 1000 > args.budget_ms:
+            failures.append(f'{script} -h takes {seconds * 1000:.0f} ms')
+
+    for failure in failures:
+        print(f'Over budget: {failure}')
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,35 +1,14 @@
-import mozart_predict as mp
-import xmlencode2 as xl
-import imd_staf as imd
-import nested_list as nl
+import mozart_pipeline as mpl
 
 song_nam = "blahblah"
-image_path = "Data/Example/Capture_1.PNG"
-Temp_path = "Data/Temp/"
+image_path = "Data/Example/Capture.png"
 model_path = "Models/semantic_model.meta"
 voc_file_path = "Data/vocabulary_semantic.txt"
-file_list = imd.split_sheet_music_into_phrases(image_path, Temp_path, margin_x=5, margin_y=20)
-phrase_list =[]
-for phrases in file_list:
-  result = mp.decode_music_score(phrases, model_path, voc_file_path)
-  prase_list = [x for x in result]
-  phrase_list.extend(prase_list)
 
-def group_measures(notes):
-    measures = []
-    current_measure = []
-
-    for item in notes:
-        if item == "barline":
-            measures.append(current_measure)
-            current_measure = []
-        else:
-            current_measure.append(item)
-
-    if current_measure:  # Add the last measure if not empty
-        measures.append(current_measure)
-
-    return measures
-finale = group_measures(phrase_list)
-print(finale)
-xl.create_musicxml(finale)
+if __name__ == "__main__":
+    predictor = mpl.get_predictor(model_path, voc_file_path)
+    timings = {}
+    musicxml = mpl.transcribe(image_path, predictor, timings=timings)
+    with open(f"{song_nam}.musicxml", "w") as output_file:
+        output_file.write(musicxml)
+    print("Stage timings (s):", {name: round(seconds, 3) for name, seconds in timings.items()})
@@ -1,112 +1,368 @@
 import cv2
 import numpy as np
 import os
+import mozart_profile
 
-def split_sheet_music_per_measure(image_path, output_dir, multi_measure_rests=None, margin_x=5, margin_y=20):
-    # Ensure the output directory exists
-    os.makedirs(output_dir, exist_ok=True)
+def load_page(page):
+    """
+    Decodes a page once as a grayscale image.
 
-    # Load the original image (color) and a grayscale version for processing
-    original_image = cv2.imread(image_path)  # Load original image in color (to preserve quality)
-    gray_image = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)  # Load grayscale image for processing
+    Parameters:
+        page (str, bytes or np.ndarray): Path to the image, encoded image bytes or an already decoded image.
 
-    if original_image is None or gray_image is None:
-        print("Error: Could not load image.")
+    Returns:
+        np.ndarray: Grayscale page, or None if it could not be decoded.
+    """
+    if isinstance(page, str):
+        with mozart_profile.stage('imread'):
+            return cv2.imread(page, cv2.IMREAD_GRAYSCALE)
+    if isinstance(page, (bytes, bytearray, memoryview)):
+        with mozart_profile.stage('imdecode'):
+            return cv2.imdecode(np.frombuffer(page, np.uint8), cv2.IMREAD_GRAYSCALE)
+    if page.ndim == 3:
+        return cv2.cvtColor(page, cv2.COLOR_BGR2GRAY)
+    return page
+
+
+def _runs(mask):
+    # Returns the [start, end) index pairs of the runs of True values in a 1D mask
+    padded = np.concatenate(([False], mask, [False]))
+    edges = np.flatnonzero(padded[1:] != padded[:-1])
+    return edges.reshape(-1, 2)
+
+
+def find_staff_lines(binary, spacing, min_length=6, band_fraction=0.5):
+    """
+    Finds staff lines from the long horizontal runs of ink of every row.
+
+    An opening with a horizontal kernel of min_length spacings keeps only the
+    ink runs at least that long, so notes, text and short beams disappear
+    while the staff lines stay, whatever the width of the other staves of
+    the page. Adjacent rows with such runs make a single line; rows with
+    less than band_fraction of the long-run ink of the best row of their
+    line (a beam or a slur lying on it) are trimmed, and lines more than
+    twice as thick as the median line (long beams alone) are dropped.
+
+    Parameters:
+        binary (np.ndarray): Binarized page, ink is non-zero.
+        spacing (float): Staff spacing in pixels of binary.
+
+    Returns:
+        np.ndarray: (top, bottom) row pairs, bottom excluded, one per line.
+    """
+    length = max(3, int(round(min_length * spacing)))
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (length, 1))
+    long_runs = cv2.morphologyEx(binary, cv2.MORPH_OPEN, kernel)
+    row_profile = np.count_nonzero(long_runs, axis=1)
+
+    lines = []
+    for top, bottom in _runs(row_profile > 0):
+        band = row_profile[top:bottom]
+        rows = np.flatnonzero(band >= band_fraction * band.max())
+        lines.append((top + rows[0], top + rows[-1] + 1))
+    lines = np.array(lines, dtype=np.int64).reshape(-1, 2)
+    if len(lines):
+        heights = lines[:, 1] - lines[:, 0]
+        lines = lines[heights <= 2 * np.median(heights) + 1]
+    return lines
+
+
+def estimate_staff_metrics(lines):
+    """
+    Estimates the staff line thickness and spacing (distance between line centers) of a page.
+
+    Most gaps between consecutive lines are inside a staff, so their median is the spacing.
+
+    Returns:
+        tuple: (thickness, spacing) in pixels.
+    """
+    thickness = float(np.median(lines[:, 1] - lines[:, 0]))
+    centers = lines.mean(axis=1)
+    spacing = float(np.median(np.diff(centers))) if len(lines) > 1 else 0.0
+    return thickness, spacing
+
+
+def group_staves(lines, spacing, min_lines=3):
+    """
+    Groups staff lines into staves; a gap bigger than two spacings starts a new staff.
+
+    Groups with fewer than min_lines lines (text, long beams) are dropped.
+
+    Returns:
+        list: One (n, 2) array of lines per staff.
+    """
+    centers = lines.mean(axis=1)
+    breaks = np.flatnonzero(np.diff(centers) > 2 * spacing) + 1
+    return [staff for staff in np.split(lines, breaks) if len(staff) >= min_lines]
+
+
+def find_barlines(staff_binary, spacing, coverage=0.98, flank_excess=0.15):
+    """
+    Finds the barlines of a staff with a vertical projection profile.
+
+    staff_binary must span from the top to the bottom staff line. Candidate
+    columns have ink on at least coverage of that height. Runs closer than
+    one spacing (double and final barlines) are merged, and a candidate is
+    kept only if the half spacing on each side holds little more ink than the
+    staff lines alone. That rejects stems next to note heads and stacked
+    time signature digits.
+
+    Returns:
+        list: x coordinate of the left edge of every barline.
+    """
+    column_profile = np.count_nonzero(staff_binary, axis=0) / staff_binary.shape[0]
+    runs = _runs(column_profile >= coverage)
+    if len(runs) == 0:
         return []
 
-    # Binarize the grayscale image
-    _, binary = cv2.threshold(gray_image, 135, 255, cv2.THRESH_BINARY_INV)
-
-    # Detect horizontal lines (staff lines)
-    horizontal_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (30, 1))
-    detected_lines = cv2.morphologyEx(binary, cv2.MORPH_OPEN, horizontal_kernel, iterations=2)
-
-    # Find contours of staff lines
-    contours, _ = cv2.findContours(detected_lines, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    staff_lines = sorted(contours, key=lambda c: cv2.boundingRect(c)[1])  # Sort by y-coordinate
-    print(f"Detected {len(staff_lines)} staff lines in {image_path}")
-
-    # Group staff lines into sets (1 set = 1 staff)
-    staff_groups = []
-    group = []
-    prev_y = None
-    for contour in staff_lines:
-        x, y, w, h = cv2.boundingRect(contour)
-        if prev_y is None or abs(y - prev_y) < 20:  # Group nearby lines
-            group.append((x, y, w, h))
-        else:
-            staff_groups.append(group)
-            group = [(x, y, w, h)]
-        prev_y = y
-    if group:
-        staff_groups.append(group)
-
-    # Initialize measure count and file list
-    measure_count = 0
-    all_filenames = []  # List to store all generated filenames
+    # Merge runs that are less than a spacing apart
+    starts = np.concatenate(([True], runs[1:, 0] - runs[:-1, 1] > spacing))
+    ends = np.concatenate((starts[1:], [True]))
+    runs = np.stack((runs[starts, 0], runs[ends, 1]), axis=1)
 
-    # Crop each staff into individual measures
-    for i, staff in enumerate(staff_groups):
-        # Compute staff bounding box with margins
-        x_min = max(min([x for x, y, w, h in staff]) - margin_x, 0)
-        x_max = min(max([x + w for x, y, w, h in staff]) + margin_x, gray_image.shape[1])
-        y_min = max(min([y for x, y, w, h in staff]) - margin_y, 0)
-        y_max = min(max([y + h for x, y, w, h in staff]) + margin_y, gray_image.shape[0])
+    # Columns crossed only by the staff lines set the baseline
+    baseline = np.median(column_profile)
+    flank = max(1, int(round(spacing / 2)))
+    barlines = []
+    for start, end in runs:
+        left = column_profile[max(start - flank, 0):start]
+        right = column_profile[end:end + flank]
+        if all(side.size == 0 or side.mean() < baseline + flank_excess for side in (left, right)):
+            barlines.append(int(start))
+    return barlines
 
-        # Crop the staff from the grayscale image (for measure detection)
-        staff_image = binary[y_min:y_max, x_min:x_max]
 
-        # Detect vertical lines (measure boundaries)
-        vertical_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (1, 16))
-        detected_columns = cv2.morphologyEx(staff_image, cv2.MORPH_OPEN, vertical_kernel, iterations=2)
+def estimate_staff_spacing(gray_image, num_columns=64):
+    """
+    Quickly estimates the staff line thickness and spacing of a full resolution page.
 
-        # Find contours for measure splitting
-        column_contours, _ = cv2.findContours(detected_columns, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        column_boundaries = sorted([cv2.boundingRect(c)[0] for c in column_contours])
+    Only num_columns evenly spaced columns are read: the most common vertical
+    black run is the line thickness and the most common white run the space
+    between two lines, which together give the spacing.
 
-        # Ensure we include the first boundary (left edge)
-        if len(column_boundaries) == 0:
-            print(f"Warning: No measure boundaries detected in staff {i + 1}.")
-            continue
+    Returns:
+        tuple: (thickness, spacing) in pixels, (0, 0) if the page has no ink.
+    """
+    columns = np.linspace(0, gray_image.shape[1] - 1, min(num_columns, gray_image.shape[1])).astype(int)
+    _, sample = cv2.threshold(np.ascontiguousarray(gray_image[:, columns].T), 0, 1,
+                              cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+
+    # Vertical runs of every sampled column, one column after the other
+    padded = np.pad(sample, ((0, 0), (1, 1))).ravel()
+    edges = np.flatnonzero(np.diff(padded)) + 1
+    lengths = np.diff(edges)
+    black = lengths[0::2]  # The padding makes every column start with a black run edge
+    white = lengths[1::2]
+    if black.size == 0 or white.size == 0:
+        return 0, 0
+
+    thickness = int(np.argmax(np.bincount(black)))
+    space = int(np.argmax(np.bincount(white)))
+    return thickness, thickness + space
+
+
+def find_measure_boxes(gray_image, margin_x=None, margin_y=None, target_spacing=10):
+    """
+    Finds the bounding box of every measure on a grayscale page.
+
+    High resolution pages are first downscaled so that the staff spacing is
+    about target_spacing pixels; detection then runs on the small page and the
+    boxes are mapped back to full resolution, so crops keep every pixel.
+
+    The staff line thickness and spacing are measured once per page and
+    every threshold is derived from them, so no tuning is needed for other
+    resolutions. By default margin_x is 0.6 spacings and margin_y 2.5
+    spacings (5 and 20 pixels at the 8 pixel spacing of Data/Example).
+
+    Returns:
+        list: (y_min, y_max, x_min, x_max) tuples in full resolution, in reading order.
+    """
+    # Downscale early: morphology and profiles don't need more than a few pixels per space
+    scale = 1.0
+    work_image = gray_image
+    with mozart_profile.stage('segmentation/estimate spacing'):
+        _, page_spacing = estimate_staff_spacing(gray_image)
+    if page_spacing > target_spacing:
+        scale = target_spacing / page_spacing
+        with mozart_profile.stage('segmentation/downscale'):
+            work_image = cv2.resize(gray_image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+    # Binarize the grayscale image (Otsu also keeps the faint, anti-aliased lines of small scans)
+    with mozart_profile.stage('segmentation/binarize'):
+        _, binary = cv2.threshold(work_image, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+
+    if page_spacing == 0:
+        print("Warning: No staff lines detected.")
+        return []
+    with mozart_profile.stage('segmentation/staff lines'):
+        lines = find_staff_lines(binary, page_spacing * scale)
+    if len(lines) < 2:
+        print("Warning: No staff lines detected.")
+        return []
+
+    thickness, spacing = estimate_staff_metrics(lines)
+    staves = group_staves(lines, spacing)
+    ignored = len(lines) - sum(len(staff) for staff in staves)
+    if ignored:
+        print(f"Warning: Ignoring {ignored} line-like rows that are not part of a staff.")
+    print(f"Detected {len(lines)} staff lines in {len(staves)} staves "
+          f"(thickness {thickness / scale:.1f}px, spacing {spacing / scale:.1f}px, detection scale {scale:.2f})")
+
+    # Margins are in full resolution pixels
+    if margin_x is None:
+        margin_x = int(round(0.6 * spacing / scale))
+    if margin_y is None:
+        margin_y = int(round(2.5 * spacing / scale))
+    height, width = gray_image.shape[:2]
 
-        column_boundaries.insert(0, 0)  # Add leftmost boundary
-        print(f"Staff {i + 1}: Detected {len(column_boundaries) - 1} measure boundaries (including the first).")
+    def to_full(v):
+        return int(round(v / scale))
+
+    boxes = []
+    for i, staff in enumerate(staves):
+        top, bottom = staff[0, 0], staff[-1, 1]
+
+        # Staff horizontal extent: columns where at least half of its lines have ink
+        line_rows = binary[(staff[:, 0] + staff[:, 1]) // 2]
+        columns = np.flatnonzero(np.count_nonzero(line_rows, axis=0) * 2 >= len(staff))
+        staff_x_min, staff_x_max = int(columns[0]), int(columns[-1]) + 1
+
+        with mozart_profile.stage('segmentation/barlines'):
+            barlines = find_barlines(binary[top:bottom, staff_x_min:staff_x_max], spacing)
+        if not barlines:
+            print(f"Warning: No measure boundaries detected in staff {i + 1}, keeping it whole.")
+
+        x_min = max(to_full(staff_x_min) - margin_x, 0)
+        x_max = min(to_full(staff_x_max) + margin_x, width)
+        y_min = max(to_full(top) - margin_y, 0)
+        y_max = min(to_full(bottom) + margin_y, height)
+
+        # Measures go from the left edge to each barline, and from the last
+        # barline to the right edge if something wide enough is left there
+        column_boundaries = [x_min] + [to_full(staff_x_min + x) for x in barlines]
+        if staff_x_max - (staff_x_min + ([0] + barlines)[-1]) > 4 * spacing:
+            column_boundaries.append(x_max)
+        print(f"Staff {i + 1}: Detected {len(column_boundaries) - 1} measures.")
+        mozart_profile.count('measures', len(column_boundaries) - 1)
 
-        # Split staff into individual measures
         for j in range(len(column_boundaries) - 1):
-            measure_x_min = max(column_boundaries[j] - margin_x, 0)
-            measure_x_max = min(column_boundaries[j + 1] + margin_x, staff_image.shape[1])
-
-            # Apply cropping on the **original** image instead of the binarized one
-            measure_image = original_image[y_min:y_max, x_min + measure_x_min:x_min + measure_x_max]
-
-            if measure_image.size == 0:
-                print(f"Warning: Measure image for measure {measure_count + 1} is empty.")
-                continue
-
-            # Check for multi-measure rests
-            duration = 1  # Default duration if not a multi-measure rest
-            measure_number = measure_count + 1
-            if multi_measure_rests:
-                for rest in multi_measure_rests:
-                    if rest[0] == measure_number:
-                        duration = rest[1]
-                        break
-
-            # Save the cropped measure from the original image
-            output_path = os.path.join(output_dir, f"measure_{measure_number}.png")
-            cv2.imwrite(output_path, measure_image)
-            all_filenames.append(output_path)  # Store the filename
-            measure_count += duration  # Increment measure count by duration
-
-    print(f"Saved {measure_count} measures to '{output_dir}'.")
+            measure_x_min = max(column_boundaries[j] - margin_x, x_min)
+            measure_x_max = min(column_boundaries[j + 1] + margin_x, x_max)
+            boxes.append((y_min, y_max, measure_x_min, measure_x_max))
+
+    return boxes
+
+
+def page_measures(gray_image, margin_x=None, margin_y=None):
+    """
+    Splits an already decoded page into measure images.
+
+    The page is decoded by the caller (see load_page()), which can then
+    tell a page that does not decode from a page without measures.
+
+    Parameters:
+        gray_image (np.ndarray): Grayscale page.
+        margin_x (int): Horizontal margin added around every measure, derived from the staff spacing if None.
+        margin_y (int): Vertical margin added around every staff, derived from the staff spacing if None.
+
+    Returns:
+        list: Grayscale measure images as NumPy views of the page, in reading order.
+    """
+    measures = []
+    for y_min, y_max, x_min, x_max in find_measure_boxes(gray_image, margin_x, margin_y):
+        measure_image = gray_image[y_min:y_max, x_min:x_max]
+        if measure_image.size == 0:
+            print(f"Warning: Measure image after measure {len(measures)} is empty.")
+            continue
+        measures.append(measure_image)
+    return measures
+
+
+def _numbered_measures(gray_image, multi_measure_rests, margin_x, margin_y):
+    # Yields (measure_number, measure_image) with measure_image a view of gray_image
+    measure_count = 0
+    for measure_image in page_measures(gray_image, margin_x, margin_y):
+        # Check for multi-measure rests
+        duration = 1  # Default duration if not a multi-measure rest
+        measure_number = measure_count + 1
+        if multi_measure_rests:
+            for rest in multi_measure_rests:
+                if rest[0] == measure_number:
+                    duration = rest[1]
+                    break
+
+        yield measure_number, measure_image
+        measure_count += duration  # Increment measure count by duration
+
+
+def segment_measures(page, multi_measure_rests=None, margin_x=None, margin_y=None, debug_dir=None):
+    """
+    Splits a page into measure images without going through the disk.
+
+    The page is decoded once as grayscale and every measure is returned as a
+    view (a slice, not a copy) of that page, ready for MusicScorePredictor.
+
+    Parameters:
+        page (str, bytes or np.ndarray): Path to the image, encoded image bytes or a decoded image.
+        multi_measure_rests (list): [measure_number, duration] pairs, only used to number debug files.
+        margin_x (int): Horizontal margin added around every measure, derived from the staff spacing if None.
+        margin_y (int): Vertical margin added around every staff, derived from the staff spacing if None.
+        debug_dir (str): If given, every measure is also written there as measure_N.png.
+
+    Returns:
+        list: Grayscale measure images as NumPy views of the page.
+    """
+    gray_image = load_page(page)
+    if gray_image is None:
+        print("Error: Could not load image.")
+        return []
+
+    if debug_dir:
+        os.makedirs(debug_dir, exist_ok=True)
+
+    measures = []
+    for measure_number, measure_image in _numbered_measures(gray_image, multi_measure_rests, margin_x, margin_y):
+        if debug_dir:
+            cv2.imwrite(os.path.join(debug_dir, f"measure_{measure_number}.png"), measure_image)
+        measures.append(measure_image)
+
+    return measures
+
+
+def split_sheet_music_per_measure(image_path, output_dir, multi_measure_rests=None, margin_x=None, margin_y=None):
+    """
+    Splits a page into measures and saves each one to output_dir/measure_N.png.
+
+    Kept for callers that need the files; segment_measures() returns the
+    measures in memory instead.
+
+    Returns:
+        list: The generated filenames.
+    """
+    # Ensure the output directory exists
+    os.makedirs(output_dir, exist_ok=True)
+
+    gray_image = load_page(image_path)
+    if gray_image is None:
+        print("Error: Could not load image.")
+        return []
+
+    all_filenames = []  # List to store all generated filenames
+    for measure_number, measure_image in _numbered_measures(gray_image, multi_measure_rests, margin_x, margin_y):
+        output_path = os.path.join(output_dir, f"measure_{measure_number}.png")
+        cv2.imwrite(output_path, measure_image)
+        all_filenames.append(output_path)  # Store the filename
+
+    print(f"Saved {len(all_filenames)} measures to '{output_dir}'.")
     return all_filenames  # Return the list of filenames
 
-# Example usage
-image_path = "Data/Example/Capture.png"
-output_dir = "Data/Temp"
-# Define multi-measure rests as nested list: [measure_number, duration]
-multi_measure_rests = []  # Example: measure 1 is 2 measures long, measure 4 is 3 measures long
 
-file_list = split_sheet_music_per_measure(image_path, output_dir, multi_measure_rests, margin_x=5, margin_y=20)
-print("Generated files:", file_list)
+if __name__ == "__main__":
+    # Example usage
+    image_path = "Data/Example/Capture.png"
+    output_dir = "Data/Temp"
+    # Define multi-measure rests as nested list: [measure_number, duration]
+    multi_measure_rests = []  # Example: measure 1 is 2 measures long, measure 4 is 3 measures long
+
+    file_list = split_sheet_music_per_measure(image_path, output_dir, multi_measure_rests)
+    print("Generated files:", file_list)
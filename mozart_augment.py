@@ -0,0 +1,193 @@
+import argparse
+import functools
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+import mozart_utils
+
+NOISE_TEXTURE_SHAPE = (256, 4096)
+
+
+@functools.lru_cache(maxsize=None)
+def _noise_texture():
+    # Gaussian noise drawn at half the resolution and upsampled, closer to
+    # the spatially correlated noise of a demosaiced, compressed photo. Built
+    # once per process, with a fixed seed so that seeded runs stay
+    # reproducible whatever the process that builds it.
+    height, width = NOISE_TEXTURE_SHAPE
+    noise = np.random.default_rng(0).standard_normal((height // 2, width // 2)).astype(np.float32)
+    return cv2.resize(noise, (width, height), interpolation=cv2.INTER_LINEAR)
+
+
+class Augmenter:
+    """
+    Random camera-like distortions of a staff image, drawn anew every time
+    a sample is read, in place of the single pre-rendered _distorted.jpg.
+
+    The perspective warp and the elastic deformation are combined into one
+    displacement field and applied with a single cv2.remap(); contrast,
+    brightness and gamma are one cv2.LUT(); then come the Gaussian blur and
+    the sensor noise, cropped from a fixed noise texture at a random offset.
+    All of it runs on the image already resized to the model height, in the
+    worker processes of CTC_PriMuS.batchGenerator().
+
+    Every distortion is applied with the given probability and a random
+    strength up to its maximum; a maximum of 0 disables it.
+
+    Parameters:
+        perspective (float): Maximum displacement of the corners, as a fraction of the height.
+        elastic (float): Maximum amplitude of the elastic deformation, in pixels.
+        elastic_grid (int): Spacing of the random displacements of the elastic deformation, in pixels.
+        contrast (float): Maximum relative change of the contrast; the brightness changes by up to half of it.
+        gamma (float): Maximum relative change of the gamma.
+        blur (float): Maximum sigma of the Gaussian blur, in pixels.
+        noise (float): Maximum standard deviation of the Gaussian noise, in gray levels.
+        probability (float): Chance of every distortion to be applied.
+    """
+
+    def __init__(self, perspective=0.08, elastic=1.5, elastic_grid=24, contrast=0.4, gamma=0.3, blur=1.2,
+                 noise=10.0, probability=0.5):
+        self.perspective = perspective
+        self.elastic = elastic
+        self.elastic_grid = elastic_grid
+        self.contrast = contrast
+        self.gamma = gamma
+        self.blur = blur
+        self.noise = noise
+        self.probability = probability
+
+    def __call__(self, image, rng):
+        """
+        Parameters:
+            image (np.ndarray): Grayscale uint8 image.
+            rng (np.random.Generator): Source of the randomness, e.g. np.random.default_rng(seed).
+
+        Returns:
+            np.ndarray: The distorted uint8 image, of the same size.
+        """
+        apply = rng.random(5) < self.probability
+        image = self._warp(image, rng, apply[0] and self.perspective > 0, apply[1] and self.elastic > 0)
+        if apply[2] and (self.contrast > 0 or self.gamma > 0):
+            image = cv2.LUT(image, self._tone_curve(rng))
+        if apply[3] and self.blur > 0:
+            image = cv2.GaussianBlur(image, (0, 0), rng.uniform(0.3, self.blur))
+        if apply[4] and self.noise > 0:
+            image = self._add_noise(image, rng)
+        return image
+
+    def _add_noise(self, image, rng):
+        # A random crop of the texture, scaled to a random strength and
+        # added in one pass: much cheaper than drawing new noise for every
+        # sample, and the hundreds of thousands of offsets keep it varied
+        height, width = image.shape
+        texture = _noise_texture()
+        if height > texture.shape[0] or width > texture.shape[1]:
+            texture = np.tile(texture, (-(-height // texture.shape[0]), -(-width // texture.shape[1])))
+        y = rng.integers(texture.shape[0] - height + 1)
+        x = rng.integers(texture.shape[1] - width + 1)
+        return cv2.addWeighted(image, 1.0, texture[y:y + height, x:x + width], rng.uniform(-self.noise, self.noise),
+                               0.0, dtype=cv2.CV_8U)
+
+    def _warp(self, image, rng, perspective, elastic):
+        if not perspective and not elastic:
+            return image
+        height, width = image.shape
+
+        # Source coordinates of every output pixel, computed on a coarse grid
+        # and interpolated: both distortions are smooth, and resizing a small
+        # two-channel field is much cheaper than evaluating them at every
+        # pixel. cv2.resize() only interpolates between the grid points and
+        # repeats the outer ones, so the grid is resized a little past the
+        # image on every side, far enough for the outer points to lie outside
+        # of it, and the image part is cut out of the result.
+        grid_width = max(width // self.elastic_grid, 1) + 2
+        grid_height = max(height // self.elastic_grid, 1) + 2
+        pad_x = max(-(-(width - grid_width) // (2 * (grid_width - 1))), 0)
+        pad_y = max(-(-(height - grid_height) // (2 * (grid_height - 1))), 0)
+        # Pixel coordinates of the grid points, as cv2.resize() interpolates them
+        xs = (np.arange(grid_width, dtype=np.float32) + 0.5) * ((width + 2 * pad_x) / grid_width) - 0.5 - pad_x
+        ys = (np.arange(grid_height, dtype=np.float32) + 0.5) * ((height + 2 * pad_y) / grid_height) - 0.5 - pad_y
+        xs, ys = np.meshgrid(xs, ys)
+        sampling = np.empty((grid_height, grid_width, 2), dtype=np.float32)
+
+        if perspective:
+            # The corners of the image move randomly, as if photographed at a slight angle
+            corners = np.float32([[0, 0], [width - 1, 0], [width - 1, height - 1], [0, height - 1]])
+            moved = corners + rng.uniform(-1, 1, (4, 2)).astype(np.float32) * np.float32(self.perspective * height)
+            m = cv2.getPerspectiveTransform(corners, moved).astype(np.float32)
+            den = m[2, 0] * xs + m[2, 1] * ys + m[2, 2]
+            sampling[..., 0] = (m[0, 0] * xs + m[0, 1] * ys + m[0, 2]) / den
+            sampling[..., 1] = (m[1, 0] * xs + m[1, 1] * ys + m[1, 2]) / den
+        else:
+            sampling[..., 0] = xs
+            sampling[..., 1] = ys
+        if elastic:
+            sampling += rng.uniform(-1, 1, sampling.shape).astype(np.float32) * np.float32(rng.uniform(0, self.elastic))
+
+        sampling = cv2.resize(sampling, (width + 2 * pad_x, height + 2 * pad_y), interpolation=cv2.INTER_LINEAR)
+        sampling = sampling[pad_y:pad_y + height, pad_x:pad_x + width]
+        return cv2.remap(image, sampling, None, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+
+    def _tone_curve(self, rng):
+        levels = np.arange(256, dtype=np.float32) / 255
+        levels = levels ** np.float32(1 + rng.uniform(-self.gamma, self.gamma))
+        levels = (levels - 0.5) * (1 + rng.uniform(-self.contrast, self.contrast)) + 0.5
+        levels += rng.uniform(-self.contrast, self.contrast) / 2
+        return np.clip(levels * 255, 0, 255).astype(np.uint8)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the augmentation cost against reading the pre-rendered distortions.')
+    parser.add_argument('-corpus', dest='corpus', type=str, required=True, help='Path to the corpus.')
+    parser.add_argument('-set', dest='set', type=str, required=True, help='Path to the set file.')
+    parser.add_argument('-samples', dest='samples', type=int, default=200)
+    parser.add_argument('-img_height', dest='img_height', type=int, default=128)
+    parser.add_argument('-seed', dest='seed', type=int, default=0)
+    parser.add_argument('-workers', dest='workers', type=int, default=os.cpu_count(),
+                        help='Worker processes the augmentation is also timed in, as in training.')
+    parser.add_argument('-preview', dest='preview', type=str, default=None, help='Folder to write a few augmented samples to.')
+    args = parser.parse_args()
+
+    with open(args.set, 'r') as f:
+        names = f.read().splitlines()[:args.samples]
+    paths = [args.corpus + '/' + name + '/' + name for name in names]
+    augmenter = Augmenter()
+    rng = np.random.default_rng(args.seed)
+
+    def timed(label, function, inputs):
+        start = time.perf_counter()
+        outputs = [function(x) for x in inputs]
+        cost = 1000 * (time.perf_counter() - start) / len(inputs)
+        print(f'{label:<32} {cost:6.2f} ms/sample')
+        return outputs, cost
+
+    def read(path):
+        return mozart_utils.resize(cv2.imread(path, cv2.IMREAD_GRAYSCALE), args.img_height)
+
+    images, _ = timed('PNG', read, [path + '.png' for path in paths])
+    augmenter(images[0], rng)  # Builds the noise texture, once per process
+    augmented, augmentation_cost = timed('On-the-fly augmentation', lambda image: augmenter(image, rng), images)
+    if args.workers > 1:
+        # As in CTC_PriMuS.batchGenerator(): the training loop only waits
+        # for the samples, distorted in parallel by the worker processes
+        rngs = [np.random.default_rng(seed) for seed in np.random.SeedSequence(args.seed).spawn(len(images))]
+        with ProcessPoolExecutor(args.workers) as executor:
+            list(executor.map(augmenter, images[:args.workers], rngs[:args.workers]))  # Started before the timing
+            start = time.perf_counter()
+            list(executor.map(augmenter, images, rngs, chunksize=8))
+            augmentation_cost = 1000 * (time.perf_counter() - start) / len(images)
+            print(f'{f"In {args.workers} worker processes":<32} {augmentation_cost:6.2f} ms/sample')
+    if all(os.path.exists(path + '_distorted.jpg') for path in paths):
+        _, jpeg_cost = timed('Pre-rendered _distorted.jpg', read, [path + '_distorted.jpg' for path in paths])
+        where = f' in {args.workers} worker processes' if args.workers > 1 else ''
+        print(f'The augmentation{where} costs {augmentation_cost / jpeg_cost:.2f} times the read of the pre-rendered JPEG')
+
+    if args.preview:
+        os.makedirs(args.preview, exist_ok=True)
+        for name, image in list(zip(names, augmented))[:16]:
+            cv2.imwrite(os.path.join(args.preview, name + '_augmented.png'), image)
+        print(f'Wrote {min(16, len(names))} samples to {args.preview}')
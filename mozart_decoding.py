@@ -0,0 +1,265 @@
+import argparse
+import math
+
+import numpy as np
+
+import mozart_utils
+
+NEG_INF = -math.inf
+
+
+def _logaddexp(a, b):
+    # Scalar log(exp(a) + exp(b)), much cheaper than np.logaddexp on Python floats
+    if a == NEG_INF:
+        return b
+    if b == NEG_INF:
+        return a
+    if a > b:
+        return a + math.log1p(math.exp(b - a))
+    return b + math.log1p(math.exp(a - b))
+
+
+class TokenPrior:
+    """
+    Bigram language model over the tokens of the vocabulary.
+
+    Built from the ground truth of the training corpus, it scores how likely
+    a token is to follow another one, so the beam search prefers sequences
+    that respect the grammar of the encoding: a barline never directly
+    follows a clef, and keySignature only follows the clef or another
+    keySignature, which keeps it at the start of the staff.
+
+    Index vocabulary_size is the boundary token: the row
+    log_probs[vocabulary_size] is the distribution of the first token and
+    the column the probability of ending after a token.
+
+    Parameters:
+        log_probs (np.ndarray): (vocabulary_size + 1, vocabulary_size + 1) log P(next | previous).
+    """
+
+    def __init__(self, log_probs):
+        self.log_probs = np.asarray(log_probs, dtype=np.float32)
+        self.vocabulary_size = self.log_probs.shape[0] - 1
+
+    @classmethod
+    def from_sequences(cls, sequences, vocabulary_size, smoothing=0.01):
+        """
+        Estimates the bigrams of sequences of token ids with additive smoothing.
+
+        Transitions never seen in the corpus keep a small probability
+        (controlled by smoothing) so that the acoustic evidence can still win.
+        """
+        boundary = vocabulary_size
+        counts = np.zeros((vocabulary_size + 1, vocabulary_size + 1), dtype=np.float64)
+        for sequence in sequences:
+            tokens = np.concatenate(([boundary], np.asarray(sequence, dtype=np.int64), [boundary]))
+            np.add.at(counts, (tokens[:-1], tokens[1:]), 1)
+
+        counts += smoothing
+        counts[boundary, boundary] = 0  # Empty sequences are not modelled
+        with np.errstate(divide='ignore'):
+            log_probs = np.log(counts / counts.sum(axis=1, keepdims=True))
+        return cls(log_probs)
+
+    def save(self, path):
+        np.save(path, self.log_probs)
+
+    @classmethod
+    def load(cls, path):
+        return cls(np.load(path))
+
+    def sequence_log_prob(self, sequence):
+        tokens = [self.vocabulary_size] + list(sequence) + [self.vocabulary_size]
+        return float(sum(self.log_probs[a, b] for a, b in zip(tokens[:-1], tokens[1:])))
+
+
+def prefix_beam_search(log_probs, beam_width=8, prior=None, lm_weight=0.5, insertion_bonus=0.0,
+                       token_threshold=1e-3, max_candidates=8):
+    """
+    CTC prefix beam search over the output of one sample.
+
+    Parameters:
+        log_probs (np.ndarray): (time, vocabulary_size + 1) log-softmax outputs, blank last.
+        beam_width (int): Number of prefixes kept after every frame.
+        prior (TokenPrior): Optional language model, weighted by lm_weight.
+        insertion_bonus (float): Added per emitted token, compensates the length penalty of the prior.
+        token_threshold (float): Tokens below this probability in a frame are not expanded.
+        max_candidates (int): Maximum number of tokens expanded per frame.
+
+    Returns:
+        list: The token ids of the best prefix.
+    """
+    log_probs = np.asarray(log_probs, dtype=np.float64)
+    blank = log_probs.shape[1] - 1
+    log_threshold = math.log(token_threshold)
+    boundary = prior.vocabulary_size if prior is not None else None
+    lm = prior.log_probs if prior is not None else None
+
+    # prefix -> [log P(ending in blank), log P(ending in a token)], and its language model score
+    beams = {(): [0.0, NEG_INF]}
+    lm_scores = {(): 0.0}
+
+    # Pruning, done for all the frames at once: only the max_candidates most
+    # likely tokens of a frame above token_threshold can extend a prefix, plus
+    # the greedy token so that the greedy path is never pruned
+    num_candidates = min(max_candidates, blank)
+    top = np.argpartition(log_probs[:, :blank], -num_candidates, axis=1)[:, -num_candidates:]
+    top_lp = np.take_along_axis(log_probs, top, axis=1)
+    keep = (top_lp > log_threshold) | (top == log_probs.argmax(axis=1)[:, None])
+
+    for frame, frame_top, frame_top_lp, frame_keep in zip(log_probs, top, top_lp, keep):
+        candidates = list(zip(frame_top[frame_keep].tolist(), frame_top_lp[frame_keep].tolist()))
+        blank_lp = float(frame[blank])
+
+        next_beams = {}
+        for prefix, (pb, pnb) in beams.items():
+            total = _logaddexp(pb, pnb)
+            last = prefix[-1] if prefix else None
+
+            # The prefix stays the same: a blank, or the last token repeated
+            entry = next_beams.get(prefix)
+            if entry is None:
+                next_beams[prefix] = entry = [NEG_INF, NEG_INF]
+            entry[0] = _logaddexp(entry[0], total + blank_lp)
+            if last is not None:
+                entry[1] = _logaddexp(entry[1], pnb + float(frame[last]))
+
+            for c, c_lp in candidates:
+                new_prefix = prefix + (c,)
+                # A repeated token is only a new emission after a blank
+                score = (pb if c == last else total) + c_lp
+                entry = next_beams.get(new_prefix)
+                if entry is None:
+                    next_beams[new_prefix] = entry = [NEG_INF, NEG_INF]
+                    if new_prefix not in lm_scores:
+                        transition = float(lm[boundary if last is None else last, c]) if lm is not None else 0.0
+                        lm_scores[new_prefix] = lm_scores[prefix] + lm_weight * transition + insertion_bonus
+                entry[1] = _logaddexp(entry[1], score)
+
+        if len(next_beams) > beam_width:
+            ranked = sorted(next_beams.items(), key=lambda item: _logaddexp(*item[1]) + lm_scores[item[0]],
+                            reverse=True)
+            beams = dict(ranked[:beam_width])
+        else:
+            beams = next_beams
+
+    def final_score(item):
+        prefix, (pb, pnb) = item
+        score = _logaddexp(pb, pnb) + lm_scores[prefix]
+        if lm is not None:
+            score += lm_weight * float(lm[prefix[-1] if prefix else boundary, boundary])
+        return score
+
+    best_prefix, _ = max(beams.items(), key=final_score)
+    return list(best_prefix)
+
+
+def beam_search_batch(log_probs, seq_lengths, **kwargs):
+    """
+    Runs prefix_beam_search() on every sample of a time-major batch.
+
+    Parameters:
+        log_probs (np.ndarray): (time, batch, vocabulary_size + 1) log-softmax outputs.
+        seq_lengths (list): Number of valid frames of every sample.
+
+    Returns:
+        list: One list of token ids per sample.
+    """
+    return [prefix_beam_search(log_probs[:length, b], **kwargs) for b, length in enumerate(seq_lengths)]
+
+
+def greedy_decode_batch(log_probs, seq_lengths):
+    """
+    Best path CTC decoding of a time-major batch, like tf.nn.ctc_greedy_decoder:
+    the most likely class of every frame, with repeats merged and blanks removed.
+
+    Parameters:
+        log_probs (np.ndarray): (time, batch, vocabulary_size + 1) outputs, blank last.
+        seq_lengths (list): Number of valid frames of every sample.
+
+    Returns:
+        list: One array of token ids per sample.
+    """
+    blank = log_probs.shape[2] - 1
+    best = np.argmax(log_probs, axis=2).T  # (batch, time)
+    previous = np.concatenate([np.full((best.shape[0], 1), -1), best[:, :-1]], axis=1)
+    valid = np.arange(best.shape[1])[None, :] < np.asarray(seq_lengths)[:, None]
+    emit = (best != blank) & (best != previous) & valid
+    return [row[mask] for row, mask in zip(best, emit)]
+
+
+class GreedyStreamDecoder:
+    """
+    Greedy CTC decoding of one sequence whose frames arrive in chunks.
+
+    The best class of the last frame is carried from one chunk to the next,
+    so a token whose frames straddle the seam between two chunks is emitted
+    once, exactly as if the whole sequence had been decoded at once.
+    """
+
+    def __init__(self):
+        self.previous = -1
+
+    def reset(self):
+        self.previous = -1
+
+    def decode(self, log_probs):
+        """
+        Parameters:
+            log_probs (np.ndarray): (time, vocabulary_size + 1) outputs of the next frames, blank last.
+
+        Returns:
+            np.ndarray: The token ids completed by these frames.
+        """
+        if len(log_probs) == 0:
+            return np.zeros(0, dtype=np.int64)
+        blank = log_probs.shape[1] - 1
+        best = np.argmax(log_probs, axis=1)
+        previous = np.concatenate(([self.previous], best[:-1]))
+        self.previous = int(best[-1])
+        return best[(best != blank) & (best != previous)]
+
+
+def read_ground_truth(corpus_dirpath, corpus_filepath, dictionary_path, semantic):
+    """ Token id sequences of the samples listed in corpus_filepath. """
+    with open(dictionary_path, 'r') as f:
+        word2int = {}
+        for word in f.read().splitlines():
+            if word not in word2int:
+                word2int[word] = len(word2int)
+    with open(corpus_filepath, 'r') as f:
+        names = f.read().splitlines()
+
+    sequences = []
+    for name in names:
+        with open(corpus_dirpath + '/' + name + '/' + name + ('.semantic' if semantic else '.agnostic'), 'r') as f:
+            tokens = f.readline().rstrip().split(mozart_utils.word_separator())
+        sequences.append([word2int[token] for token in tokens])
+    return sequences, len(word2int)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the token prior used by the beam search decoder.')
+    parser.add_argument('-corpus', dest='corpus', type=str, help='Path to the corpus.')
+    parser.add_argument('-set', dest='set', type=str, default='Data/train.txt', help='Path to the training set file.')
+    parser.add_argument('-vocabulary', dest='voc', type=str, required=True, help='Path to the vocabulary file.')
+    parser.add_argument('-semantic', dest='semantic', action="store_true", default=False)
+    parser.add_argument('-packed', dest='packed', type=str, default=None,
+                        help='Read the labels from a corpus packed with primus_pack.py instead.')
+    parser.add_argument('-smoothing', dest='smoothing', type=float, default=0.01)
+    parser.add_argument('-output', dest='output', type=str, required=True, help='Where to save the prior (.npy).')
+    args = parser.parse_args()
+    if args.corpus is None and args.packed is None:
+        parser.error('the ground truth is read from -corpus or -packed')
+
+    if args.packed:
+        import primus_pack
+        packed = primus_pack.PackedCorpus(args.packed)
+        sequences = [packed.label(idx) for idx in range(len(packed))]
+        vocabulary_size = len(dict.fromkeys(packed.vocabulary))
+    else:
+        sequences, vocabulary_size = read_ground_truth(args.corpus, args.set, args.voc, args.semantic)
+
+    prior = TokenPrior.from_sequences(sequences, vocabulary_size, args.smoothing)
+    prior.save(args.output)
+    print(f'Saved the bigrams of {len(sequences)} sequences to {args.output}')
@@ -0,0 +1,187 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import time
+
+import numpy as np
+
+import mozart_utils
+
+
+def peak_rss_mb():
+    """ Peak resident set size of this process in MiB. """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+def evaluate(predictor, primus, sample_list, batch_size=16, chunk_size=512):
+    """
+    Runs a predictor over sample_list and measures accuracy and speed.
+
+    Samples are read chunk_size at a time, grouped by width and decoded in
+    batches of up to batch_size staves. The latency of a staff is the time
+    of the forward pass that decoded it.
+
+    Returns:
+        dict: The metrics, ready to be written as JSON.
+    """
+    params = {'img_height': int(predictor.HEIGHT)}
+    predictions = []
+    targets = []
+    latencies = []
+    input_time = 0.0
+    inference_time = 0.0
+
+    start = time.perf_counter()
+    for chunk_start in range(0, len(sample_list), chunk_size):
+        t = time.perf_counter()
+        images = []
+        for sample_filepath in sample_list[chunk_start:chunk_start + chunk_size]:
+            image, label = primus.readSample(sample_filepath, params, normalize=False)
+            images.append(predictor.preprocess(image))
+            targets.append(label)
+        input_time += time.perf_counter() - t
+
+        chunk_predictions = [None] * len(images)
+        for bucket in mozart_utils.width_buckets([img.shape[1] for img in images], batch_size):
+            t = time.perf_counter()
+            results = predictor.predict_preprocessed([images[i] for i in bucket], batch_size)
+            elapsed = time.perf_counter() - t
+            inference_time += elapsed
+            latencies.extend([elapsed] * len(bucket))
+            for i, result in zip(bucket, results):
+                chunk_predictions[i] = result
+        predictions.extend(chunk_predictions)
+
+        print(f'Evaluated {len(targets)}/{len(sample_list)} samples')
+    wall_time = time.perf_counter() - start
+
+    # Unknown words get an id outside the vocabulary, so they always count as errors
+    unknown = primus.vocabulary_size
+    prediction_ids = [[primus.word2int.get(w, unknown) for w in p] for p in predictions]
+    metrics = mozart_utils.symbol_error_rate(prediction_ids, targets)
+
+    latencies_ms = np.asarray(latencies) * 1000
+    return {
+        'num_samples': len(targets),
+        'batch_size': batch_size,
+        'ser': metrics['ser'],
+        'sequence_error_rate': metrics['sequence_errors'] / len(targets) if targets else 0.0,
+        'edit_distance': metrics['edit_distance'],
+        'target_length': metrics['target_length'],
+        'throughput_staves_per_s': len(targets) / inference_time if inference_time else 0.0,
+        'latency_ms': {
+            'mean': float(latencies_ms.mean()) if len(latencies) else 0.0,
+            'p50': float(np.percentile(latencies_ms, 50)) if len(latencies) else 0.0,
+            'p90': float(np.percentile(latencies_ms, 90)) if len(latencies) else 0.0,
+            'p99': float(np.percentile(latencies_ms, 99)) if len(latencies) else 0.0,
+        },
+        'input_seconds': input_time,
+        'inference_seconds': inference_time,
+        'wall_seconds': wall_time,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compares results with a baseline result file.
+
+    Returns:
+        list: Descriptions of the regressions beyond tolerance (relative).
+    """
+    regressions = []
+    if results['ser'] > baseline['ser'] * (1 + tolerance) and results['ser'] - baseline['ser'] > 1e-9:
+        regressions.append(f"SER {baseline['ser']:.4f} -> {results['ser']:.4f}")
+    if results['throughput_staves_per_s'] < baseline['throughput_staves_per_s'] * (1 - tolerance):
+        regressions.append(f"throughput {baseline['throughput_staves_per_s']:.1f} -> "
+                           f"{results['throughput_staves_per_s']:.1f} staves/s")
+    if results['latency_ms']['p90'] > baseline['latency_ms']['p90'] * (1 + tolerance):
+        regressions.append(f"p90 latency {baseline['latency_ms']['p90']:.1f} -> {results['latency_ms']['p90']:.1f} ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Evaluate a trained model on a test list.')
+    parser.add_argument('-corpus', dest='corpus', type=str, required=True, help='Path to the corpus.')
+    parser.add_argument('-set', dest='set', type=str, default='Data/test.txt', help='Path to the test set file.')
+    parser.add_argument('-model', dest='model', type=str, required=True, help='Path to the trained model (.meta).')
+    parser.add_argument('-vocabulary', dest='voc', type=str, required=True, help='Path to the vocabulary file.')
+    parser.add_argument('-semantic', dest='semantic', action="store_true", default=False)
+    parser.add_argument('-packed', dest='packed', type=str, default=None, help='Corpus packed with primus_pack.py.')
+    parser.add_argument('-batch_size', dest='batch_size', type=int, default=16)
+    parser.add_argument('-decoder', dest='decoder', type=str, default='greedy', choices=['greedy', 'beam'])
+    parser.add_argument('-beam_width', dest='beam_width', type=int, default=8)
+    parser.add_argument('-prior', dest='prior', type=str, default=None,
+                        help='Token prior built with mozart_decoding.py, used by the beam search.')
+    parser.add_argument('-lm_weight', dest='lm_weight', type=float, default=0.5)
+    parser.add_argument('-max_samples', dest='max_samples', type=int, default=None, help='Only evaluate the first samples.')
+    parser.add_argument('-output', dest='output', type=str, default=None, help='Where to write the JSON results.')
+    parser.add_argument('-reference', dest='reference', type=str, default=None,
+                        help='Float model to compare with (e.g. when -model is quantized): adds the speedup and SER change.')
+    parser.add_argument('-baseline', dest='baseline', type=str, default=None,
+                        help='JSON results of a previous run; exit with status 1 on regressions.')
+    parser.add_argument('-tolerance', dest='tolerance', type=float, default=0.05,
+                        help='Relative change allowed against the baseline.')
+    args = parser.parse_args()
+
+    import mozart_predict
+    from primus import CTC_PriMuS
+
+    primus = CTC_PriMuS(args.corpus, args.set, args.voc, args.semantic, packed_path=args.packed)
+    with open(args.set, 'r') as f:
+        sample_list = f.read().splitlines()[:args.max_samples]  # Keep the file order, it is reproducible
+
+    load_start = time.perf_counter()
+    predictor = mozart_predict.MusicScorePredictor(args.model, args.voc, decoder=args.decoder,
+                                                   beam_width=args.beam_width, prior=args.prior,
+                                                   lm_weight=args.lm_weight)
+    load_time = time.perf_counter() - load_start
+
+    results = evaluate(predictor, primus, sample_list, args.batch_size)
+    results.update({
+        'model': args.model,
+        'set': args.set,
+        'model_load_seconds': load_time,
+        'decoder': args.decoder,
+        'beam_width': args.beam_width if args.decoder == 'beam' else None,
+        'prior': args.prior if args.decoder == 'beam' else None,
+        'lm_weight': args.lm_weight if args.decoder == 'beam' and args.prior else None,
+        'host': platform.node(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    })
+    predictor.close()
+
+    if args.reference:
+        reference = mozart_predict.MusicScorePredictor(args.reference, args.voc, decoder=args.decoder,
+                                                       beam_width=args.beam_width, prior=args.prior,
+                                                       lm_weight=args.lm_weight)
+        reference_results = evaluate(reference, primus, sample_list, args.batch_size)
+        reference.close()
+        reference_results['model'] = args.reference
+        results['reference'] = reference_results
+        results['speedup'] = (results['throughput_staves_per_s'] / reference_results['throughput_staves_per_s']
+                              if reference_results['throughput_staves_per_s'] else None)
+        results['ser_delta'] = results['ser'] - reference_results['ser']
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f'Regression: {regression}')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+import argparse
+import functools
+import hashlib
+import os
+import re
+import time
+
+import numpy as np
+
+# Kinds of events
+UNKNOWN, NOTE, GRACENOTE, REST, BARLINE, TIE, CLEF, KEY, TIME, MULTIREST = range(10)
+KIND_NAMES = ['unknown', 'note', 'gracenote', 'rest', 'barline', 'tie', 'clef', 'key', 'time', 'multirest']
+
+STEPS = 'CDEFGAB'
+
+# Note values of the semantic encoding: (name, length in quarter notes, MusicXML <type>)
+NOTE_TYPES = [
+    ('quadruple_whole', 16.0, 'long'),
+    ('double_whole', 8.0, 'breve'),
+    ('whole', 4.0, 'whole'),
+    ('half', 2.0, 'half'),
+    ('quarter', 1.0, 'quarter'),
+    ('eighth', 0.5, 'eighth'),
+    ('sixteenth', 0.25, '16th'),
+    ('thirty_second', 0.125, '32nd'),
+    ('sixty_fourth', 0.0625, '64th'),
+    ('hundred_twenty_eighth', 0.03125, '128th'),
+]
+_TYPE_INDEX = {name: idx for idx, (name, _, _) in enumerate(NOTE_TYPES)}
+
+# Fifths of the major keys; a minor key has the signature of its relative major, three fifths up
+KEY_FIFTHS = {'Cb': -7, 'Gb': -6, 'Db': -5, 'Ab': -4, 'Eb': -3, 'Bb': -2, 'F': -1, 'C': 0,
+              'G': 1, 'D': 2, 'A': 3, 'E': 4, 'B': 5, 'F#': 6, 'C#': 7}
+_ALTERS = {'': 0, '#': 1, '##': 2, 'b': -1, 'bb': -2, 'N': 0}
+
+# One row per token. Depending on the kind:
+#   note, gracenote: step (index in STEPS), octave, alter
+#   note, gracenote, rest: duration (quarter notes, dots included), type (index in NOTE_TYPES), dots, fermata
+#   clef: step (index of the sign in STEPS), value = line
+#   key: value = fifths
+#   time: value = beats, value2 = beat type
+#   multirest: value = number of measures
+EVENT_DTYPE = np.dtype([
+    ('kind', 'u1'), ('step', 'u1'), ('octave', 'i1'), ('alter', 'i1'),
+    ('duration', 'f4'), ('type', 'u1'), ('dots', 'u1'), ('fermata', '?'),
+    ('value', 'i2'), ('value2', 'i2'),
+])
+
+_UNKNOWN_EVENT = (UNKNOWN, 0, 0, 0, 0.0, 0, 0, False, 0, 0)
+
+_PITCH = re.compile(r'([A-G])(##|#|bb|b|N)?(-?\d+)$')
+_VALUE = re.compile(r'([a-z_]+?)(\.*)(_fermata)?$')
+
+
+def _note_value(text):
+    # quarter.._fermata -> (duration, type, dots, fermata)
+    match = _VALUE.match(text)
+    if not match or match.group(1) not in _TYPE_INDEX:
+        return None
+    type_index = _TYPE_INDEX[match.group(1)]
+    dots = len(match.group(2))
+    return NOTE_TYPES[type_index][1] * (2 - 0.5 ** dots), type_index, dots, match.group(3) is not None
+
+
+@functools.lru_cache(maxsize=None)
+def parse_token(token):
+    """
+    Parses one token of the semantic encoding.
+
+    Parameters:
+        token (str): e.g. 'note-Bb4_quarter.', 'gracenote-C5_eighth', 'rest-half_fermata', 'clef-G2'.
+
+    Returns:
+        tuple: The event, with the fields of EVENT_DTYPE. Tokens that cannot be parsed are UNKNOWN events.
+    """
+    if token == 'barline':
+        return (BARLINE,) + _UNKNOWN_EVENT[1:]
+    if token == 'tie':
+        return (TIE,) + _UNKNOWN_EVENT[1:]
+
+    name, _, argument = token.partition('-')
+    try:
+        if name in ('note', 'gracenote'):
+            pitch, _, value = argument.partition('_')
+            pitch_match = _PITCH.match(pitch)
+            note_value = _note_value(value)
+            if pitch_match and note_value:
+                step, alter, octave = pitch_match.groups()
+                duration, type_index, dots, fermata = note_value
+                return (NOTE if name == 'note' else GRACENOTE, STEPS.index(step), int(octave),
+                        _ALTERS[alter or ''], duration, type_index, dots, fermata, 0, 0)
+        elif name == 'rest':
+            note_value = _note_value(argument)
+            if note_value:
+                duration, type_index, dots, fermata = note_value
+                return (REST, 0, 0, 0, duration, type_index, dots, fermata, 0, 0)
+        elif name == 'clef':
+            if argument[0] in 'CFG':
+                return (CLEF, STEPS.index(argument[0]), 0, 0, 0.0, 0, 0, False, int(argument[1:]), 0)
+        elif name == 'keySignature':
+            tonic = argument[:-1]
+            if argument[-1] == 'M' and tonic in KEY_FIFTHS:
+                return (KEY, 0, 0, 0, 0.0, 0, 0, False, KEY_FIFTHS[tonic], 0)
+            if argument[-1] == 'm' and tonic in KEY_FIFTHS:
+                return (KEY, 0, 0, 0, 0.0, 0, 0, False, KEY_FIFTHS[tonic] - 3, 0)
+        elif name == 'timeSignature':
+            if argument in ('C', 'C/'):  # Common and cut time
+                beats, beat_type = (4, 4) if argument == 'C' else (2, 2)
+            else:
+                beats, beat_type = (int(part) for part in argument.split('/'))
+            return (TIME, 0, 0, 0, 0.0, 0, 0, False, beats, beat_type)
+        elif name == 'multirest':
+            return (MULTIREST, 0, 0, 0, 0.0, 0, 0, False, int(argument), 0)
+    except (ValueError, IndexError):
+        pass
+    return _UNKNOWN_EVENT
+
+
+class EventTable:
+    """
+    The events of all the tokens of a vocabulary, indexed by token id.
+
+    Parsing a token takes a few string operations; with the table, the
+    token ids coming out of the decoder are turned into events with a
+    plain index, and the vocabulary is only parsed once. The array is
+    cached next to the vocabulary file (vocabulary_semantic.txt.events.npz)
+    and rebuilt when the vocabulary changes.
+
+    The ids are those of MusicScorePredictor: the line of the token in the
+    vocabulary file, and one more trailing UNKNOWN row for the ids the
+    predictor maps to "Unknown".
+
+    Parameters:
+        words (list): The tokens of the vocabulary, in id order.
+        events (np.ndarray): (len(words) + 1,) array of EVENT_DTYPE.
+    """
+
+    VERSION = 1
+
+    def __init__(self, words, events):
+        self.words = list(words)
+        self.events = events
+        # Python tuples of the rows, much cheaper to index one by one than the structured array
+        self.rows = events.tolist()
+        self.word2id = {}
+        for idx, word in enumerate(self.words):
+            self.word2id.setdefault(word, idx)
+        self.unknown = len(self.words)
+        self.barline = events['kind'] == BARLINE
+
+    @classmethod
+    def from_words(cls, words):
+        events = np.array([parse_token(word) for word in words] + [_UNKNOWN_EVENT], dtype=EVENT_DTYPE)
+        return cls(words, events)
+
+    @classmethod
+    def from_vocabulary(cls, voc_file_path, cache=True):
+        """
+        Loads the table of a vocabulary file from its cache, or builds it and
+        writes the cache. The cache is optional: if it cannot be written (a
+        read-only folder), the table is simply built again next time.
+        """
+        with open(voc_file_path, 'rb') as f:
+            content = f.read()
+        words = content.decode('utf-8').splitlines()
+        digest = hashlib.sha1(content).hexdigest()
+        cache_path = voc_file_path + '.events.npz'
+
+        if cache and os.path.exists(cache_path):
+            try:
+                with np.load(cache_path) as cached:
+                    if int(cached['version']) == cls.VERSION and str(cached['digest']) == digest:
+                        return cls(words, cached['events'])
+            except Exception:
+                pass  # Unreadable cache, built again below
+
+        table = cls.from_words(words)
+        if cache:
+            try:
+                with open(cache_path, 'wb') as f:
+                    np.savez(f, version=cls.VERSION, digest=digest, events=table.events)
+            except OSError:
+                pass
+        return table
+
+    def __len__(self):
+        return len(self.rows)
+
+    def ids(self, tokens):
+        """ Token ids of a list of tokens, UNKNOWN for the tokens outside the vocabulary. """
+        return [self.word2id.get(token, self.unknown) for token in tokens]
+
+    def split_measures(self, ids):
+        """
+        Splits a sequence of token ids at the barlines.
+
+        Returns:
+            list: One array of token ids per measure; the last one is empty if ids ends with a barline.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        parts = np.split(ids, np.flatnonzero(self.barline[ids]))
+        # Every part but the first starts with its barline
+        return parts[:1] + [part[1:] for part in parts[1:]]
+
+
+_tables = {}
+
+
+def for_vocabulary(voc_file_path):
+    """ The EventTable of a vocabulary file, loaded once per process. """
+    key = os.path.abspath(voc_file_path)
+    if key not in _tables:
+        _tables[key] = EventTable.from_vocabulary(voc_file_path)
+    return _tables[key]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the token event table of a vocabulary and list the tokens it cannot parse.')
+    parser.add_argument('-vocabulary', dest='voc', type=str, default='Data/vocabulary_semantic.txt', help='Path to the vocabulary file.')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    table = EventTable.from_vocabulary(args.voc, cache=False)
+    built = time.perf_counter() - start
+    table = EventTable.from_vocabulary(args.voc)
+    start = time.perf_counter()
+    EventTable.from_vocabulary(args.voc)
+    loaded = time.perf_counter() - start
+
+    kinds = np.bincount(table.events['kind'][:-1], minlength=len(KIND_NAMES))
+    print(f'{len(table.words)} tokens: ' + ', '.join(f'{count} {name}' for name, count in zip(KIND_NAMES, kinds) if count))
+    print(f'Parsed in {1000 * built:.1f} ms, loaded from the cache in {1000 * loaded:.1f} ms')
+    unknown = [word for word, row in zip(table.words, table.rows) if row[0] == UNKNOWN]
+    if unknown:
+        print('Not understood: ' + ' '.join(unknown))
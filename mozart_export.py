@@ -0,0 +1,251 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# Names of the tensors of an exported graph, read by MusicScorePredictor.
+# TensorFlow is only imported inside the functions, so reading them is cheap.
+INPUT_NAME = 'model_input'
+SEQ_LENGTHS_NAME = 'seq_lengths'
+HEIGHT_NAME = 'input_height'
+WIDTH_REDUCTION_NAME = 'width_reduction'
+LOG_PROBS_NAME = 'log_probs'
+DECODED_NAMES = ('decoded_indices', 'decoded_values', 'decoded_shape')
+OUTPUT_NAMES = [HEIGHT_NAME, WIDTH_REDUCTION_NAME, LOG_PROBS_NAME] + list(DECODED_NAMES)
+
+
+def _add_decoding_outputs(logits, seq_lengths):
+    # logits are time-major (time, batch, vocabulary_size + 1)
+    import tensorflow as tf
+
+    log_probs = tf.nn.log_softmax(logits, name=LOG_PROBS_NAME)
+    decoded, _ = tf.nn.ctc_greedy_decoder(logits, seq_lengths)
+    return [log_probs] + [tf.identity(tensor, name=name) for tensor, name in
+                          zip((decoded[0].indices, decoded[0].values, decoded[0].dense_shape), DECODED_NAMES)]
+
+
+def _keep_prob_to_constant(graph_def):
+    # Inference always runs with keep_prob 1.0: turning the placeholder into a
+    # constant lets the dropout be folded away
+    import tensorflow as tf
+
+    for node in graph_def.node:
+        if node.name == 'keep_prob' and node.op == 'Placeholder':
+            dtype = node.attr['dtype']
+            node.op = 'Const'
+            node.ClearField('attr')
+            node.attr['dtype'].CopyFrom(dtype)
+            node.attr['value'].tensor.CopyFrom(tf.make_tensor_proto(1.0, dtype=tf.float32))
+    return graph_def
+
+
+def optimize_graph_def(graph_def):
+    """
+    Prepares a frozen GraphDef for inference: drops the training nodes,
+    folds the batch normalizations into the preceding convolutions and runs
+    Grappler's constant folding and arithmetic simplification.
+    """
+    import tensorflow as tf
+    from tensorflow.python.grappler import tf_optimizer
+    from tensorflow.python.tools import optimize_for_inference_lib
+    from tensorflow.core.protobuf import config_pb2, rewriter_config_pb2
+
+    input_names = [INPUT_NAME, SEQ_LENGTHS_NAME]
+    graph_def = tf.compat.v1.graph_util.remove_training_nodes(graph_def, protected_nodes=OUTPUT_NAMES + input_names)
+    graph_def = optimize_for_inference_lib.optimize_for_inference(
+        graph_def, input_names, OUTPUT_NAMES,
+        [tf.float32.as_datatype_enum, tf.int32.as_datatype_enum], toco_compatible=False)
+
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.graph_util.import_graph_def(graph_def, name='')
+        # Grappler must not prune the outputs away
+        fetch_collection = tf.compat.v1.GraphKeys.TRAIN_OP
+        for name in OUTPUT_NAMES:
+            graph.add_to_collection(fetch_collection, graph.get_operation_by_name(name))
+        meta_graph = tf.compat.v1.train.export_meta_graph(graph=graph)
+
+    config = config_pb2.ConfigProto()
+    rewriter = config.graph_options.rewrite_options
+    rewriter.optimizers.extend(['constfold', 'arithmetic', 'dependency', 'remap'])
+    rewriter.meta_optimizer_iterations = rewriter_config_pb2.RewriterConfig.ONE
+    return tf_optimizer.OptimizeGraph(config, meta_graph)
+
+
+def freeze_checkpoint(model_path):
+    """
+    Freezes a TF1 checkpoint (the .meta file and its variables) into an
+    optimized inference-only GraphDef.
+    """
+    import tensorflow as tf
+
+    graph = tf.Graph()
+    with graph.as_default(), tf.compat.v1.Session(graph=graph) as sess:
+        saver = tf.compat.v1.train.import_meta_graph(model_path, clear_devices=True)
+        saver.restore(sess, model_path[:-5])
+        logits = tf.compat.v1.get_collection("logits")[0]
+        _add_decoding_outputs(logits, graph.get_tensor_by_name(SEQ_LENGTHS_NAME + ':0'))
+
+        graph_def = tf.compat.v1.graph_util.convert_variables_to_constants(sess, graph.as_graph_def(), OUTPUT_NAMES)
+
+    return optimize_graph_def(_keep_prob_to_constant(graph_def))
+
+
+def load_graph_def(model_path):
+    """ Frozen GraphDef of a .pb written by this module, or of a checkpoint (.meta) frozen on the fly. """
+    import tensorflow as tf
+
+    if not model_path.endswith('.pb'):
+        return freeze_checkpoint(model_path)
+    graph_def = tf.compat.v1.GraphDef()
+    with open(model_path, 'rb') as f:
+        graph_def.ParseFromString(f.read())
+    return graph_def
+
+
+def export_checkpoint(model_path, output_path):
+    """
+    Freezes a TF1 checkpoint into a single inference-only GraphDef (.pb).
+
+    Parameters:
+        model_path (str): Path to the trained model (.meta file).
+        output_path (str): Path of the frozen graph.
+    """
+    _write_graph_def(freeze_checkpoint(model_path), output_path)
+
+
+def fold_batch_normalization(model):
+    """
+    The convolution blocks of a mozart_model.CTC_CNN_Model with every batch
+    normalization folded into the convolution before it.
+
+    Keras 3 traces BatchNormalization to Mul and AddV2 rather than to
+    FusedBatchNorm, which optimize_for_inference() does not fold, so the
+    moving statistics are folded here, before freezing: the kernel is
+    scaled by gamma / sqrt(variance + epsilon) and the bias becomes
+    (bias - mean) * gamma / sqrt(variance + epsilon) + beta.
+
+    Returns:
+        list: (kernel, bias, negative_slope, pool_size) of every block, the weights as NumPy arrays.
+    """
+    import numpy as np
+
+    layers = model.conv_layers
+    blocks = []
+    for conv, norm, activation, pooling in zip(layers[0::4], layers[1::4], layers[2::4], layers[3::4]):
+        kernel = conv.kernel.numpy()
+        bias = conv.bias.numpy() if conv.use_bias else np.zeros(kernel.shape[-1], dtype=kernel.dtype)
+        scale = 1 / np.sqrt(norm.moving_variance.numpy() + norm.epsilon)
+        if norm.scale:
+            scale = scale * norm.gamma.numpy()
+        bias = (bias - norm.moving_mean.numpy()) * scale
+        if norm.center:
+            bias = bias + norm.beta.numpy()
+        blocks.append((kernel * scale, bias, float(activation.negative_slope), tuple(pooling.pool_size)))
+    return blocks
+
+
+def folded_features(model):
+    """
+    The convolutional part of a mozart_model.CTC_CNN_Model in inference
+    mode, as a function of the input images built from the weights of
+    fold_batch_normalization(): Conv2D + BiasAdd, LeakyReLU and MaxPool per
+    block, then the columns flattened into frames as in model.features().
+    """
+    import tensorflow as tf
+
+    blocks = fold_batch_normalization(model)
+
+    def features(inputs):
+        x = inputs
+        for kernel, bias, negative_slope, pool_size in blocks:
+            x = tf.nn.bias_add(tf.nn.conv2d(x, kernel, 1, 'SAME'), bias)
+            x = tf.nn.leaky_relu(x, negative_slope)
+            x = tf.nn.max_pool2d(x, pool_size, pool_size, 'VALID')
+        return model.flatten(model.permute(x))
+
+    return features
+
+
+def export_keras_model(model, output_path, img_height, width_reduction):
+    """
+    Freezes a mozart_model.CTC_CNN_Model into the same inference-only
+    GraphDef format as export_checkpoint(), with the batch normalizations
+    folded into the convolutions (see fold_batch_normalization()).
+
+    The exported function has a fixed signature: a (batch, img_height,
+    width, 1) float32 image batch and the (batch,) int32 sequence lengths.
+    """
+    import tensorflow as tf
+    from tensorflow.python.framework import convert_to_constants
+
+    features = folded_features(model)
+
+    @tf.function(input_signature=[
+        tf.TensorSpec([None, img_height, None, 1], tf.float32, name=INPUT_NAME),
+        tf.TensorSpec([None], tf.int32, name=SEQ_LENGTHS_NAME),
+    ])
+    def inference(inputs, seq_lengths):
+        # Every output is returned so that none of them is pruned from the function graph
+        height = tf.constant(img_height, name=HEIGHT_NAME)
+        reduction = tf.constant(width_reduction, name=WIDTH_REDUCTION_NAME)
+        logits = model.sequence_logits(features(inputs), training=False)
+        logits = tf.transpose(logits, [1, 0, 2])  # Time-major, as the decoders expect
+        return [height, reduction] + _add_decoding_outputs(logits, seq_lengths)
+
+    frozen = convert_to_constants.convert_variables_to_constants_v2(inference.get_concrete_function())
+    graph_def = frozen.graph.as_graph_def()
+    _write_graph_def(optimize_graph_def(graph_def), output_path)
+
+
+def _write_graph_def(graph_def, output_path):
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    print(f'Wrote {output_path} ({len(graph_def.node)} nodes, {os.path.getsize(output_path) / 2**20:.1f} MiB)')
+
+
+_COLD_START = """
+import json, sys, time
+start = time.perf_counter()
+import numpy as np
+import mozart_predict
+import mozart_evaluate
+imported = time.perf_counter()
+predictor = mozart_predict.MusicScorePredictor(sys.argv[1], sys.argv[2])
+loaded = time.perf_counter()
+predictor.predict_preprocessed([np.zeros((int(predictor.HEIGHT), 256), dtype=np.float32)])
+first = time.perf_counter()
+print(json.dumps({'import_seconds': imported - start, 'load_seconds': loaded - imported,
+                  'first_prediction_seconds': first - loaded, 'peak_rss_mb': mozart_evaluate.peak_rss_mb()}))
+"""
+
+
+def measure_cold_start(model_path, voc_file_path):
+    """
+    Loads a model in a fresh Python process and measures the import time,
+    the time to load the model, the time of the first prediction (graph
+    warm-up included) and the peak memory.
+    """
+    result = subprocess.run([sys.executable, '-c', _COLD_START, model_path, voc_file_path],
+                            cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export a trained model to a frozen inference graph.')
+    parser.add_argument('-model', dest='model', type=str, required=True, help='Path to the trained model (.meta).')
+    parser.add_argument('-output', dest='output', type=str, required=True, help='Path of the frozen graph (.pb).')
+    parser.add_argument('-vocabulary', dest='voc', type=str, default=None,
+                        help='Vocabulary file; if given, the cold start of both models is measured.')
+    args = parser.parse_args()
+
+    export_checkpoint(args.model, args.output)
+
+    if args.voc:
+        for label, path in (('checkpoint', args.model), ('frozen', args.output)):
+            stats = measure_cold_start(path, args.voc)
+            print(f"{label:>10}: imports {stats['import_seconds']:.2f}s, load {stats['load_seconds']:.2f}s, "
+                  f"first prediction {stats['first_prediction_seconds']:.2f}s, peak RSS {stats['peak_rss_mb']:.0f} MiB")
@@ -1,13 +1,12 @@
-import tensorflow as tf
-
 def leaky_relu(features, alpha=0.2, name=None):
+    import tensorflow as tf
     return tf.maximum(alpha * features, features)
 
-def default_model_params(img_height, vocabulary_size):
+def default_model_params(img_height, vocabulary_size, batch_size=1):
     params = dict()
     params["img_height"] = img_height
     params["img_width"] = None
-    params["batch_size"] = 1  # Processing measures sequentially
+    params["batch_size"] = batch_size  # 1 processes measures sequentially
     params["img_channels"] = 1
     params["conv_blocks"] = 4
     params["conv_filter_n"] = [32, 64, 128, 256]
@@ -15,52 +14,131 @@ def default_model_params(img_height, vocabulary_size):
     params["conv_pooling_size"] = [[2, 2], [2, 2], [2, 2], [2, 2]]
     params["rnn_units"] = 512
     params["rnn_layers"] = 2
+    params["rnn_dropout"] = 0.5
+    params["rnn_stateful"] = False  # True carries the LSTM memory across calls, with a fixed batch_size
     params["vocabulary_size"] = vocabulary_size
     return params
 
-class CTC_CNN_Model(tf.keras.Model):
-    def __init__(self, params):
-        super(CTC_CNN_Model, self).__init__()
-        
-        self.conv_layers = []
-        for i in range(params["conv_blocks"]):
-            self.conv_layers.append(tf.keras.layers.Conv2D(
-                filters=params["conv_filter_n"][i],
-                kernel_size=params["conv_filter_size"][i],
-                padding="same",
-                activation=None
-            ))
-            self.conv_layers.append(tf.keras.layers.BatchNormalization())
-            self.conv_layers.append(tf.keras.layers.LeakyReLU(alpha=0.2))
-            self.conv_layers.append(tf.keras.layers.MaxPooling2D(pool_size=params["conv_pooling_size"][i]))
-
-        self.flatten = tf.keras.layers.Reshape((-1, params["conv_filter_n"][-1]))
+def _define_model_class():
+    import tensorflow as tf
+
+    class CTC_CNN_Model(tf.keras.Model):
+        def __init__(self, params):
+            super(CTC_CNN_Model, self).__init__()
         
-        # **Stateful RNN Layer**
-        self.rnn_layers = []
-        for _ in range(params["rnn_layers"]):
-            self.rnn_layers.append(tf.keras.layers.LSTM(
-                params["rnn_units"], 
-                return_sequences=True, 
-                stateful=True  # 👈 Keeps memory across measures!
-            ))
-
-        self.dense = tf.keras.layers.Dense(params["vocabulary_size"] + 1, activation=None)
-    
-    def call(self, inputs):
-        x = inputs
-        for layer in self.conv_layers:
-            x = layer(x)
+            self.conv_layers = []
+            for i in range(params["conv_blocks"]):
+                self.conv_layers.append(tf.keras.layers.Conv2D(
+                    filters=params["conv_filter_n"][i],
+                    kernel_size=params["conv_filter_size"][i],
+                    padding="same",
+                    activation=None
+                ))
+                self.conv_layers.append(tf.keras.layers.BatchNormalization())
+                self.conv_layers.append(tf.keras.layers.LeakyReLU(alpha=0.2))
+                self.conv_layers.append(tf.keras.layers.MaxPooling2D(pool_size=params["conv_pooling_size"][i]))
+
+            # Columns become time steps: (batch, height, width, filters) is
+            # transposed to (batch, width, height, filters) and every column
+            # flattened into one feature vector
+            height_reduction = 1
+            for pooling_size in params["conv_pooling_size"][:params["conv_blocks"]]:
+                height_reduction *= pooling_size[0]
+            self.permute = tf.keras.layers.Permute((2, 1, 3))
+            self.flatten = tf.keras.layers.Reshape(
+                (-1, (params["img_height"] // height_reduction) * params["conv_filter_n"][params["conv_blocks"] - 1]))
 
-        x = self.flatten(x)
+            # Stateful LSTMs keep their memory from one measure to the next
+            # (see reset_states()); training uses independent samples instead
+            self.rnn_layers = []
+            self.rnn_dropouts = []
+            for _ in range(params["rnn_layers"]):
+                self.rnn_layers.append(tf.keras.layers.LSTM(
+                    params["rnn_units"],
+                    return_sequences=True,
+                    stateful=params["rnn_stateful"]
+                ))
+                self.rnn_dropouts.append(tf.keras.layers.Dropout(params["rnn_dropout"]))
 
-        for rnn in self.rnn_layers:
-            x = rnn(x)  # Stateful LSTM processing
+            self.dense = tf.keras.layers.Dense(params["vocabulary_size"] + 1, activation=None)
 
-        logits = self.dense(x)
-        return logits
+            # Under Keras 3, tf.train.Checkpoint does not follow the layers of
+            # plain Python lists: every layer is also kept in a named
+            # attribute, so that checkpoints hold the whole model
+            for name, layers in (('conv_layer', self.conv_layers), ('rnn_layer', self.rnn_layers),
+                                 ('rnn_dropout', self.rnn_dropouts)):
+                for i, layer in enumerate(layers):
+                    setattr(self, f'{name}_{i}', layer)
+
+        def call(self, inputs, training=None):
+            """ (batch, img_height, width, channels) images to (batch, width / width_reduction, vocabulary_size + 1) logits. """
+            return self.sequence_logits(self.features(inputs, training=training), training=training)
+
+        def features(self, inputs, training=None):
+            """ Convolutional part: one feature vector per width_reduction columns, (batch, frames, features). """
+            x = inputs
+            for layer in self.conv_layers:
+                x = layer(x, training=training)
+            return self.flatten(self.permute(x))
+
+        def sequence_logits(self, features, training=None):
+            """ Recurrent part: the logits of every frame, (batch, frames, vocabulary_size + 1). """
+            x = features
+            for rnn, dropout in zip(self.rnn_layers, self.rnn_dropouts):
+                x = dropout(rnn(x), training=training)
+            return self.dense(x)
     
-    def reset_states(self):
-        """ Reset memory between different sheet music pieces. """
-        for rnn in self.rnn_layers:
-            rnn.reset_states()
+        def reset_states(self):
+            """ Reset memory between different sheet music pieces. """
+            for rnn in self.rnn_layers:
+                rnn.reset_states()
+
+    return CTC_CNN_Model
+
+
+def restore_weights(model, checkpoint_path, optimizer=None):
+    """
+    Restores a built CTC_CNN_Model, and optionally its optimizer, from a checkpoint written by mozart_training.py.
+
+    Every variable of the model (and of the optimizer, if given) has to be
+    in the checkpoint, so a checkpoint that misses layers fails here instead
+    of leaving them at their random initialization. The optimizer slots of
+    the checkpoint are ignored when no optimizer is given.
+
+    Parameters:
+        model (CTC_CNN_Model): Model already called once, so that its variables exist.
+        checkpoint_path (str): e.g. Models/semantic/model-64000.
+        optimizer (tf.keras.optimizers.Optimizer): Optimizer to restore too, already built.
+
+    Raises:
+        ValueError: If a variable of the model or of the optimizer is not in the checkpoint.
+    """
+    import tensorflow as tf
+
+    if not model.built:
+        raise ValueError("The model must be built before its weights are restored")
+    objects = {'model': model}
+    if optimizer is not None:
+        objects['optimizer'] = optimizer
+    status = tf.train.Checkpoint(**objects).restore(checkpoint_path)
+    try:
+        status.assert_existing_objects_matched()
+    except AssertionError:
+        # The assertion lists every unmatched variable with its value, far too long to be read
+        raise ValueError(f"{checkpoint_path} does not hold every variable of the model (checkpoints written "
+                         f"before all the layers were tracked only hold the dense layer)") from None
+    status.expect_partial()
+
+
+_model_class = None
+
+
+def __getattr__(name):
+    # CTC_CNN_Model subclasses tf.keras.Model: it is defined, and TensorFlow
+    # imported, on first use so that importing this module stays cheap
+    global _model_class
+    if name == 'CTC_CNN_Model':
+        if _model_class is None:
+            _model_class = _define_model_class()
+        return _model_class
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,196 @@
+import io
+import queue
+import threading
+import time
+
+import image_dissector
+import mozart_events
+import mozart_predict
+import mozart_profile
+import xmlencoder
+
+DEFAULT_MODEL_PATH = "Models/semantic_model.meta"
+DEFAULT_VOC_FILE_PATH = "Data/vocabulary_semantic.txt"
+
+_predictors = {}
+
+
+def get_predictor(model_path=DEFAULT_MODEL_PATH, voc_file_path=DEFAULT_VOC_FILE_PATH):
+    """Returns a MusicScorePredictor for the given model, restoring it only the first time."""
+    key = (model_path, voc_file_path)
+    if key not in _predictors:
+        _predictors[key] = mozart_predict.MusicScorePredictor(model_path, voc_file_path)
+    return _predictors[key]
+
+
+def iter_measures(notes):
+    """ Splits an iterable of tokens at the barlines, yielding every measure as soon as it is complete. """
+    current_measure = []
+
+    for item in notes:
+        if item == "barline":
+            yield current_measure
+            current_measure = []
+        else:
+            current_measure.append(item)
+
+    if current_measure:  # Add the last measure if not empty
+        yield current_measure
+
+
+def group_measures(notes):
+    return list(iter_measures(notes))
+
+
+class _Stage(threading.Thread):
+    # Runs one pipeline stage, keeping its busy time and any exception for the caller
+    def __init__(self, name, target):
+        super().__init__(name=name, daemon=True)
+        self.target = target
+        self.busy = 0.0
+        self.error = None
+
+    def run(self):
+        try:
+            self.target(self)
+        except BaseException as e:
+            self.error = e
+
+
+def _put(q, item, abort):
+    # Blocking put that gives up if another stage failed
+    while not abort.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def transcribe(page, predictor=None, batch_size=16, queue_size=4, margin_x=None, margin_y=None, timings=None,
+               output=None):
+    """
+    Transcribes a page of sheet music into a MusicXML document.
+
+    The work runs as three stages connected by bounded queues, so that
+    segmentation and preprocessing of the next measures and the encoding of
+    finished measures overlap with the network inference:
+
+        segmentation -> inference -> encoding
+
+    Parameters:
+        page (str, bytes or np.ndarray): Path to the image, encoded image bytes or a decoded image.
+        predictor (MusicScorePredictor): Warm predictor to use. Defaults to get_predictor().
+        batch_size (int): Number of measures sent to the network at once.
+        queue_size (int): Maximum number of batches waiting between two stages.
+        margin_x (int): Horizontal margin added around every measure, derived from the staff spacing if None.
+        margin_y (int): Vertical margin added around every staff, derived from the staff spacing if None.
+        timings (dict): If given, filled with the busy seconds of every stage and the total, plus
+            the mozart_profile report of the page under 'profile' when profiling is enabled.
+        output: Text stream the MusicXML is written to as the measures are
+            decoded. By default the document is returned as a string.
+
+    Returns:
+        str: The MusicXML document, or None when it was written to output.
+    """
+    if predictor is None:
+        predictor = get_predictor()
+
+    start = time.perf_counter()
+    profile_mark = mozart_profile.mark()
+    to_inference = queue.Queue(maxsize=queue_size)
+    to_encoding = queue.Queue(maxsize=queue_size)
+    abort = threading.Event()
+    stream = io.StringIO() if output is None else output
+
+    def segment(stage):
+        t = time.perf_counter()
+        gray_image = image_dissector.load_page(page)
+        if gray_image is None:
+            raise ValueError("Error: Could not load image.")
+        batch = []
+        for measure_image in image_dissector.page_measures(gray_image, margin_x, margin_y):
+            batch.append(predictor.preprocess(measure_image))
+            if len(batch) == batch_size:
+                stage.busy += time.perf_counter() - t
+                if not _put(to_inference, batch, abort):
+                    return
+                t = time.perf_counter()
+                batch = []
+
+        stage.busy += time.perf_counter() - t
+        if batch:
+            _put(to_inference, batch, abort)
+        _put(to_inference, None, abort)
+
+    def infer(stage):
+        while True:
+            batch = to_inference.get()
+            if batch is None:
+                break
+            t = time.perf_counter()
+            results = predictor.predict_preprocessed(batch, batch_size, ids=True)
+            stage.busy += time.perf_counter() - t
+            if not _put(to_encoding, results, abort):
+                return
+        _put(to_encoding, None, abort)
+
+    def encode(stage):
+        # The decoder output stays as token ids, turned into events by the
+        # precompiled table of the vocabulary rather than parsed as words
+        current_measure = []
+        t = time.perf_counter()
+        events = mozart_events.for_vocabulary(predictor.voc_file_path)
+        barline = events.barline.tolist()
+        writer = xmlencoder.MusicXMLWriter(stream)
+        stage.busy += time.perf_counter() - t
+        while True:
+            results = to_encoding.get()
+            if results is None:
+                break
+            t = time.perf_counter()
+            with mozart_profile.stage('xml/encode'):
+                for ids in results:
+                    for item in ids:
+                        if barline[item]:
+                            writer.write_measure_ids(current_measure, events)
+                            current_measure = []
+                        else:
+                            current_measure.append(item)
+            stage.busy += time.perf_counter() - t
+
+        t = time.perf_counter()
+        if current_measure:  # Add the last measure if not empty
+            writer.write_measure_ids(current_measure, events)
+        writer.close()
+        stage.busy += time.perf_counter() - t
+
+    stages = [_Stage("segmentation", segment), _Stage("inference", infer), _Stage("encoding", encode)]
+    for stage in stages:
+        stage.start()
+
+    # Wait for the stages, stopping the others as soon as one of them fails
+    for stage in stages:
+        while stage.is_alive():
+            stage.join(0.1)
+            if any(s.error for s in stages):
+                abort.set()
+                for q in (to_inference, to_encoding):
+                    try:
+                        q.put_nowait(None)
+                    except queue.Full:
+                        pass
+
+    for stage in stages:
+        if stage.error:
+            raise stage.error
+
+    if timings is not None:
+        for stage in stages:
+            timings[stage.name] = stage.busy
+        timings["total"] = time.perf_counter() - start
+        if mozart_profile.is_enabled():
+            timings["profile"] = mozart_profile.report(since=profile_mark)
+
+    return stream.getvalue() if output is None else None
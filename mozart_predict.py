@@ -1,12 +1,339 @@
-import tensorflow as tf
+import os
 import mozart_utils
+import mozart_profile
+import mozart_decoding
+import mozart_export
 import cv2
 import numpy as np
+from primus import CTC_PriMuS
+
+
+class MusicScorePredictor:
+    """
+    Keeps a trained model (CTC) loaded so that many images can be decoded
+    without restoring the graph for each one.
+
+    The graph, the vocabulary and the model constants (WIDTH_REDUCTION and
+    HEIGHT) are loaded once in the constructor; predict() then only runs
+    the preprocessing and the forward pass.
+
+    By default the network output is decoded greedily. With
+    decoder='beam' a CTC prefix beam search runs instead, optionally guided
+    by a token prior built with mozart_decoding.py from the training ground
+    truth; it is slower but can fix grammatically impossible outputs.
+
+    Parameters:
+        model_path (str): Path to the trained model (.meta file), to a
+            frozen graph (.pb) exported with mozart_export.py, or to an int8
+            model (.tflite) quantized with mozart_quantize.py.
+        voc_file_path (str): Path to the vocabulary file.
+        decoder (str): 'greedy' or 'beam'.
+        beam_width (int): Prefixes kept by the beam search.
+        prior (str or TokenPrior): Token prior (or the path of a saved one) for the beam search.
+        lm_weight (float): Weight of the prior in the beam search score.
+    """
+
+    def __init__(self, model_path, voc_file_path, decoder='greedy', beam_width=8, prior=None, lm_weight=0.5):
+        if decoder not in ('greedy', 'beam'):
+            raise ValueError(f"Unknown decoder {decoder}, expected 'greedy' or 'beam'")
+        self.decoder = decoder
+        self.beam_width = beam_width
+        self.prior = mozart_decoding.TokenPrior.load(prior) if isinstance(prior, str) else prior
+        self.lm_weight = lm_weight
+
+        # Load vocabulary
+        self.voc_file_path = voc_file_path
+        try:
+            with open(voc_file_path, 'r') as dict_file:
+                dict_list = dict_file.read().splitlines()
+                self.int2word = {idx: word for idx, word in enumerate(dict_list)}
+            # Array lookup for decoding: ids outside the vocabulary map to the trailing "Unknown"
+            self.words = np.asarray(dict_list + ["Unknown"], dtype=object)
+            print(f"Loaded vocabulary with {len(self.int2word)} entries.")
+        except Exception as e:
+            raise ValueError(f"Error loading vocabulary: {e}")
+
+        self.interpreter = None
+        if model_path.endswith('.tflite'):
+            self._load_tflite(model_path)
+            return
+
+        # TensorFlow is only imported once a model is loaded, so that importing
+        # this module (e.g. from the pipeline or the CLIs) stays fast
+        import tensorflow as tf
+
+        # Each predictor owns its graph and session so that several of them
+        # can live in the same process.
+        self.graph = tf.Graph()
+        self.sess = tf.compat.v1.Session(graph=self.graph)
+
+        with self.graph.as_default():
+            if model_path.endswith('.pb'):
+                self._load_frozen_graph(model_path)
+            else:
+                self._restore_checkpoint(model_path)
+
+            # Retrieve constants from the model
+            self.WIDTH_REDUCTION, self.HEIGHT = self.sess.run([self._width_reduction_tensor, self._height_tensor])
+            print(f"Width reduction: {self.WIDTH_REDUCTION}, Height: {self.HEIGHT}")
+
+        self.graph.finalize()
+
+    def _restore_checkpoint(self, model_path):
+        import tensorflow as tf
+
+        # Restore model
+        try:
+            with mozart_profile.stage('model restore'):
+                saver = tf.compat.v1.train.import_meta_graph(model_path)
+                saver.restore(self.sess, model_path[:-5])  # Load corresponding checkpoint
+            print("Model restored successfully.")
+        except Exception as e:
+            self.sess.close()
+            raise ValueError(f"Error restoring model: {e}")
+
+        # Access model tensors
+        try:
+            self.input = self.graph.get_tensor_by_name("model_input:0")
+            self.seq_len = self.graph.get_tensor_by_name("seq_lengths:0")
+            self.rnn_keep_prob = self.graph.get_tensor_by_name("keep_prob:0")
+            self._height_tensor = self.graph.get_tensor_by_name("input_height:0")
+            self._width_reduction_tensor = self.graph.get_tensor_by_name("width_reduction:0")
+            logits = tf.compat.v1.get_collection("logits")[0]
+
+            # Define the decoding operation
+            self.decoded, _ = tf.nn.ctc_greedy_decoder(logits, self.seq_len)
+            self.log_probs = tf.nn.log_softmax(logits)  # Time-major, for the beam search
+            print("Decoding operation defined.")
+        except Exception as e:
+            self.sess.close()
+            raise ValueError(f"Error accessing model tensors: {e}")
+
+    def _load_frozen_graph(self, model_path):
+        import tensorflow as tf
+
+        # Inference graph written by mozart_export.py: no variables to restore,
+        # no dropout input, and the decoding outputs are already in the graph
+        try:
+            with mozart_profile.stage('model restore'):
+                tf.graph_util.import_graph_def(mozart_export.load_graph_def(model_path), name='')
+            print("Frozen model loaded successfully.")
+
+            tensor = lambda name: self.graph.get_tensor_by_name(name + ':0')
+            self.input = tensor(mozart_export.INPUT_NAME)
+            self.seq_len = tensor(mozart_export.SEQ_LENGTHS_NAME)
+            self.rnn_keep_prob = None
+            self._height_tensor = tensor(mozart_export.HEIGHT_NAME)
+            self._width_reduction_tensor = tensor(mozart_export.WIDTH_REDUCTION_NAME)
+            self.log_probs = tensor(mozart_export.LOG_PROBS_NAME)
+            self.decoded = [tf.sparse.SparseTensor(*(tensor(name) for name in mozart_export.DECODED_NAMES))]
+        except Exception as e:
+            self.sess.close()
+            raise ValueError(f"Error loading frozen model: {e}")
+
+    def _load_tflite(self, model_path):
+        import tensorflow as tf
+
+        # Quantized model written by mozart_quantize.py: it outputs the
+        # log-probabilities and the CTC decoding runs in NumPy
+        try:
+            with mozart_profile.stage('model restore'):
+                self.interpreter = tf.lite.Interpreter(model_path=model_path, num_threads=os.cpu_count())
+                self._tflite_runner = self.interpreter.get_signature_runner()
+            self.graph = self.sess = None
+            height = int(self.interpreter.get_input_details()[0]['shape_signature'][1])
+            outputs = self._tflite_runner(**{mozart_export.INPUT_NAME: np.zeros((1, height, 64, 1), dtype=np.float32)})
+            self.HEIGHT = outputs[mozart_export.HEIGHT_NAME]
+            self.WIDTH_REDUCTION = outputs[mozart_export.WIDTH_REDUCTION_NAME]
+            print(f"Quantized model loaded successfully. Width reduction: {self.WIDTH_REDUCTION}, Height: {self.HEIGHT}")
+        except Exception as e:
+            raise ValueError(f"Error loading quantized model: {e}")
+
+    def preprocess(self, image):
+        """
+        Loads (if needed), resizes and normalizes an image for the model.
+
+        Parameters:
+            image (str or np.ndarray): Path to the image or the image itself.
+
+        Returns:
+            np.ndarray: Normalized image of shape (HEIGHT, width).
+        """
+        if isinstance(image, str):
+            image_path = image
+            with mozart_profile.stage('imread'):
+                image = cv2.imread(image_path, 0)  # Grayscale image
+            if image is None:
+                raise ValueError(f"Image could not be loaded. Check the path: {image_path}")
+        elif image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+        with mozart_profile.stage('preprocess'):
+            image = mozart_utils.resize(image, int(self.HEIGHT))
+            return mozart_utils.normalize(image).astype(np.float32)
+
+    def predict(self, image):
+        """
+        Decodes a single music score image.
+
+        Parameters:
+            image (str or np.ndarray): Path to the image or the image itself.
+
+        Returns:
+            list: Decoded text from the image as a list of words.
+        """
+        return self.predict_batch([image])[0]
+
+    def predict_batch(self, images):
+        """
+        Decodes several music score images in a single forward pass.
+
+        The images are padded to the widest one with PAD_COLUMN, as in
+        CTC_PriMuS.nextBatch, but every sample keeps its own sequence length
+        so the padding is ignored by the decoder.
+
+        Parameters:
+            images (list): Paths to the images or the images themselves.
+
+        Returns:
+            list: One list of words per image, in the same order.
+        """
+        try:
+            images = [self.preprocess(image) for image in images]
+        except Exception as e:
+            raise ValueError(f"Error preprocessing image: {e}")
+
+        return self._decode_batch(images)
+
+    def _decode_batch(self, images, ids=False):
+        # images are already preprocessed; with ids, the token ids are returned instead of the words
+        if self.interpreter is None:
+            with mozart_profile.stage('pad batch'):
+                batch_images = mozart_utils.pad_images(images, CTC_PriMuS.PAD_COLUMN)
+
+        # Calculate sequence lengths
+        seq_lengths = [int(img.shape[1] / self.WIDTH_REDUCTION) for img in images]
+
+        feed_dict = None
+        if self.interpreter is None:
+            feed_dict = {
+                self.input: batch_images,
+                self.seq_len: seq_lengths,
+            }
+            if self.rnn_keep_prob is not None:
+                feed_dict[self.rnn_keep_prob] = 1.0
+
+        # Predict
+        try:
+            unknown = len(self.words) - 1
+            if self.interpreter is not None or self.decoder == 'beam':
+                # Decoding in NumPy from the log-probabilities
+                if self.interpreter is not None:
+                    with mozart_profile.stage('tflite invoke'):
+                        log_probs = self._tflite_log_probs(images)
+                else:
+                    with mozart_profile.stage('sess.run'):
+                        log_probs = self.sess.run(self.log_probs, feed_dict=feed_dict)
+                self._count_batch(len(images))
+                with mozart_profile.stage('beam search' if self.decoder == 'beam' else 'greedy decode'):
+                    predictions = self._decode_log_probs(log_probs, seq_lengths)
+                predictions = [np.minimum(np.asarray(pred, dtype=np.int64), unknown) for pred in predictions]
+                return [(pred if ids else self.words[pred]).tolist() for pred in predictions]
+
+            with mozart_profile.stage('sess.run'):
+                prediction = self.sess.run(self.decoded, feed_dict=feed_dict)
+            self._count_batch(len(images))
+            with mozart_profile.stage('sparse_tensor_to_strs'):
+                indices, values, dense_shape = prediction[0]
+                values = np.where((values >= 0) & (values < unknown), values, unknown)
+                words = values if ids else self.words[values]
+                return [pred.tolist() for pred in mozart_utils.sparse_to_ragged(indices, words, int(dense_shape[0]))]
+        except Exception as e:
+            raise ValueError(f"Error during prediction: {e}")
+
+    def _tflite_log_probs(self, images):
+        # One image per invocation: the fused LSTMs of a quantized model have
+        # a batch size of 1, and no padding is computed. The outputs are
+        # stacked into a time-major batch; the decoders ignore the frames
+        # past the sequence length of every image.
+        outputs = [self._tflite_runner(**{mozart_export.INPUT_NAME: image[np.newaxis, :, :, np.newaxis]})
+                   [mozart_export.LOG_PROBS_NAME][:, 0] for image in images]
+        log_probs = np.zeros((max(len(output) for output in outputs), len(outputs), outputs[0].shape[1]),
+                             dtype=np.float32)
+        for b, output in enumerate(outputs):
+            log_probs[:len(output), b] = output
+        return log_probs
+
+    def _decode_log_probs(self, log_probs, seq_lengths):
+        if self.decoder == 'beam':
+            return mozart_decoding.beam_search_batch(log_probs, seq_lengths, beam_width=self.beam_width,
+                                                     prior=self.prior, lm_weight=self.lm_weight)
+        return mozart_decoding.greedy_decode_batch(log_probs, seq_lengths)
+
+    @staticmethod
+    def _count_batch(num_images):
+        mozart_profile.count('staves', num_images)
+        mozart_profile.count('batches')
+
+    def predict_many(self, images, batch_size=16, width_tolerance=0.25):
+        """
+        Decodes several music score images with the already loaded model.
+
+        Images are grouped by width into buckets of at most batch_size
+        images, and each bucket is decoded in one forward pass. A bucket only
+        takes images up to (1 + width_tolerance) times the width of its
+        narrowest image, which keeps the padding small.
+
+        Parameters:
+            images (list): Paths to the images or the images themselves.
+            batch_size (int): Maximum number of images per forward pass.
+            width_tolerance (float): Allowed relative width spread in a bucket.
+
+        Returns:
+            list: One list of words per image, in the same order.
+        """
+        try:
+            images = [self.preprocess(image) for image in images]
+        except Exception as e:
+            raise ValueError(f"Error preprocessing image: {e}")
+
+        return self.predict_preprocessed(images, batch_size, width_tolerance)
+
+    def predict_preprocessed(self, images, batch_size=16, width_tolerance=0.25, ids=False):
+        """
+        Same as predict_many() for images that already went through preprocess().
+
+        This lets callers run the preprocessing in another thread or process.
+        With ids, every image gets a list of token ids (line numbers in the
+        vocabulary, len(vocabulary) for unknown ids) instead of words, to be
+        encoded with the EventTable of the vocabulary (mozart_events).
+        """
+        results = [None] * len(images)
+        for bucket in mozart_utils.width_buckets([img.shape[1] for img in images], batch_size, width_tolerance):
+            predictions = self._decode_batch([images[i] for i in bucket], ids)
+            for i, prediction in zip(bucket, predictions):
+                results[i] = prediction
+
+        return results
+
+    def close(self):
+        if self.sess is not None:
+            self.sess.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
 
 def decode_music_score(image_path, model_path, voc_file_path):
     """
     Decodes a music score image using a trained model (CTC).
 
+    This restores the model for a single image; use MusicScorePredictor
+    when decoding more than one image.
+
     Parameters:
         image_path (str): Path to the input image.
         model_path (str): Path to the trained model.
@@ -15,82 +342,12 @@ def decode_music_score(image_path, model_path, voc_file_path):
     Returns:
         list: Decoded text from the image as a list of words.
     """
-    # Check TensorFlow compatibility
-    tf.compat.v1.reset_default_graph()
-    sess = tf.compat.v1.InteractiveSession()
-    tf.compat.v1.disable_eager_execution()
-
-    # Load vocabulary
-    try:
-        with open(voc_file_path, 'r') as dict_file:
-            dict_list = dict_file.read().splitlines()
-            int2word = {idx: word for idx, word in enumerate(dict_list)}
-        print(f"Loaded vocabulary with {len(int2word)} entries.")
-    except Exception as e:
-        raise ValueError(f"Error loading vocabulary: {e}")
-
-    # Restore model
-    try:
-        saver = tf.compat.v1.train.import_meta_graph(model_path)
-        saver.restore(sess, model_path[:-5])  # Load corresponding checkpoint
-        print("Model restored successfully.")
-    except Exception as e:
-        raise ValueError(f"Error restoring model: {e}")
-
-    # Access model tensors
-    try:
-        graph = tf.compat.v1.get_default_graph()
-        input = graph.get_tensor_by_name("model_input:0")
-        seq_len = graph.get_tensor_by_name("seq_lengths:0")
-        rnn_keep_prob = graph.get_tensor_by_name("keep_prob:0")
-        height_tensor = graph.get_tensor_by_name("input_height:0")
-        width_reduction_tensor = graph.get_tensor_by_name("width_reduction:0")
-        logits = tf.compat.v1.get_collection("logits")[0]
-
-        # Retrieve constants from the model
-        WIDTH_REDUCTION, HEIGHT = sess.run([width_reduction_tensor, height_tensor])
-        print(f"Width reduction: {WIDTH_REDUCTION}, Height: {HEIGHT}")
-
-        # Define the decoding operation
-        decoded, _ = tf.nn.ctc_greedy_decoder(logits, seq_len)
-        print("Decoding operation defined.")
-    except Exception as e:
-        raise ValueError(f"Error accessing model tensors: {e}")
-
-    # Preprocess image
-    try:
-        image = cv2.imread(image_path, 0)  # Grayscale image
-        if image is None:
-            raise ValueError("Image could not be loaded. Check the path.")
-        image = mozart_utils.resize(image, HEIGHT)
-        image = mozart_utils.normalize(image)
-        image = np.asarray(image).reshape(1, image.shape[0], image.shape[1], 1)
-        print(f"Image preprocessed. Shape: {image.shape}")
-    except Exception as e:
-        raise ValueError(f"Error preprocessing image: {e}")
-
-    # Calculate sequence lengths
-    seq_lengths = [image.shape[2] / WIDTH_REDUCTION]
-    if not seq_lengths[0].is_integer():
-        print("Warning: Sequence length is not an integer. Adjusting...")
-    seq_lengths = [int(seq_lengths[0])]
-
-    # Predict
-    try:
-        prediction = sess.run(decoded,
-                              feed_dict={
-                                  input: image,
-                                  seq_len: seq_lengths,
-                                  rnn_keep_prob: 1.0,
-                              })
-        str_predictions = mozart_utils.sparse_tensor_to_strs(prediction)
-        result = [int2word.get(w, "Unknown") for w in str_predictions[0]]
-        return result
-    except Exception as e:
-        raise ValueError(f"Error during prediction: {e}")
-    finally:
-        sess.close()
+    with MusicScorePredictor(model_path, voc_file_path) as predictor:
+        return predictor.predict(image_path)
 
 # Example usage
 # result = decode_music_score("path/to/image.png", "path/to/model.meta", "path/to/vocabulary.txt")
 # print(result)
+#
+# with MusicScorePredictor("path/to/model.meta", "path/to/vocabulary.txt") as predictor:
+#     results = predictor.predict_many(["path/to/staff_1.png", "path/to/staff_2.png"])
@@ -0,0 +1,156 @@
+"""
+Lightweight timers and counters for the transcription pipeline.
+
+    import mozart_profile
+
+    mozart_profile.enable()
+    with mozart_profile.stage('sess.run'):
+        ...
+    mozart_profile.count('staves', 16)
+    mozart_profile.print_report()
+    mozart_profile.export_chrome_trace('trace.json')  # Open in chrome://tracing or ui.perfetto.dev
+
+While disabled (the default) stage() returns a shared no-op context
+manager and count() returns immediately, so the hooks can stay in hot code.
+"""
+import json
+import os
+import threading
+import time
+
+_enabled = False
+_events = []  # (name, start, duration, pid, tid), times in seconds
+_counts = []  # (name, n), summed by report()
+_lock = threading.Lock()
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.perf_counter()
+        # list.append is atomic, no lock needed
+        _events.append((self.name, self.start, end - self.start, os.getpid(), threading.get_ident()))
+        return False
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    with _lock:
+        del _events[:]
+        del _counts[:]
+
+
+def stage(name):
+    """ Context manager timing the code it wraps under name. """
+    if not _enabled:
+        return _NULL_STAGE
+    return _Stage(name)
+
+
+def count(name, n=1):
+    """ Adds n to the counter name. """
+    if not _enabled:
+        return
+    _counts.append((name, n))
+
+
+def mark():
+    """ Position in the logs, to report only what happens after it. """
+    return len(_events), len(_counts)
+
+
+def drain():
+    """ Removes and returns the recorded events and counters, e.g. to send them from a worker process. """
+    with _lock:
+        events = list(_events)
+        counts = list(_counts)
+        del _events[:]
+        del _counts[:]
+    return events, counts
+
+
+def merge(events, counts):
+    """ Adds events and counts recorded elsewhere (see drain()). """
+    with _lock:
+        _events.extend(events)
+        _counts.extend(counts)
+
+
+def report(since=(0, 0)):
+    """
+    Aggregates the events and counts recorded after the mark since.
+
+    Returns:
+        dict: {'stages': {name: {'count', 'total', 'mean', 'max'}}, 'counters': {name: n}}
+        with times in seconds.
+    """
+    stages = {}
+    for name, _, duration, _, _ in _events[since[0]:]:
+        entry = stages.get(name)
+        if entry is None:
+            stages[name] = entry = {'count': 0, 'total': 0.0, 'max': 0.0}
+        entry['count'] += 1
+        entry['total'] += duration
+        entry['max'] = max(entry['max'], duration)
+    for entry in stages.values():
+        entry['mean'] = entry['total'] / entry['count']
+    counters = {}
+    for name, n in _counts[since[1]:]:
+        counters[name] = counters.get(name, 0) + n
+    return {'stages': stages, 'counters': counters}
+
+
+def print_report(since=(0, 0), title='Profile'):
+    result = report(since)
+    print(f'{title}:')
+    for name, entry in sorted(result['stages'].items(), key=lambda item: -item[1]['total']):
+        print(f"  {name:<32} {entry['total'] * 1000:10.1f} ms  x{entry['count']:<6} "
+              f"mean {entry['mean'] * 1000:8.2f} ms  max {entry['max'] * 1000:8.2f} ms")
+    for name, n in sorted(result['counters'].items()):
+        print(f'  {name:<32} {n}')
+
+
+def export_chrome_trace(path, since=(0, 0)):
+    """ Writes the events as Chrome trace event JSON (complete events, microseconds). """
+    trace_events = [{
+        'name': name,
+        'ph': 'X',
+        'ts': start * 1e6,
+        'dur': duration * 1e6,
+        'pid': pid,
+        'tid': tid,
+    } for name, start, duration, pid, tid in _events[since[0]:]]
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, f)
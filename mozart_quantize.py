@@ -0,0 +1,235 @@
+import argparse
+import random
+
+import cv2
+import numpy as np
+
+import mozart_export
+import mozart_utils
+
+
+def calibration_images(corpus_dirpath, corpus_filepath, img_height, num_samples=200, seed=0, packed_path=None):
+    """
+    Yields num_samples randomly chosen training staves, preprocessed as for
+    inference, one (1, img_height, width, 1) batch at a time.
+
+    Parameters:
+        corpus_dirpath (str): Path to the PrIMuS corpus.
+        corpus_filepath (str): Set file to draw the samples from (e.g. Data/train.txt).
+        img_height (int): Input height of the model.
+        num_samples (int): Number of calibration samples.
+        seed (int): Seed of the sample choice, for reproducible models.
+        packed_path (str): Read the images from a corpus packed with primus_pack.py instead.
+    """
+    with open(corpus_filepath, 'r') as f:
+        names = f.read().splitlines()
+    names = random.Random(seed).sample(names, min(num_samples, len(names)))
+
+    packed = None
+    if packed_path is not None:
+        import primus_pack
+        packed = primus_pack.PackedCorpus(packed_path)
+
+    for name in names:
+        if packed is not None and name in packed:
+            image = packed.image(packed.name2idx[name])
+        else:
+            image = cv2.imread(corpus_dirpath + '/' + name + '/' + name + '.png', cv2.IMREAD_GRAYSCALE)
+            if image is None:
+                continue
+        image = mozart_utils.normalize(mozart_utils.resize(image, img_height)).astype(np.float32)
+        yield image[np.newaxis, :, :, np.newaxis]
+
+
+def _inference_function(graph_def):
+    # The float model from the input image to the log-probabilities, plus the
+    # model constants, as a TF2 function the TFLite converter accepts. The CTC
+    # decoding has no TFLite kernel and runs in NumPy (mozart_decoding).
+    import tensorflow as tf
+
+    def import_graph():
+        tf.graph_util.import_graph_def(graph_def, name='')
+
+    wrapped = tf.compat.v1.wrap_function(import_graph, [])
+    outputs = wrapped.prune(
+        feeds=[mozart_export.INPUT_NAME + ':0'],
+        fetches={name: name + ':0' for name in (mozart_export.LOG_PROBS_NAME, mozart_export.HEIGHT_NAME,
+                                                mozart_export.WIDTH_REDUCTION_NAME)})
+
+    input_shape = outputs.inputs[0].shape
+
+    @tf.function(input_signature=[tf.TensorSpec([None, input_shape[1], None, 1], tf.float32,
+                                                name=mozart_export.INPUT_NAME)])
+    def inference(inputs):
+        return outputs(inputs)
+
+    # The module keeps the function alive and gives the TFLite model a signature with named outputs
+    module = tf.Module()
+    module.inference = inference
+    return inference.get_concrete_function(), module
+
+
+def _fusable_lstm():
+    # The recurrence of a Keras LSTM layer as a function with the arguments,
+    # outputs and attributes of the Keras 2 standard_lstm(): the TFLite
+    # converter recognizes the "lstm_*" api_implements attribute and
+    # replaces the whole function by its UNIDIRECTIONAL_SEQUENCE_LSTM
+    # kernel. The body only runs in TensorFlow. Keras 3 layers carry no
+    # such attribute, and their while loop over a TensorList has no
+    # builtin TFLite equivalent.
+    import uuid
+
+    import tensorflow as tf
+
+    @tf.function(autograph=False, experimental_attributes={
+        'api_implements': 'lstm_' + str(uuid.uuid4()), 'time_major': False, 'go_backwards': False})
+    def lstm(inputs, init_h, init_c, kernel, recurrent_kernel, bias):
+        def step(state, x):
+            h, c = state
+            z = tf.matmul(x, kernel) + tf.matmul(h, recurrent_kernel) + bias
+            i, f, g, o = tf.split(z, 4, axis=1)  # Keras gate order
+            c = tf.sigmoid(f) * c + tf.sigmoid(i) * tf.tanh(g)
+            return tf.sigmoid(o) * tf.tanh(c), c
+
+        hs, cs = tf.scan(step, tf.transpose(inputs, [1, 0, 2]), initializer=(init_h, init_c))
+        # last_output, outputs, state_h, state_c, runtime
+        return hs[-1], tf.transpose(hs, [1, 0, 2]), hs[-1], cs[-1], tf.constant(0.0)
+
+    return lstm
+
+
+def _keras_inference_function(model, img_height, width_reduction):
+    # Same outputs as _inference_function(), computed from a
+    # mozart_model.CTC_CNN_Model: batch normalizations folded into the
+    # convolutions, and every LSTM layer turned into a fused TFLite LSTM.
+    # The fused kernel needs a static batch size, so the model takes one
+    # image at a time (MusicScorePredictor runs .tflite models per image).
+    import tensorflow as tf
+
+    # The weights are captured as constants: the converter goes through a
+    # SavedModel to keep the LSTM functions, and would leave variables as
+    # variables there
+    features = mozart_export.folded_features(model)
+    lstms = [(_fusable_lstm(), rnn.cell.units, rnn.cell.kernel.numpy(), rnn.cell.recurrent_kernel.numpy(),
+              rnn.cell.bias.numpy()) for rnn in model.rnn_layers]
+    dense_kernel, dense_bias = model.dense.kernel.numpy(), model.dense.bias.numpy()
+
+    @tf.function(input_signature=[tf.TensorSpec([1, img_height, None, 1], tf.float32, name=mozart_export.INPUT_NAME)])
+    def inference(inputs):
+        x = features(inputs)
+        for lstm, units, kernel, recurrent_kernel, bias in lstms:
+            state = tf.zeros([1, units])
+            x = lstm(x, state, state, tf.constant(kernel), tf.constant(recurrent_kernel), tf.constant(bias))[1]
+        logits = tf.transpose(tf.matmul(x, dense_kernel) + dense_bias, [1, 0, 2])  # Time-major, as the decoders expect
+        return {mozart_export.LOG_PROBS_NAME: tf.nn.log_softmax(logits),
+                mozart_export.HEIGHT_NAME: tf.constant(img_height),
+                mozart_export.WIDTH_REDUCTION_NAME: tf.constant(width_reduction)}
+
+    module = tf.Module()
+    module.inference = inference
+    return inference.get_concrete_function(), module
+
+
+def restore_keras_model(model_path, voc_file_path, img_height=128):
+    """
+    Restores a mozart_model.CTC_CNN_Model from a checkpoint written by mozart_training.py.
+
+    Returns:
+        tuple: (model, width_reduction)
+
+    Raises:
+        ValueError: If the checkpoint does not hold every variable of the model.
+    """
+    import mozart_model
+
+    with open(voc_file_path, 'r') as dict_file:
+        vocabulary_size = len(dict.fromkeys(dict_file.read().splitlines()))
+    params = mozart_model.default_model_params(img_height, vocabulary_size)
+    width_reduction = 1
+    for pooling_size in params["conv_pooling_size"][:params["conv_blocks"]]:
+        width_reduction *= pooling_size[1]
+
+    model = mozart_model.CTC_CNN_Model(params)
+    model(np.zeros((1, img_height, width_reduction, 1), dtype=np.float32), training=False)
+    mozart_model.restore_weights(model, model_path)
+    return model, width_reduction
+
+
+def quantize(model_path, output_path, mode='dynamic', calibration=None, voc_file_path=None, img_height=128):
+    """
+    Converts a trained model to an int8 quantized TFLite model.
+
+    Only builtin TFLite operations are allowed, so a model the interpreter
+    could not run fails here rather than when it is loaded. The models
+    trained by mozart_training.py are converted from their checkpoint, whose
+    LSTMs become fused TFLite LSTMs; a frozen graph of them cannot be
+    converted, its LSTMs are loops over TensorLists.
+
+    Parameters:
+        model_path (str): Checkpoint written by mozart_training.py (e.g.
+            Models/semantic/model-64000), or a TF1 model (.meta) or frozen graph (.pb).
+        output_path (str): Path of the .tflite model.
+        mode (str): 'dynamic' stores the weights as int8 and quantizes the
+            activations on the fly; 'static' also quantizes the activations
+            with ranges measured on the calibration images.
+        calibration (iterable): Input batches for 'static' (see calibration_images()).
+        voc_file_path (str): Vocabulary of the model, needed for a mozart_training.py checkpoint.
+        img_height (int): Input height of a mozart_training.py checkpoint.
+    """
+    import tensorflow as tf
+
+    if model_path.endswith(('.meta', '.pb')):
+        concrete_function, module = _inference_function(mozart_export.load_graph_def(model_path))
+    else:
+        if voc_file_path is None:
+            raise ValueError("Quantizing a training checkpoint needs its vocabulary")
+        model, width_reduction = restore_keras_model(model_path, voc_file_path, img_height)
+        concrete_function, module = _keras_inference_function(model, img_height, width_reduction)
+
+    converter = tf.lite.TFLiteConverter.from_concrete_functions([concrete_function], module)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if mode == 'static':
+        if calibration is None:
+            raise ValueError("Static quantization needs calibration images")
+        converter.representative_dataset = lambda: ([batch] for batch in calibration)
+        # Ops without an int8 kernel stay in float
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8, tf.lite.OpsSet.TFLITE_BUILTINS]
+    elif mode == 'dynamic':
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS]
+    else:
+        raise ValueError(f"Unknown quantization mode {mode}, expected 'dynamic' or 'static'")
+
+    try:
+        tflite_model = converter.convert()
+    except Exception as e:
+        raise ValueError(f"{model_path} could not be converted to builtin TFLite operations (a frozen graph with "
+                         f"LSTMs cannot be; quantize its training checkpoint instead): {e}") from e
+    with open(output_path, 'wb') as f:
+        f.write(tflite_model)
+    print(f'Wrote {output_path} ({len(tflite_model) / 2**20:.1f} MiB, {mode} int8)')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Quantize a trained model to int8 for CPU inference.')
+    parser.add_argument('-model', dest='model', type=str, required=True,
+                        help='Checkpoint written by mozart_training.py, or TF1 model (.meta) or frozen graph (.pb).')
+    parser.add_argument('-vocabulary', dest='voc', type=str, default=None,
+                        help='Vocabulary file, needed to quantize a mozart_training.py checkpoint.')
+    parser.add_argument('-output', dest='output', type=str, required=True, help='Path of the quantized model (.tflite).')
+    parser.add_argument('-mode', dest='mode', type=str, default='dynamic', choices=['dynamic', 'static'])
+    parser.add_argument('-corpus', dest='corpus', type=str, default=None, help='Path to the corpus (static mode).')
+    parser.add_argument('-set', dest='set', type=str, default='Data/train.txt', help='Samples to calibrate on.')
+    parser.add_argument('-packed', dest='packed', type=str, default=None, help='Corpus packed with primus_pack.py.')
+    parser.add_argument('-calibration_samples', dest='calibration_samples', type=int, default=200)
+    parser.add_argument('-img_height', dest='img_height', type=int, default=128)
+    args = parser.parse_args()
+
+    if not args.model.endswith(('.meta', '.pb')) and args.voc is None:
+        parser.error('quantizing a mozart_training.py checkpoint needs -vocabulary')
+    calibration = None
+    if args.mode == 'static':
+        if args.corpus is None and args.packed is None:
+            parser.error('-mode static needs -corpus or -packed for the calibration samples')
+        calibration = calibration_images(args.corpus, args.set, args.img_height, args.calibration_samples,
+                                         packed_path=args.packed)
+    quantize(args.model, args.output, args.mode, calibration, args.voc, args.img_height)
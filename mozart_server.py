@@ -0,0 +1,296 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+import image_dissector
+import mozart_pipeline
+import xmlencoder
+
+MAX_BODY_SIZE = 64 * 2**20
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class MicroBatcher:
+    """
+    Collects the staves of concurrent requests into batches for a pool of
+    warm predictors.
+
+    Every predictor has a worker that waits for the first pending staff and
+    then keeps collecting until it has batch_size staves or the first one
+    has waited max_latency seconds, whichever comes first. The forward pass
+    runs in a thread dedicated to that predictor, so the event loop keeps
+    accepting requests meanwhile.
+
+    Parameters:
+        predictors (list): Warm MusicScorePredictor instances.
+        batch_size (int): Maximum number of staves per forward pass.
+        max_latency (float): Maximum seconds a staff waits for its batch to fill.
+    """
+
+    def __init__(self, predictors, batch_size=16, max_latency=0.02):
+        self.predictors = predictors
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.queue = asyncio.Queue()
+        self.workers = []
+        # Metrics
+        self.batches = 0
+        self.staves = 0
+        self.batch_sizes = {}
+        self.inference_seconds = 0.0
+        self.queue_wait_seconds = 0.0
+
+    def start(self):
+        for predictor in self.predictors:
+            executor = ThreadPoolExecutor(max_workers=1)
+            self.workers.append(asyncio.ensure_future(self._work(predictor, executor)))
+
+    async def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+
+    async def predict(self, images):
+        """ Decodes preprocessed staves, returning one list of words per image. """
+        loop = asyncio.get_running_loop()
+        futures = []
+        for image in images:
+            future = loop.create_future()
+            self.queue.put_nowait((image, future, time.perf_counter()))
+            futures.append(future)
+        return await asyncio.gather(*futures)
+
+    async def _work(self, predictor, executor):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = batch[0][2] + self.max_latency
+            while len(batch) < self.batch_size:
+                # Staves already waiting are always taken, even past the deadline
+                if not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                    continue
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            start = time.perf_counter()
+            images = [image for image, _, _ in batch]
+            try:
+                results = await loop.run_in_executor(executor, predictor.predict_preprocessed, images, self.batch_size)
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            self.inference_seconds += time.perf_counter() - start
+            self.queue_wait_seconds += sum(start - queued for _, _, queued in batch)
+            self.batches += 1
+            self.staves += len(batch)
+            self.batch_sizes[len(batch)] = self.batch_sizes.get(len(batch), 0) + 1
+            for (_, future, _), result in zip(batch, results):
+                if not future.done():  # The request may have been cancelled
+                    future.set_result(result)
+
+    def metrics(self):
+        return {
+            'queue_depth': self.queue.qsize(),
+            'predictors': len(self.predictors),
+            'batches': self.batches,
+            'staves': self.staves,
+            'mean_batch_size': self.staves / self.batches if self.batches else 0.0,
+            'batch_sizes': {str(size): n for size, n in sorted(self.batch_sizes.items())},
+            'inference_seconds': self.inference_seconds,
+            'mean_queue_wait_ms': 1000 * self.queue_wait_seconds / self.staves if self.staves else 0.0,
+        }
+
+
+class TranscriptionServer:
+    """
+    HTTP front end of the MicroBatcher.
+
+        POST /transcribe[?format=musicxml|tokens]   body: an encoded page image
+        GET  /metrics                               queue depth, batch sizes, request counts
+        GET  /health
+
+    Decoding and segmentation of the uploaded pages run in a thread pool
+    (OpenCV releases the GIL), only the forward passes go through the batcher.
+    """
+
+    def __init__(self, batcher, segmentation_threads=4, margin_x=None, margin_y=None):
+        self.batcher = batcher
+        self.executor = ThreadPoolExecutor(max_workers=segmentation_threads)
+        self.margin_x = margin_x
+        self.margin_y = margin_y
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.request_seconds = 0.0
+
+    def _segment(self, body):
+        gray_image = image_dissector.load_page(body)
+        if gray_image is None:
+            raise HTTPError(400, 'Could not decode the image')
+        predictor = self.batcher.predictors[0]
+        return [predictor.preprocess(measure_image)
+                for measure_image in image_dissector.page_measures(gray_image, self.margin_x, self.margin_y)]
+
+    async def transcribe(self, body, output_format):
+        loop = asyncio.get_running_loop()
+        images = await loop.run_in_executor(self.executor, self._segment, body)
+        results = await self.batcher.predict(images)
+
+        notes = [token for tokens in results for token in tokens]
+        measures = mozart_pipeline.group_measures(notes)
+        if output_format == 'tokens':
+            return 'application/json', json.dumps({'tokens': notes, 'measures': measures}).encode('utf-8')
+        musicxml = await loop.run_in_executor(self.executor, xmlencoder.create_musicxml, measures)
+        return 'application/vnd.recordare.musicxml+xml', musicxml.encode('utf-8')
+
+    def metrics(self):
+        metrics = self.batcher.metrics()
+        metrics.update({
+            'requests': self.requests,
+            'errors': self.errors,
+            'in_flight': self.in_flight,
+            'mean_request_ms': 1000 * self.request_seconds / self.requests if self.requests else 0.0,
+        })
+        return metrics
+
+    async def _route(self, method, target, body):
+        url = urlsplit(target)
+        if url.path == '/transcribe':
+            if method != 'POST':
+                raise HTTPError(405, 'Use POST with the image as the body')
+            output_format = parse_qs(url.query).get('format', ['musicxml'])[0]
+            if output_format not in ('musicxml', 'tokens'):
+                raise HTTPError(400, f'Unknown format {output_format}')
+            if not body:
+                raise HTTPError(400, 'Empty body')
+            return await self.transcribe(body, output_format)
+        if url.path == '/metrics' and method == 'GET':
+            return 'application/json', json.dumps(self.metrics()).encode('utf-8')
+        if url.path == '/health' and method == 'GET':
+            return 'text/plain', b'ok'
+        raise HTTPError(404, f'No route for {method} {url.path}')
+
+    async def _read_request(self, reader):
+        """
+        Reads the request line, the headers and the body.
+
+        Returns:
+            tuple: (method, target, body), or None if the client closed the connection without a request.
+
+        Raises:
+            HTTPError: If the request is malformed (400) or its body too large (413).
+        """
+        try:
+            request_line = await reader.readline()
+            if not request_line:
+                return None
+            method, target, _ = request_line.decode('latin-1').split(' ', 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            length = int(headers.get('content-length', 0))
+            if length > MAX_BODY_SIZE:
+                raise HTTPError(413, f'Images are limited to {MAX_BODY_SIZE // 2**20} MiB')
+            body = await reader.readexactly(length) if length else b''
+        except (ValueError, asyncio.IncompleteReadError) as e:
+            raise HTTPError(400, f'Bad request: {e}') from e
+        return method.upper(), target, body
+
+    async def handle(self, reader, writer):
+        start = time.perf_counter()
+        self.in_flight += 1
+        try:
+            try:
+                request = await self._read_request(reader)
+                if request is None:
+                    return
+                content_type, payload = await self._route(*request)
+                status = 200
+            except HTTPError as e:
+                status, content_type, payload = e.status, 'text/plain', str(e).encode('utf-8')
+            # Anything else failed on the server side, the predictors included:
+            # they report every failure as a ValueError
+            except Exception as e:
+                status, content_type, payload = 500, 'text/plain', f'Error: {e}'.encode('utf-8')
+
+            if status != 200:
+                self.errors += 1
+            writer.write(f'HTTP/1.1 {status} {REASONS[status]}\r\n'
+                         f'Content-Type: {content_type}\r\n'
+                         f'Content-Length: {len(payload)}\r\n'
+                         f'Connection: close\r\n\r\n'.encode('latin-1') + payload)
+            await writer.drain()
+        finally:
+            self.in_flight -= 1
+            self.requests += 1
+            self.request_seconds += time.perf_counter() - start
+            writer.close()
+
+
+async def serve(args):
+    import mozart_predict
+
+    predictors = [mozart_predict.MusicScorePredictor(args.model, args.voc) for _ in range(args.predictors)]
+    batcher = MicroBatcher(predictors, args.batch_size, args.max_latency_ms / 1000)
+    batcher.start()
+    server = TranscriptionServer(batcher, args.segmentation_threads, args.margin_x, args.margin_y)
+
+    http_server = await asyncio.start_server(server.handle, args.host, args.port)
+    print(f'Serving on http://{args.host}:{args.port} with {args.predictors} predictor(s)')
+    try:
+        async with http_server:
+            await http_server.serve_forever()
+    finally:
+        await batcher.stop()
+        for predictor in predictors:
+            predictor.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve sheet music transcription over HTTP.')
+    parser.add_argument('-model', dest='model', type=str, required=True, help='Path to the trained model.')
+    parser.add_argument('-vocabulary', dest='voc', type=str, required=True, help='Path to the vocabulary file.')
+    parser.add_argument('-host', dest='host', type=str, default='127.0.0.1')
+    parser.add_argument('-port', dest='port', type=int, default=8000)
+    parser.add_argument('-predictors', dest='predictors', type=int, default=1, help='Warm model instances.')
+    parser.add_argument('-batch_size', dest='batch_size', type=int, default=16, help='Maximum staves per forward pass.')
+    parser.add_argument('-max_latency_ms', dest='max_latency_ms', type=float, default=20,
+                        help='Maximum time a staff waits for its batch to fill.')
+    parser.add_argument('-segmentation_threads', dest='segmentation_threads', type=int, default=os.cpu_count())
+    parser.add_argument('-margin_x', dest='margin_x', type=int, default=None, help='Default: derived from the staff spacing.')
+    parser.add_argument('-margin_y', dest='margin_y', type=int, default=None, help='Default: derived from the staff spacing.')
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
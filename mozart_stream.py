@@ -0,0 +1,170 @@
+import argparse
+
+import cv2
+import numpy as np
+
+import mozart_decoding
+import mozart_model
+import mozart_utils
+
+
+def column_windows(pieces, window, context, height):
+    """
+    Cuts a staff, given as consecutive pieces of columns, into overlapping windows.
+
+    Every window has a core of window columns, widened by up to context
+    columns on each side so that the convolutions see the same neighbours
+    for the core as in the full image. Only the columns that the next
+    windows still need are kept, so the memory used does not depend on the
+    width of the staff.
+
+    Parameters:
+        pieces (iterable): (height, columns) arrays, the staff from left to right.
+        window (int): Columns in the core of a window.
+        context (int): Columns added on each side of the core.
+        height (int): Height of the pieces.
+
+    Yields:
+        tuple: (image, first, last), the window and the columns [first, last) of its core in it.
+    """
+    pending = np.zeros((height, 0), dtype=np.float32)
+    pending_start = 0  # Staff column of pending[:, 0]
+    core_start = 0
+    for piece in pieces:
+        pending = np.concatenate([pending, piece], axis=1)
+        while pending_start + pending.shape[1] >= core_start + window + context:
+            offset = max(core_start - context, 0) - pending_start
+            yield (pending[:, offset:core_start + window + context - pending_start],
+                   core_start - pending_start - offset, core_start + window - pending_start - offset)
+            core_start += window
+            drop = core_start - context - pending_start
+            if drop > 0:
+                pending = pending[:, drop:]
+                pending_start += drop
+
+    end = pending_start + pending.shape[1]
+    if core_start < end:
+        offset = max(core_start - context, 0) - pending_start
+        yield pending[:, offset:], core_start - pending_start - offset, end - pending_start - offset
+
+
+class StreamingTranscriber:
+    """
+    Decodes staves of any width (a panorama, or a staff continued over
+    several pages) with a constant amount of memory.
+
+    The staff is cut into windows by column_windows(); the convolutions run
+    on one window at a time, and the stateful LSTMs of CTC_CNN_Model carry
+    their state from a window to the next one, so the frames of the cores
+    get the same logits as a full-width pass. A GreedyStreamDecoder merges
+    the CTC outputs at the seams.
+
+    Parameters:
+        model_path (str): Checkpoint written by mozart_training.py (e.g. Models/semantic/model-64000).
+        voc_file_path (str): Path to the vocabulary file.
+        window (int): Columns decoded per step, rounded to a multiple of the width reduction.
+        context (int): Columns added on each side of a window, at least the
+            receptive field of the convolutions; also rounded to the width reduction.
+        img_height (int): Input height of the model.
+    """
+
+    def __init__(self, model_path, voc_file_path, window=1024, context=64, img_height=128):
+        with open(voc_file_path, 'r') as dict_file:
+            dict_list = list(dict.fromkeys(dict_file.read().splitlines()))
+        self.words = np.asarray(dict_list + ["Unknown"], dtype=object)
+
+        params = mozart_model.default_model_params(img_height, len(dict_list), batch_size=1)
+        self.HEIGHT = img_height
+        self.WIDTH_REDUCTION = 1
+        for pooling_size in params["conv_pooling_size"][:params["conv_blocks"]]:
+            self.WIDTH_REDUCTION *= pooling_size[1]
+        self.window = max(window // self.WIDTH_REDUCTION, 1) * self.WIDTH_REDUCTION
+        self.context = -(-context // self.WIDTH_REDUCTION) * self.WIDTH_REDUCTION
+
+        # Training checkpoints have no LSTM states, which would fail the check
+        # of restore_weights(): the weights are restored into a model that is
+        # not stateful, then copied into the stateful one
+        dummy = np.zeros((1, img_height, self.WIDTH_REDUCTION, 1), dtype=np.float32)
+        trained = mozart_model.CTC_CNN_Model(params)
+        trained(dummy, training=False)
+        mozart_model.restore_weights(trained, model_path)
+        self.model = mozart_model.CTC_CNN_Model(dict(params, rnn_stateful=True))
+        self.model(dummy, training=False)
+        self.model.set_weights(trained.get_weights())
+        self.model.reset_states()
+        self.decoder = mozart_decoding.GreedyStreamDecoder()
+
+    def preprocess(self, image):
+        """ Grayscale image (or its path) resized to the model height and normalized, as float32. """
+        if isinstance(image, str):
+            image_path = image
+            image = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+            if image is None:
+                raise ValueError(f"Image could not be loaded. Check the path: {image_path}")
+        elif image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        return mozart_utils.normalize(mozart_utils.resize(image, self.HEIGHT)).astype(np.float32)
+
+    def stream(self, pieces):
+        """
+        Decodes one staff, yielding its words as soon as their window is done.
+
+        Parameters:
+            pieces (iterable): Preprocessed (HEIGHT, columns) pieces of the staff, from left to right.
+        """
+        import tensorflow as tf
+
+        self.model.reset_states()
+        self.decoder.reset()
+        for image, first, last in column_windows(pieces, self.window, self.context, self.HEIGHT):
+            features = self.model.features(image[np.newaxis, :, :, np.newaxis], training=False)
+            features = features[:, first // self.WIDTH_REDUCTION:last // self.WIDTH_REDUCTION]
+            if features.shape[1] == 0:
+                continue
+            log_probs = tf.nn.log_softmax(self.model.sequence_logits(features, training=False))
+            yield from self.words[self.decoder.decode(log_probs[0].numpy())]
+
+    def predict(self, images):
+        """
+        Decodes a staff given as one image, or as a list of images to be read
+        side by side (e.g. the pieces of a staff split over several pages).
+
+        Returns:
+            list: The predicted words.
+        """
+        if not isinstance(images, (list, tuple)):
+            images = [images]
+        return list(self.stream(self.preprocess(image) for image in images))
+
+    def predict_full_width(self, images):
+        """ Decodes the whole staff in one pass, as a reference for predict(). """
+        if not isinstance(images, (list, tuple)):
+            images = [images]
+        image = np.concatenate([self.preprocess(image) for image in images], axis=1)
+        self.model.reset_states()
+        self.decoder.reset()
+        logits = self.model(image[np.newaxis, :, :, np.newaxis], training=False)[0].numpy()
+        return list(self.words[self.decoder.decode(logits)])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Decode very wide staves window by window, in constant memory.')
+    parser.add_argument('images', nargs='+', help='Pieces of one staff, read side by side from left to right.')
+    parser.add_argument('-model', dest='model', type=str, required=True, help='Checkpoint written by mozart_training.py.')
+    parser.add_argument('-vocabulary', dest='voc', type=str, required=True, help='Path to the vocabulary file.')
+    parser.add_argument('-window', dest='window', type=int, default=1024, help='Columns decoded per step.')
+    parser.add_argument('-context', dest='context', type=int, default=64, help='Columns of overlap on each side of a window.')
+    parser.add_argument('-compare', dest='compare', action="store_true", default=False,
+                        help='Also decode the staff in one pass and check that both outputs match.')
+    args = parser.parse_args()
+
+    import mozart_evaluate
+
+    transcriber = StreamingTranscriber(args.model, args.voc, args.window, args.context)
+    words = transcriber.predict(args.images)
+    print(' '.join(words))
+    print(f'Peak RSS after streaming: {mozart_evaluate.peak_rss_mb():.0f} MiB')
+    if args.compare:
+        full = transcriber.predict_full_width(args.images)
+        print(f'Full-width pass: {"same output" if full == words else "DIFFERENT output: " + " ".join(full)}, '
+              f'peak RSS {mozart_evaluate.peak_rss_mb():.0f} MiB')
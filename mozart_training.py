@@ -1,83 +1,211 @@
-import tensorflow as tf
 from primus import CTC_PriMuS
+import mozart_augment
+import mozart_decoding
 import mozart_utils
 import mozart_model
 import argparse
 import os
-
-# Check GPU availability and configure memory growth
-gpus = tf.config.experimental.list_physical_devices('GPU')
-if gpus:
-    for gpu in gpus:
-        tf.config.experimental.set_memory_growth(gpu, True)
-
-parser = argparse.ArgumentParser(description='Train model.')
-parser.add_argument('-corpus', dest='corpus', type=str, required=True, help='Path to the corpus.')
-parser.add_argument('-set', dest='set', type=str, required=True, help='Path to the set file.')
-parser.add_argument('-save_model', dest='save_model', type=str, required=True, help='Path to save the model.')
-parser.add_argument('-vocabulary', dest='voc', type=str, required=True, help='Path to the vocabulary file.')
-parser.add_argument('-semantic', dest='semantic', action="store_true", default=False)
-args = parser.parse_args()
-
-# Load primus
-primus = CTC_PriMuS(args.corpus, args.set, args.voc, args.semantic, val_split=0.1)
-
-# Parameterization
-img_height = 128
-params = mozart_model.default_model_params(img_height, primus.vocabulary_size)
-max_epochs = 64000
-dropout_rate = 0.5
-
-# Model
-inputs, seq_len, targets, decoded, loss, rnn_keep_prob = mozart_model.ctc_crnn(params)
-optimizer = tf.keras.optimizers.Adam()
-
-# Checkpoint to save and load the model
-checkpoint_dir = os.path.dirname(args.save_model)
-checkpoint = tf.train.Checkpoint(optimizer=optimizer, model=decoded)
-
-@tf.function
-def train_step(batch_inputs, batch_seq_len, batch_targets, dropout_rate):
-    with tf.GradientTape() as tape:
-        predictions, loss_value = decoded(batch_inputs, training=True)
-        loss_value = tf.reduce_mean(loss_value)
-    gradients = tape.gradient(loss_value, decoded.trainable_variables)
-    optimizer.apply_gradients(zip(gradients, decoded.trainable_variables))
-    return loss_value
-
-# Training loop
-for epoch in range(max_epochs):
-    batch = primus.nextBatch(params)
-    loss_value = train_step(batch['inputs'], batch['seq_lengths'], batch['targets'], dropout_rate)
-
-    if epoch % 1000 == 0:
-        # Validation
-        print(f'Loss value at epoch {epoch}: {loss_value}')
-        print('Validating...')
-
-        validation_batch, validation_size = primus.getValidation(params)
-
-        val_idx = 0
-        val_ed = 0
-        val_len = 0
-        val_count = 0
-
-        while val_idx < validation_size:
-            mini_batch_inputs = validation_batch['inputs'][val_idx:val_idx + params['batch_size']]
-            mini_batch_seq_len = validation_batch['seq_lengths'][val_idx:val_idx + params['batch_size']]
-
-            prediction = decoded(mini_batch_inputs, training=False)
-            str_predictions = ctc_utils.sparse_tensor_to_strs(prediction)
-
-            for i, pred in enumerate(str_predictions):
-                ed = ctc_utils.edit_distance(pred, validation_batch['targets'][val_idx + i])
-                val_ed += ed
-                val_len += len(validation_batch['targets'][val_idx + i])
-                val_count += 1
-
-            val_idx += params['batch_size']
-
-        print(f'[Epoch {epoch}] {1. * val_ed / val_count} ({100. * val_ed / val_len} SER) from {val_count} samples.')
-        print('Saving the model...')
-        checkpoint.save(file_prefix=os.path.join(checkpoint_dir, 'ckpt'))
-        print('------------------------------')
+import time
+
+import numpy as np
+
+LABEL_STEP = 16  # Label batches are padded to a multiple of this length
+
+
+def pad_training_batch(batch, batch_size=None):
+    """
+    Turns a primus batch into the dense arrays of train_step.
+
+    The labels are padded with 0 to a multiple of LABEL_STEP tokens. With
+    batch_size, the batch is padded with empty samples up to that size; they
+    have a weight of 0 in the loss.
+
+    Returns:
+        tuple: (inputs, seq_lengths, labels, label_lengths, weights)
+    """
+    inputs = batch['inputs']
+    num_samples = inputs.shape[0]
+    batch_size = max(batch_size or num_samples, num_samples)
+
+    label_lengths = np.zeros(batch_size, dtype=np.int32)
+    label_lengths[:num_samples] = [len(target) for target in batch['targets']]
+    labels = np.zeros((batch_size, -(-max(int(label_lengths.max()), 1) // LABEL_STEP) * LABEL_STEP), dtype=np.int32)
+    for i, target in enumerate(batch['targets']):
+        labels[i, :len(target)] = target
+
+    # Padding samples get one frame so that their loss stays finite
+    seq_lengths = np.ones(batch_size, dtype=np.int32)
+    seq_lengths[:num_samples] = batch['seq_lengths']
+    weights = np.zeros(batch_size, dtype=np.float32)
+    weights[:num_samples] = 1
+    if batch_size > num_samples:
+        inputs = np.concatenate([inputs, np.full((batch_size - num_samples,) + inputs.shape[1:], CTC_PriMuS.PAD_COLUMN,
+                                                 dtype=inputs.dtype)])
+    return inputs, seq_lengths, labels, label_lengths, weights
+
+
+def make_train_step(model, optimizer, params, jit_compile=True):
+    """
+    Builds the training step: CTC loss, gradients and the optimizer update as one function.
+
+    The input signature is fixed, so the function is traced once. With
+    jit_compile, XLA still compiles it once per distinct input shape, which
+    is why the batch widths, label lengths and batch sizes are quantized.
+    """
+    import tensorflow as tf
+
+    @tf.function(jit_compile=jit_compile, input_signature=[
+        tf.TensorSpec([None, params['img_height'], None, params['img_channels']], tf.float32),
+        tf.TensorSpec([None], tf.int32),
+        tf.TensorSpec([None, None], tf.int32),
+        tf.TensorSpec([None], tf.int32),
+        tf.TensorSpec([None], tf.float32),
+    ])
+    def train_step(inputs, seq_lengths, labels, label_lengths, weights):
+        with tf.GradientTape() as tape:
+            logits = model(inputs, training=True)
+            loss = tf.nn.ctc_loss(labels, logits, label_lengths, seq_lengths, logits_time_major=False, blank_index=-1)
+            loss = tf.reduce_sum(loss * weights) / tf.reduce_sum(weights)
+        gradients = tape.gradient(loss, model.trainable_variables)
+        optimizer.apply_gradients(zip(gradients, model.trainable_variables))
+        return loss
+
+    return train_step
+
+
+def validate(model, primus, params, max_bytes):
+    """ Greedy decoding of the validation set; returns (mean edit distance, SER, number of samples). """
+    import tensorflow as tf
+
+    predictions = []
+    targets = []
+    for batch in primus.validationBatches(params, max_bytes=max_bytes):
+        logits = model(batch['inputs'], training=False)
+        log_probs = tf.transpose(tf.nn.log_softmax(logits), [1, 0, 2]).numpy()
+        predictions.extend(mozart_decoding.greedy_decode_batch(log_probs, batch['seq_lengths']))
+        targets.extend(batch['targets'])
+
+    metrics = mozart_utils.symbol_error_rate(predictions, targets)
+    return metrics['edit_distance'] / len(targets), metrics['ser'], len(targets)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Train model.')
+    parser.add_argument('-corpus', dest='corpus', type=str, required=True, help='Path to the corpus.')
+    parser.add_argument('-set', dest='set', type=str, required=True, help='Path to the set file.')
+    parser.add_argument('-save_model', dest='save_model', type=str, required=True, help='Path to save the model.')
+    parser.add_argument('-vocabulary', dest='voc', type=str, required=True, help='Path to the vocabulary file.')
+    parser.add_argument('-semantic', dest='semantic', action="store_true", default=False)
+    parser.add_argument('-packed', dest='packed', type=str, default=None, help='Corpus packed with primus_pack.py.')
+    parser.add_argument('-validation_mb', dest='validation_mb', type=int, default=256, help='Maximum size of a validation batch in MiB.')
+    parser.add_argument('-augment', dest='augment', action="store_true", default=False,
+                        help='Distort the training samples on the fly (blur, perspective, noise, contrast, elastic).')
+    parser.add_argument('-seed', dest='seed', type=int, default=None, help='Seed of the sample order and of the distortions.')
+    parser.add_argument('-max_pixels', dest='max_pixels', type=int, default=None, help='Bucket batches by width, capping their padded size.')
+    parser.add_argument('-batch_size', dest='batch_size', type=int, default=16, help='Samples per batch without -max_pixels.')
+    parser.add_argument('-steps', dest='steps', type=int, default=64000, help='Number of training steps.')
+    parser.add_argument('-learning_rate', dest='learning_rate', type=float, default=1e-3)
+    parser.add_argument('-width_growth', dest='width_growth', type=float, default=1.25,
+                        help='Ratio between consecutive batch widths; batches are padded to the next one.')
+    parser.add_argument('-log_every', dest='log_every', type=int, default=100, help='Steps between two progress lines.')
+    parser.add_argument('-validate_every', dest='validate_every', type=int, default=1000, help='Steps between two validations.')
+    parser.add_argument('-jit', dest='jit', type=str, default='auto', choices=['auto', 'on', 'off'],
+                        help='Compile the training step with XLA; auto only does on GPU, where it pays off.')
+    parser.add_argument('-export', dest='export', type=str, default=None,
+                        help='Also export the model to a frozen graph (.pb) at every validation.')
+    args = parser.parse_args()
+
+    # Imported after the arguments are parsed so that -h answers immediately
+    import tensorflow as tf
+
+    # Check GPU availability and configure memory growth
+    gpus = tf.config.experimental.list_physical_devices('GPU')
+    if gpus:
+        for gpu in gpus:
+            tf.config.experimental.set_memory_growth(gpu, True)
+
+    # Load primus
+    augmenter = mozart_augment.Augmenter() if args.augment else None
+    primus = CTC_PriMuS(args.corpus, args.set, args.voc, args.semantic, val_split=0.1, packed_path=args.packed,
+                        augmenter=augmenter)
+
+    # Parameterization
+    img_height = 128
+    params = mozart_model.default_model_params(img_height, primus.vocabulary_size, args.batch_size)
+    width_reduction = primus.widthReduction(params)
+
+    # Batches are padded to one of a few widths (and, with -max_pixels, a
+    # power of two samples) so that XLA compiles only a few shapes
+    width_sizes = mozart_utils.quantized_sizes(16 * width_reduction, 4096, args.width_growth, 4 * width_reduction)
+
+    # Model
+    model = mozart_model.CTC_CNN_Model(params)
+    optimizer = tf.keras.optimizers.Adam(args.learning_rate)
+    jit_compile = args.jit == 'on' or (args.jit == 'auto' and bool(gpus))
+    train_step = make_train_step(model, optimizer, params, jit_compile)
+
+    # Checkpoint to save and load the model
+    checkpoint_dir = os.path.dirname(os.path.abspath(args.save_model))
+    checkpoint = tf.train.Checkpoint(optimizer=optimizer, model=model)
+    manager = tf.train.CheckpointManager(checkpoint, checkpoint_dir, max_to_keep=5,
+                                         checkpoint_name=os.path.basename(args.save_model))
+    if manager.latest_checkpoint:
+        # The variables must exist for the restore to check that all of them were found
+        model(np.zeros((1, img_height, width_reduction, 1), dtype=np.float32), training=False)
+        optimizer.build(model.trainable_variables)
+        mozart_model.restore_weights(model, manager.latest_checkpoint, optimizer)
+        print(f'Restored {manager.latest_checkpoint}')
+    first_step = int(optimizer.iterations) + 1
+
+    # Training loop
+    batches = primus.batchGenerator(params, seed=args.seed, max_pixels=args.max_pixels, width_sizes=width_sizes)
+    shapes = set()
+    compile_time = 0.0
+    step_time = 0.0
+    timed_steps = 0
+    samples = 0
+    losses = []
+    for step in range(first_step, args.steps + 1):
+        batch = next(batches)
+        num_samples = batch['inputs'].shape[0]
+        batch_size = 1 << (num_samples - 1).bit_length() if args.max_pixels else args.batch_size
+        inputs, seq_lengths, labels, label_lengths, weights = pad_training_batch(batch, batch_size)
+        shape = (inputs.shape, labels.shape)
+
+        start = time.perf_counter()
+        loss = float(train_step(inputs, seq_lengths, labels, label_lengths, weights))  # float() waits for the step
+        elapsed = time.perf_counter() - start
+        losses.append(loss)
+        if shape in shapes:
+            step_time += elapsed
+            timed_steps += 1
+            samples += num_samples
+        else:
+            # The first step of a shape is dominated by its compilation
+            shapes.add(shape)
+            compile_time += elapsed
+
+        if step % args.log_every == 0:
+            throughput = f'{1000 * step_time / timed_steps:.0f} ms/step, {samples / step_time:.1f} samples/s, ' if timed_steps else ''
+            print(f'Step {step}: loss {np.mean(losses):.3f}, {throughput}{len(shapes)} batch shapes '
+                  f'({compile_time:.1f}s in their first step), {primus.input_wait_time:.1f}s waiting on input, '
+                  f'{100 * primus.padding_ratio:.1f}% padding')
+            step_time = 0.0
+            timed_steps = 0
+            samples = 0
+            losses = []
+
+        if step % args.validate_every == 0 or step == args.steps:
+            print('Validating...')
+            edit_distance, ser, val_count = validate(model, primus, params, args.validation_mb * 2**20)
+            print(f'[Step {step}] {edit_distance} ({100. * ser} SER) from {val_count} samples.')
+            print('Saving the model...')
+            print(f'Saved {manager.save(checkpoint_number=step)}')
+            if args.export:
+                import mozart_export
+                mozart_export.export_keras_model(model, args.export, img_height, width_reduction)
+            print('------------------------------')
+
+
+if __name__ == '__main__':
+    main()
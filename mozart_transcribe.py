@@ -0,0 +1,236 @@
+import argparse
+import json
+import multiprocessing
+import os
+import time
+
+import cv2
+
+import image_dissector
+import mozart_profile
+import mozart_utils
+import xmlencoder
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.tif', '.tiff', '.bmp')
+
+
+def collect_scores(inputs):
+    """
+    Turns the command line inputs into scores.
+
+    A directory is one score whose pages are the images inside it, in name
+    order. An image given directly is a one-page score. The score name
+    (directory name or image name without extension) names the output file
+    and the progress of the score, so it has to be unique.
+
+    Returns:
+        list: (score_name, [page_paths]) tuples.
+
+    Raises:
+        ValueError: If two inputs give the same score name (a/scan/ and b/scan/, x.png and x.jpg).
+    """
+    scores = []
+    sources = {}
+    for path in inputs:
+        if os.path.isdir(path):
+            pages = sorted(os.path.join(path, f) for f in os.listdir(path)
+                           if f.lower().endswith(IMAGE_EXTENSIONS))
+            if not pages:
+                print(f"Warning: No images found in {path}.")
+                continue
+            score_name = os.path.basename(os.path.normpath(path))
+        elif path.lower().endswith(IMAGE_EXTENSIONS):
+            pages = [path]
+            score_name = os.path.splitext(os.path.basename(path))[0]
+        else:
+            print(f"Warning: Skipping {path}, only images and directories of images are supported.")
+            continue
+        sources.setdefault(score_name, []).append(path)
+        scores.append((score_name, pages))
+
+    duplicates = [f"{' and '.join(paths)} would be written to the same {name}.musicxml"
+                  for name, paths in sources.items() if len(paths) > 1]
+    if duplicates:
+        raise ValueError('; '.join(duplicates))
+    return scores
+
+
+def _init_worker(profile=False):
+    # One OpenCV thread per process, the pool already uses every core
+    cv2.setNumThreads(1)
+    if profile:
+        mozart_profile.enable()
+
+
+def segment_page(task):
+    """
+    Pool worker: decodes one page and returns its measures resized to the model height.
+
+    The crops are returned as uint8 so that sending them back to the
+    inference process stays cheap. The profile events recorded for the page
+    are returned with them (empty unless profiling is enabled).
+    """
+    score_name, page_idx, page_path, height, margin_x, margin_y = task
+    gray_image = image_dissector.load_page(page_path)
+    if gray_image is None:
+        return score_name, page_idx, None, mozart_profile.drain()
+
+    crops = []
+    for measure_image in image_dissector.page_measures(gray_image, margin_x, margin_y):
+        with mozart_profile.stage('resize'):
+            crops.append(mozart_utils.resize(measure_image, height))
+    return score_name, page_idx, crops, mozart_profile.drain()
+
+
+class Progress:
+    """
+    Keeps the tokens of every finished page on disk so that an interrupted
+    job can be restarted without decoding those pages again.
+
+    Every saved page records the path, size and modification time of its
+    image, and only counts as done while the image is unchanged, so a page
+    that was replaced, or a score whose pages moved, is decoded again.
+
+    Layout: <output_dir>/.progress/<score_name>/page_<n>.json
+    """
+
+    def __init__(self, output_dir):
+        self.progress_dir = os.path.join(output_dir, '.progress')
+
+    def _page_path(self, score_name, page_idx):
+        return os.path.join(self.progress_dir, score_name, f'page_{page_idx}.json')
+
+    @staticmethod
+    def _stamp(page_path):
+        # Identifies the image a page was decoded from
+        stat = os.stat(page_path)
+        return {'page': os.path.abspath(page_path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+    def is_done(self, score_name, page_idx, page_path):
+        try:
+            with open(self._page_path(score_name, page_idx), 'r') as f:
+                saved = json.load(f)
+            stamp = self._stamp(page_path)
+        except (OSError, ValueError):
+            return False
+        return all(saved.get(key) == value for key, value in stamp.items())
+
+    def save(self, score_name, page_idx, page_path, tokens):
+        path = self._page_path(score_name, page_idx)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(dict(self._stamp(page_path), tokens=tokens), f)
+        os.replace(tmp_path, path)  # Atomic, a crash never leaves half a page
+
+    def load(self, score_name, page_idx):
+        with open(self._page_path(score_name, page_idx), 'r') as f:
+            return json.load(f)['tokens']
+
+
+def write_score(score_name, num_pages, progress, output_dir):
+    import mozart_pipeline
+
+    # One page of tokens in memory at a time, the measures are written as they are read
+    notes = (token for page_idx in range(num_pages) for token in progress.load(score_name, page_idx))
+
+    output_path = os.path.join(output_dir, score_name + '.musicxml')
+    tmp_path = output_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        xmlencoder.write_musicxml(mozart_pipeline.iter_measures(notes), f)
+    os.replace(tmp_path, output_path)
+    return output_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Transcribe sheet music images to MusicXML.')
+    parser.add_argument('inputs', nargs='+', help='Images (one-page scores) or directories of pages (one score each).')
+    parser.add_argument('-model', dest='model', type=str, required=True, help='Path to the trained model (.meta).')
+    parser.add_argument('-vocabulary', dest='voc', type=str, required=True, help='Path to the vocabulary file.')
+    parser.add_argument('-output', dest='output', type=str, required=True, help='Directory for the MusicXML files.')
+    parser.add_argument('-workers', dest='workers', type=int, default=os.cpu_count(), help='Segmentation processes.')
+    parser.add_argument('-batch_size', dest='batch_size', type=int, default=16, help='Measures per forward pass.')
+    parser.add_argument('-margin_x', dest='margin_x', type=int, default=None, help='Default: derived from the staff spacing.')
+    parser.add_argument('-margin_y', dest='margin_y', type=int, default=None, help='Default: derived from the staff spacing.')
+    parser.add_argument('-profile', dest='profile', action="store_true", default=False,
+                        help='Print where the time goes for every page and for the whole run.')
+    parser.add_argument('-trace', dest='trace', type=str, default=None,
+                        help='Write a Chrome trace of the run (implies -profile).')
+    args = parser.parse_args()
+    if args.trace:
+        args.profile = True
+    if args.profile:
+        mozart_profile.enable()
+
+    # Imported here so that the spawned segmentation workers, which import
+    # this module, don't load TensorFlow
+    import mozart_predict
+
+    try:
+        scores = collect_scores(args.inputs)
+    except ValueError as e:
+        parser.error(str(e))
+    os.makedirs(args.output, exist_ok=True)
+    progress = Progress(args.output)
+
+    # Only the pages that were not decoded by a previous run
+    pending = {}
+    tasks = []
+    for score_name, pages in scores:
+        todo = [idx for idx, page in enumerate(pages) if not progress.is_done(score_name, idx, page)]
+        pending[score_name] = (len(pages), set(todo))
+        if not todo and not os.path.exists(os.path.join(args.output, score_name + '.musicxml')):
+            write_score(score_name, len(pages), progress, args.output)
+    total_pages = sum(len(pages) for _, pages in scores)
+    todo_pages = sum(len(todo) for _, todo in pending.values())
+    print(f'{len(scores)} scores, {total_pages} pages, {total_pages - todo_pages} already done.')
+    if todo_pages == 0:
+        return
+
+    # The model is loaded once, in this process, and shared by every page
+    predictor = mozart_predict.MusicScorePredictor(args.model, args.voc)
+    for score_name, pages in scores:
+        for page_idx in sorted(pending[score_name][1]):
+            tasks.append((score_name, page_idx, pages[page_idx], int(predictor.HEIGHT), args.margin_x, args.margin_y))
+
+    pages_of = dict(scores)
+    done = 0
+    start = time.perf_counter()
+    # spawn: the workers must not inherit the TensorFlow runtime of this process
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(args.workers, initializer=_init_worker, initargs=(args.profile,)) as pool:
+        for score_name, page_idx, crops, (events, counts) in pool.imap_unordered(segment_page, tasks):
+            page_path = pages_of[score_name][page_idx]
+            profile_mark = mozart_profile.mark()
+            mozart_profile.merge(events, counts)
+            if crops is None:
+                print(f'Error: Could not load {page_path}, it will be retried on the next run.')
+                continue
+
+            tokens = []
+            for result in predictor.predict_many(crops, args.batch_size):
+                tokens.extend(result)
+            progress.save(score_name, page_idx, page_path, tokens)
+
+            num_pages, todo = pending[score_name]
+            todo.discard(page_idx)
+            if not todo:
+                print(f'Wrote {write_score(score_name, num_pages, progress, args.output)}')
+
+            done += 1
+            elapsed = time.perf_counter() - start
+            print(f'[{done}/{todo_pages}] {page_path} ({done / elapsed:.2f} pages/s)')
+            if args.profile:
+                mozart_profile.print_report(since=profile_mark, title=f'Profile of {page_path}')
+
+    predictor.close()
+
+    if args.profile:
+        mozart_profile.print_report(title='Profile of the run')
+    if args.trace:
+        mozart_profile.export_chrome_trace(args.trace)
+        print(f'Wrote {args.trace}')
+
+
+if __name__ == '__main__':
+    main()
@@ -23,44 +23,44 @@ def convert_inputs_to_ctc_format(target_text):
 
     return train_targets, original
 
-def sparse_tuple_from(sequences, dtype=np.int32):
-    indices = []
-    values = []
+def ragged_to_sparse(sequences, dtype=np.int32):
+    """
+    Converts a list of sequences into the (indices, values, dense_shape)
+    triple of a sparse tensor, without a Python loop over the elements.
+    """
+    lengths = np.fromiter((len(seq) for seq in sequences), dtype=np.int64, count=len(sequences))
+    total = int(lengths.sum())
+
+    rows = np.repeat(np.arange(len(sequences), dtype=np.int64), lengths)
+    # Column of every element: its position minus the start of its row
+    row_starts = np.cumsum(lengths) - lengths
+    columns = np.arange(total, dtype=np.int64) - np.repeat(row_starts, lengths)
+
+    indices = np.stack([rows, columns], axis=1)
+    values = np.concatenate([np.asarray(seq, dtype=dtype) for seq in sequences]) if total else np.zeros(0, dtype=dtype)
+    shape = np.asarray([len(sequences), lengths.max() if len(sequences) else 0], dtype=np.int64)
 
-    for n, seq in enumerate(sequences):
-        indices.extend(zip([n] * len(seq), range(len(seq))))
-        values.extend(seq)
+    return indices, values, shape
 
-    indices = np.asarray(indices, dtype=np.int64)
-    values = np.asarray(values, dtype=dtype)
-    shape = np.asarray([len(sequences), np.asarray(indices).max(0)[1] + 1], dtype=np.int64)
+def sparse_to_ragged(indices, values, num_rows):
+    """
+    Splits the values of a sparse tensor with row-major sorted indices
+    (as returned by the CTC decoders) into one array per row.
+    """
+    indices = np.asarray(indices)
+    rows = indices[:, 0] if len(indices) else np.zeros(0, dtype=np.int64)
+    boundaries = np.searchsorted(rows, np.arange(1, num_rows))
+    return np.split(np.asarray(values), boundaries)
 
-    return indices, values, shape
+def sparse_tuple_from(sequences, dtype=np.int32):
+    return ragged_to_sparse(sequences, dtype)
 
 def sparse_tensor_to_strs(sparse_tensor):
-    indices= sparse_tensor[0][0]
+    indices = sparse_tensor[0][0]
     values = sparse_tensor[0][1]
     dense_shape = sparse_tensor[0][2]
 
-    strs = [ [] for i in range(dense_shape[0]) ]
-
-    string = []
-    ptr = 0
-    b = 0
-
-    for idx in range(len(indices)):
-        if indices[idx][0] != b:
-            strs[b] = string
-            string = []
-            b = indices[idx][0]
-
-        string.append(values[ptr])
-
-        ptr = ptr + 1
-
-    strs[b] = string
-
-    return strs
+    return sparse_to_ragged(indices, values, int(dense_shape[0]))
 
 
 def pad_sequences(sequences, maxlen=None, dtype=np.float32,
@@ -144,3 +144,199 @@ def resize(image, height):
     width = int(float(height * image.shape[1]) / image.shape[0])
     sample_img = cv2.resize(image, (width, height))
     return sample_img
+
+
+def pad_images(images, pad_value, channels=1, width=None):
+    """Stacks 2D images into a (batch, height, width, channels) float32 tensor padded with pad_value.
+
+    width defaults to the widest image."""
+    max_image_width = max(img.shape[1] for img in images)
+    if width is not None:
+        max_image_width = max(max_image_width, width)
+
+    batch_images = np.ones(shape=[len(images),
+                                  images[0].shape[0],
+                                  max_image_width,
+                                  channels], dtype=np.float32) * pad_value
+
+    for i, img in enumerate(images):
+        batch_images[i, 0:img.shape[0], 0:img.shape[1], 0] = img
+
+    return batch_images
+
+
+def quantized_sizes(smallest, largest, growth=1.25, multiple=1):
+    """
+    Increasing sizes from smallest to at least largest, each about growth
+    times the previous one and rounded up to a multiple of multiple.
+
+    Padding tensors to one of these sizes bounds the number of distinct
+    shapes (and so of compilations) to a few dozen, with at most
+    (growth - 1) of padding.
+    """
+    sizes = []
+    size = smallest
+    while True:
+        rounded = -(-int(size) // multiple) * multiple
+        if not sizes or rounded > sizes[-1]:
+            sizes.append(rounded)
+        if rounded >= largest:
+            return sizes
+        size = size * growth
+
+
+def quantize_size(size, sizes):
+    """ Smallest of the sorted sizes that holds size; past the largest, size is rounded up to a multiple of it. """
+    idx = np.searchsorted(sizes, size)
+    if idx < len(sizes):
+        return int(sizes[idx])
+    return -(-size // sizes[-1]) * sizes[-1]
+
+
+def width_buckets(widths, batch_size, width_tolerance=0.25):
+    """
+    Groups sample indices by width so that each group can be padded with little waste.
+
+    Indices are sorted by width and a new group starts when it would exceed
+    batch_size samples or (1 + width_tolerance) times the narrowest width of the group.
+    """
+    order = sorted(range(len(widths)), key=lambda i: widths[i])
+
+    buckets = []
+    bucket = []
+    for idx in order:
+        if bucket and (len(bucket) >= batch_size or widths[idx] > widths[bucket[0]] * (1 + width_tolerance)):
+            buckets.append(bucket)
+            bucket = []
+        bucket.append(idx)
+    if bucket:
+        buckets.append(bucket)
+
+    return buckets
+
+
+def image_size(image_path):
+    """Returns (height, width) of an image, read from the header for PNG files."""
+    with open(image_path, 'rb') as image_file:
+        header = image_file.read(24)
+    if header[:8] == b'\x89PNG\r\n\x1a\n':
+        width, height = np.frombuffer(header[16:24], dtype='>u4')
+        return int(height), int(width)
+    image = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+    return image.shape[:2]
+
+
+def _pad_int_sequences(sequences, value):
+    lengths = np.asarray([len(s) for s in sequences], dtype=np.int64)
+    padded = np.full((len(sequences), max(int(lengths.max(initial=0)), 1)), value, dtype=np.int64)
+    for idx, s in enumerate(sequences):
+        padded[idx, :len(s)] = s
+    return padded, lengths
+
+
+def levenshtein_matrices(a_sequences, b_sequences):
+    """
+    Fills the Levenshtein dynamic programming matrices of a batch of sequence pairs at once.
+
+    Cells on the same anti-diagonal (i + j constant) don't depend on each
+    other, so each of the n + m diagonals is computed with NumPy for every
+    pair of the batch together.
+
+    Returns:
+        tuple: (D, a_lengths, b_lengths) where D[k, i, j] is the distance
+        between a_sequences[k][:i] and b_sequences[k][:j].
+    """
+    a, a_lengths = _pad_int_sequences(a_sequences, -1)
+    b, b_lengths = _pad_int_sequences(b_sequences, -2)
+    batch, n = a.shape
+    m = b.shape[1]
+
+    D = np.zeros((batch, n + 1, m + 1), dtype=np.int32)
+    D[:, :, 0] = np.arange(n + 1)
+    D[:, 0, :] = np.arange(m + 1)
+
+    rows = np.arange(batch)[:, None]
+    for k in range(2, n + m + 1):
+        i = np.arange(max(1, k - m), min(n, k - 1) + 1)
+        j = k - i
+        change = D[:, i - 1, j - 1] + (a[:, i - 1] != b[:, j - 1])
+        D[rows, i, j] = np.minimum(np.minimum(D[:, i - 1, j], D[:, i, j - 1]) + 1, change)
+
+    return D, a_lengths, b_lengths
+
+
+def levenshtein_batch(a_sequences, b_sequences):
+    """Levenshtein distances between a_sequences[k] and b_sequences[k], computed together."""
+    if len(a_sequences) == 0:
+        return np.zeros(0, dtype=np.int64)
+    D, a_lengths, b_lengths = levenshtein_matrices(a_sequences, b_sequences)
+    return D[np.arange(len(a_sequences)), a_lengths, b_lengths].astype(np.int64)
+
+
+def symbol_error_rate(predictions, targets, vocabulary_size=None, batch_size=256):
+    """
+    Computes the edit distance based metrics of a whole set of predictions in one call.
+
+    Pairs are sorted by length and processed batch_size at a time, so the
+    DP matrices stay small.
+
+    Parameters:
+        predictions (list): Predicted sequences of token ids, or rows padded with -1.
+        targets (list): Ground truth sequences of token ids, or rows padded with -1.
+        vocabulary_size (int): If given, also count a per-token confusion matrix.
+        batch_size (int): Number of pairs computed together.
+
+    Returns:
+        dict: 'distances' (per pair), 'edit_distance' and 'target_length' (totals),
+        'ser' (symbol error rate), 'sequence_errors' (pairs with a distance > 0)
+        and, with vocabulary_size, 'confusion': a (V + 1) x (V + 1) matrix of
+        [target token, predicted token] counts where index V stands for no
+        token (insertions in the last row, deletions in the last column).
+    """
+    predictions = [[s for s in p if s != -1] for p in predictions]
+    targets = [[s for s in t if s != -1] for t in targets]
+
+    distances = np.zeros(len(targets), dtype=np.int64)
+    confusion = None
+    if vocabulary_size is not None:
+        confusion = np.zeros((vocabulary_size + 1, vocabulary_size + 1), dtype=np.int64)
+
+    order = sorted(range(len(targets)), key=lambda k: max(len(targets[k]), len(predictions[k])))
+    for start in range(0, len(order), batch_size):
+        chunk = order[start:start + batch_size]
+        chunk_targets = [targets[k] for k in chunk]
+        chunk_predictions = [predictions[k] for k in chunk]
+        D, t_lengths, p_lengths = levenshtein_matrices(chunk_targets, chunk_predictions)
+        distances[chunk] = D[np.arange(len(chunk)), t_lengths, p_lengths]
+
+        if confusion is not None:
+            for c in range(len(chunk)):
+                _count_alignment(D[c], chunk_targets[c], chunk_predictions[c], confusion, vocabulary_size)
+
+    total_length = sum(len(t) for t in targets)
+    total_distance = int(distances.sum())
+    result = {
+        'distances': distances,
+        'edit_distance': total_distance,
+        'target_length': total_length,
+        'ser': total_distance / total_length if total_length else 0.0,
+        'sequence_errors': int(np.count_nonzero(distances)),
+    }
+    if confusion is not None:
+        result['confusion'] = confusion
+    return result
+
+
+def _count_alignment(D, target, prediction, confusion, none_idx):
+    # Walks one optimal alignment back from the end of the DP matrix
+    i, j = len(target), len(prediction)
+    while i > 0 or j > 0:
+        if i > 0 and j > 0 and D[i, j] == D[i - 1, j - 1] + (target[i - 1] != prediction[j - 1]):
+            confusion[target[i - 1], prediction[j - 1]] += 1
+            i, j = i - 1, j - 1
+        elif i > 0 and D[i, j] == D[i - 1, j] + 1:
+            confusion[target[i - 1], none_idx] += 1
+            i -= 1
+        else:
+            confusion[none_idx, prediction[j - 1]] += 1
+            j -= 1
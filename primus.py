@@ -1,17 +1,37 @@
 import cv2
+import multiprocessing
 import numpy as np
 import mozart_utils
+import primus_pack
 import random
+import threading
+import queue
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+# Corpus of a worker process of CTC_PriMuS.batchGenerator()
+_worker_corpus = None
+
+
+def _init_worker(corpus):
+    global _worker_corpus
+    _worker_corpus = corpus
+
+
+def _read_sample(*args, **kwargs):
+    return _worker_corpus.readSample(*args, **kwargs)
+
 
 class CTC_PriMuS:
     gt_element_separator = '-'
     PAD_COLUMN = 0
-    validation_dict = None
 
 
-    def __init__(self, corpus_dirpath, corpus_filepath, dictionary_path, semantic, distortions = False, val_split = 0.0):
+    def __init__(self, corpus_dirpath, corpus_filepath, dictionary_path, semantic, distortions = False, val_split = 0.0, packed_path = None, augmenter = None):
         self.semantic = semantic
         self.distortions = distortions
+        self.augmenter = augmenter  # mozart_augment.Augmenter applied to the training batches
         self.corpus_dirpath = corpus_dirpath
 
         # Corpus
@@ -36,6 +56,13 @@ class CTC_PriMuS:
         dict_file.close()
 
         self.vocabulary_size = len(self.word2int)
+
+        # Packed corpus (see primus_pack.py), read instead of the PNG and ground truth files
+        self.packed = None
+        if packed_path is not None:
+            self.packed = primus_pack.PackedCorpus(packed_path)
+            if self.packed.vocabulary != dict_list or self.packed.semantic != semantic:
+                raise ValueError(f"{packed_path} was packed with another vocabulary or encoding")
         
         
         # Train and validation split
@@ -43,119 +70,370 @@ class CTC_PriMuS:
         val_idx = int(len(corpus_list) * val_split) 
         self.training_list = corpus_list[val_idx:]
         self.validation_list = corpus_list[:val_idx]
+        self.validation_cache = None
         
         print ('Training with ' + str(len(self.training_list)) + ' and validating with ' + str(len(self.validation_list)))
 
+    def __getstate__(self):
+        # Sent to the worker processes, which never validate
+        state = self.__dict__.copy()
+        state['validation_cache'] = None
+        return state
+
+    def readSample(self, sample_filepath, params, distortions=False, normalize=True, augment_seed=None):
+        """
+        Reads, resizes and normalizes one sample image and its label sequence.
+
+        With normalize=False the image is returned as the resized uint8 grayscale image.
+        With augment_seed and an augmenter, the resized image is distorted
+        with np.random.default_rng(augment_seed).
+        """
+        packed = self.packed
+        if packed is not None and packed.distortions == distortions and sample_filepath in packed:
+            idx = packed.name2idx[sample_filepath]
+            sample_img = packed.image(idx)
+            if packed.height != params['img_height']:
+                sample_img = mozart_utils.resize(sample_img, params['img_height'])
+            if self.augmenter is not None and augment_seed is not None:
+                sample_img = self.augmenter(sample_img, np.random.default_rng(augment_seed))
+            return mozart_utils.normalize(sample_img) if normalize else sample_img, packed.label(idx)
+
+        sample_fullpath = self.corpus_dirpath + '/' + sample_filepath + '/' + sample_filepath
+
+        # IMAGE
+        if distortions:
+            sample_img = cv2.imread(sample_fullpath + '_distorted.jpg', cv2.IMREAD_GRAYSCALE)
+        else:
+            sample_img = cv2.imread(sample_fullpath + '.png', cv2.IMREAD_GRAYSCALE)
+        height = params['img_height']
+        sample_img = mozart_utils.resize(sample_img,height)
+        if self.augmenter is not None and augment_seed is not None:
+            sample_img = self.augmenter(sample_img, np.random.default_rng(augment_seed))
+        image = mozart_utils.normalize(sample_img) if normalize else sample_img
+
+        # GROUND TRUTH
+        if self.semantic:
+            sample_full_filepath = sample_fullpath + '.semantic'
+        else:
+            sample_full_filepath = sample_fullpath + '.agnostic'
+
+        sample_gt_file = open(sample_full_filepath, 'r')
+        sample_gt_plain = sample_gt_file.readline().rstrip().split(mozart_utils.word_separator())
+        sample_gt_file.close()
+
+        return image, [self.word2int[lab] for lab in sample_gt_plain]
+
+    def makeBatch(self, images, labels, params, width_sizes=None):
+        """
+        Pads the images to the widest one with PAD_COLUMN and computes the sequence lengths.
+
+        With width_sizes, the batch is padded further to the next of these
+        widths (see mozart_utils.quantized_sizes()).
+        """
+        width = None
+        if width_sizes is not None:
+            width = mozart_utils.quantize_size(max(img.shape[1] for img in images), width_sizes)
+        batch_images = mozart_utils.pad_images(images, self.PAD_COLUMN, params['img_channels'], width)
+
+        # LENGTH
+        width_reduction = self.widthReduction(params)
+
+        # Each sample keeps its own length so that the padding is not decoded
+        lengths = [ img.shape[1] // width_reduction for img in images ]
+
+        return {
+            'inputs': batch_images,
+            'seq_lengths': np.asarray(lengths),
+            'targets': labels,
+        }
+
     def nextBatch(self, params):
         images = []
         labels = []
 
         # Read files
         for _ in range(params['batch_size']):
-            sample_filepath = self.training_list[self.current_idx]
+            image, label = self.readSample(self.training_list[self.current_idx], params, self.distortions)
+            images.append(image)
+            labels.append(label)
+
+            self.current_idx = (self.current_idx + 1) % len( self.training_list )
+
+        # Transform to batch
+        return self.makeBatch(images, labels, params)
+
+    def sampleSizes(self, sample_list, params, distortions=None):
+        """
+        Returns the resized widths and the label lengths of the samples.
+
+        They come from the packed corpus when possible; otherwise the image
+        size is read from the PNG header and the label from its file, without
+        decoding any image. distortions selects the images measured, and
+        defaults to self.distortions.
+        """
+        if distortions is None:
+            distortions = self.distortions
+        height = params['img_height']
+        widths = np.zeros(len(sample_list), dtype=np.int64)
+        label_lengths = np.zeros(len(sample_list), dtype=np.int64)
+        for i, sample_filepath in enumerate(sample_list):
+            packed = self.packed
+            if packed is not None and packed.distortions == distortions and sample_filepath in packed:
+                idx = packed.name2idx[sample_filepath]
+                width = packed.widths[idx] if packed.height == height else int(float(height * packed.widths[idx]) / packed.height)
+                widths[i], label_lengths[i] = width, packed.index[idx, 3]
+                continue
+
             sample_fullpath = self.corpus_dirpath + '/' + sample_filepath + '/' + sample_filepath
+            img_height, img_width = mozart_utils.image_size(sample_fullpath + ('_distorted.jpg' if distortions else '.png'))
+            widths[i] = int(float(height * img_width) / img_height)
 
-            # IMAGE
-            if self.distortions:
-                sample_img = cv2.imread(sample_fullpath + '_distorted.jpg', False) # Grayscale is assumed
-            else:
-                sample_img = cv2.imread(sample_fullpath + '.png', False)  # Grayscale is assumed!
-            height = params['img_height']
-            sample_img = ctc_utils.resize(sample_img,height)
-            images.append(ctc_utils.normalize(sample_img))
-
-            # GROUND TRUTH
-            if self.semantic:
-                sample_full_filepath = sample_fullpath + '.semantic'
-            else:
-                sample_full_filepath = sample_fullpath + '.agnostic'
-            
-            sample_gt_file = open(sample_full_filepath, 'r')
-            sample_gt_plain = sample_gt_file.readline().rstrip().split(ctc_utils.word_separator())
-            sample_gt_file.close()
+            with open(sample_fullpath + ('.semantic' if self.semantic else '.agnostic'), 'r') as sample_gt_file:
+                label_lengths[i] = len(sample_gt_file.readline().rstrip().split(mozart_utils.word_separator()))
 
-            labels.append([self.word2int[lab] for lab in sample_gt_plain])
+        return widths, label_lengths
 
-            self.current_idx = (self.current_idx + 1) % len( self.training_list )
+    def bucketedBatches(self, sample_list, params, max_pixels, rng=random, widths=None, label_lengths=None):
+        """
+        Splits sample_list into batches of samples with similar width and label length.
 
+        A batch grows until its padded size (samples x widest width x height)
+        would exceed max_pixels, so narrow samples make big batches and wide
+        samples small ones. Samples are binned by width (and label length) and
+        shuffled inside a bin, then the batch order is shuffled, so batches
+        change from one call to the next.
 
-        # Transform to batch
-        image_widths = [img.shape[1] for img in images]
-        max_image_width = max(image_widths)
+        Returns:
+            tuple: (list of batches of sample names, padding ratio of those batches)
+        """
+        if widths is None or label_lengths is None:
+            widths, label_lengths = self.sampleSizes(sample_list, params)
 
-        batch_images = np.ones(shape=[params['batch_size'],
-                                       params['img_height'],
-                                       max_image_width,
-                                       params['img_channels']], dtype=np.float32)*self.PAD_COLUMN
+        width_bin = 4 * self.widthReduction(params)
+        order = sorted(range(len(sample_list)),
+                       key=lambda i: (widths[i] // width_bin, label_lengths[i] // 4, rng.random()))
 
-        for i, img in enumerate(images):
-            batch_images[i, 0:img.shape[0], 0:img.shape[1], 0] = img
+        batches = []
+        batch = []
+        batch_max_width = 0
+        padded_pixels = 0
+        for i in order:
+            max_width = max(batch_max_width, widths[i])
+            if batch and (len(batch) + 1) * max_width * params['img_height'] > max_pixels:
+                batches.append(batch)
+                padded_pixels += len(batch) * batch_max_width
+                batch = []
+                max_width = widths[i]
+            batch.append(i)
+            batch_max_width = max_width
+        if batch:
+            batches.append(batch)
+            padded_pixels += len(batch) * batch_max_width
 
-        # LENGTH
+        rng.shuffle(batches)
+        padding_ratio = 1 - float(np.sum(widths)) / padded_pixels if padded_pixels else 0.0
+        return [[sample_list[i] for i in batch] for batch in batches], padding_ratio
+
+    def widthReduction(self, params):
         width_reduction = 1
         for i in range(params['conv_blocks']):
             width_reduction = width_reduction * params['conv_pooling_size'][i][1]
+        return width_reduction
 
-        lengths = [ batch_images.shape[2] / width_reduction ] * batch_images.shape[0]
+    def batchGenerator(self, params, num_workers=4, prefetch=4, shuffle_buffer=1024, shard_index=0, num_shards=1, seed=None, max_pixels=None, width_sizes=None):
+        """
+        Yields training batches forever, prepared in the background.
 
-        return {
-            'inputs': batch_images,
-            'seq_lengths': np.asarray(lengths),
-            'targets': labels,
-        }
-        
-    def getValidation(self, params):
-        if self.validation_dict == None:                
-            images = []
-            labels = []
-    
-            # Read files
-            for sample_filepath in self.validation_list:
-                sample_fullpath = self.corpus_dirpath + '/' + sample_filepath + '/' + sample_filepath
-    
-                # IMAGE
-                sample_img = cv2.imread(sample_fullpath + '.png', False)  # Grayscale is assumed!
-                height = params['img_height']
-                sample_img = ctc_utils.resize(sample_img,height)
-                images.append(ctc_utils.normalize(sample_img))
-    
-                # GROUND TRUTH
-                if self.semantic:
-                    sample_full_filepath = sample_fullpath + '.semantic'
+        Samples are decoded and resized by num_workers threads (OpenCV
+        releases the GIL), or with an augmenter by num_workers processes, so
+        that the Python side of the distortions does not hold the GIL of
+        the training loop. A feeder thread batches them and keeps up to
+        prefetch batches ready. With num_shards > 1 only every num_shards-th
+        training sample, starting at shard_index, is read.
+
+        By default batches have params['batch_size'] samples taken from a
+        shuffle buffer of shuffle_buffer sample names. With max_pixels, every
+        epoch is split by bucketedBatches() instead, which caps the padded
+        size of a batch and keeps the padding small. width_sizes is passed
+        on to makeBatch() to limit the number of distinct batch widths.
+
+        With an augmenter, every sample read gets new distortions. Their
+        seeds are drawn in order from seed, so a seeded run is reproducible
+        whatever the thread that reads a sample.
+
+        The time the caller spent waiting for a batch is accumulated in
+        self.input_wait_time, over self.batches_served batches, and
+        self.padding_ratio is the share of padding in the pixels served.
+
+        Raises:
+            ValueError: If the shard has no training sample.
+        """
+        shard = self.training_list[shard_index::num_shards]
+        if not shard:
+            # The batch plan would look for a first sample forever
+            raise ValueError(f"Shard {shard_index} of {num_shards} has no training sample "
+                             f"(the training set has {len(self.training_list)})")
+        rng = random.Random(seed)
+        augment_seeds = np.random.SeedSequence(seed)
+        ready = queue.Queue(maxsize=prefetch)
+        stop = threading.Event()
+        self.input_wait_time = 0.0
+        self.batches_served = 0
+        self.padding_ratio = 0.0
+        served_pixels = [0, 0]  # [image pixels, padded pixels]
+
+        def batch_plan():
+            # Endless stream of batches of sample names, one epoch after the other
+            if max_pixels is not None:
+                widths, label_lengths = self.sampleSizes(shard, params)
+                while True:
+                    batches, padding_ratio = self.bucketedBatches(shard, params, max_pixels, rng, widths, label_lengths)
+                    print(f'Epoch of {len(batches)} bucketed batches, {100 * padding_ratio:.1f}% padding')
+                    for batch in batches:
+                        yield batch
+
+            buffer = []
+            batch = []
+            while True:
+                for sample_filepath in shard:
+                    # Shuffle buffer: emit a random element once it is full
+                    buffer.append(sample_filepath)
+                    if len(buffer) < shuffle_buffer:
+                        continue
+                    pick = rng.randrange(len(buffer))
+                    buffer[pick], buffer[-1] = buffer[-1], buffer[pick]
+                    batch.append(buffer.pop())
+                    if len(batch) == params['batch_size']:
+                        yield batch
+                        batch = []
+
+        def feed():
+            try:
+                if self.augmenter is not None:
+                    # Spawned, not forked: the training process runs TensorFlow threads.
+                    # The images come back as uint8, an eighth of the size of the normalized ones.
+                    executor = ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context('spawn'),
+                                                   initializer=_init_worker, initargs=(self,))
+                    read_sample = _read_sample
                 else:
-                    sample_full_filepath = sample_fullpath + '.agnostic'
-                
-                sample_gt_file = open(sample_full_filepath, 'r')
-            
-                sample_gt_plain = sample_gt_file.readline().rstrip().split(ctc_utils.word_separator())
-                sample_gt_file.close()
-    
-                labels.append([self.word2int[lab] for lab in sample_gt_plain])
-    
-            # Transform to batch
-            image_widths = [img.shape[1] for img in images]
-            max_image_width = max(image_widths)
-    
-            batch_images = np.ones(shape=[len(self.validation_list),
-                                           params['img_height'],
-                                           max_image_width,
-                                           params['img_channels']], dtype=np.float32)*self.PAD_COLUMN
-    
-            for i, img in enumerate(images):
-                batch_images[i, 0:img.shape[0], 0:img.shape[1], 0] = img
-    
-            # LENGTH
-            width_reduction = 1
-            for i in range(params['conv_blocks']):
-                width_reduction = width_reduction * params['conv_pooling_size'][i][1]
-    
-            lengths = [ batch_images.shape[2] / width_reduction ] * batch_images.shape[0]
-    
-            self.validation_dict = {
-                'inputs': batch_images,
-                'seq_lengths': np.asarray(lengths),
+                    executor = ThreadPoolExecutor(num_workers)
+                    read_sample = self.readSample
+                with executor:
+                    plan = batch_plan()
+                    in_flight = deque()
+                    while not stop.is_set():
+                        # Keep the reads of the next batches going while this one is assembled
+                        while len(in_flight) < prefetch:
+                            in_flight.append([executor.submit(read_sample, sample_filepath, params, self.distortions,
+                                                              normalize=False, augment_seed=augment_seeds.spawn(1)[0])
+                                              for sample_filepath in next(plan)])
+                        samples = [future.result() for future in in_flight.popleft()]
+                        images, labels = zip(*samples)
+                        images = [mozart_utils.normalize(image) for image in images]
+                        item = self.makeBatch(images, list(labels), params, width_sizes)
+                        while not stop.is_set():
+                            try:
+                                ready.put(item, timeout=0.1)
+                                break
+                            except queue.Full:
+                                pass
+                    for futures in in_flight:
+                        for future in futures:
+                            future.cancel()
+            except BaseException as e:
+                ready.put(e)
+
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+        try:
+            while True:
+                start = time.perf_counter()
+                item = ready.get()
+                self.input_wait_time += time.perf_counter() - start
+                if isinstance(item, BaseException):
+                    raise item
+                self.batches_served += 1
+                served_pixels[0] += int(np.sum(item['seq_lengths']))
+                served_pixels[1] += item['inputs'].shape[0] * (item['inputs'].shape[2] // self.widthReduction(params))
+                self.padding_ratio = 1 - served_pixels[0] / served_pixels[1] if served_pixels[1] else 0.0
+                yield item
+        finally:
+            stop.set()
+
+    def validationSamples(self, params, cache=True):
+        """
+        Returns the validation images (resized uint8) and labels.
+
+        With cache=True they are kept in self.validation_cache for the next
+        calls. Unpadded uint8 images take at most a quarter of the memory of
+        the padded float32 tensor.
+        """
+        if self.validation_cache is not None and self.validation_cache['img_height'] == params['img_height']:
+            return self.validation_cache['images'], self.validation_cache['targets']
+
+        images = []
+        labels = []
+
+        # Read files
+        for sample_filepath in self.validation_list:
+            image, label = self.readSample(sample_filepath, params, normalize=False)
+            images.append(image)
+            labels.append(label)
+
+        if cache:
+            self.validation_cache = {
+                'img_height': params['img_height'],
+                'images': images,
                 'targets': labels,
             }
-            
-        
-        return self.validation_dict, len(self.validation_list)
+        return images, labels
+
+    def validationBatches(self, params, max_bytes=256 * 2**20, cache=True):
+        """
+        Yields the validation split in batches whose input tensor is at most max_bytes.
+
+        Samples are sorted by width so that each chunk is padded only to the
+        widest sample in it, not to the widest of the whole split. Every
+        batch also has an 'indices' entry with the positions of its samples
+        in self.validation_list.
+
+        With cache=False, and no cached split for this height, the widths
+        come from sampleSizes() and every chunk is read when its batch is
+        made, so only one chunk is in memory at a time.
+        """
+        cached = self.validation_cache is not None and self.validation_cache['img_height'] == params['img_height']
+        if cache or cached:
+            images, labels = self.validationSamples(params, cache)
+            widths = [image.shape[1] for image in images]
+            read = lambda i: (images[i], labels[i])
+        else:
+            widths, _ = self.sampleSizes(self.validation_list, params, distortions=False)
+            read = lambda i: self.readSample(self.validation_list[i], params, normalize=False)
+        order = sorted(range(len(widths)), key=lambda i: widths[i])
+        bytes_per_column = params['img_height'] * params['img_channels'] * np.dtype(np.float32).itemsize
+
+        chunk = []
+        for i in order:
+            # Sorted by width, so the current sample is the widest of the chunk
+            if chunk and (len(chunk) + 1) * widths[i] * bytes_per_column > max_bytes:
+                yield self._validationBatch(chunk, read, params)
+                chunk = []
+            chunk.append(i)
+        if chunk:
+            yield self._validationBatch(chunk, read, params)
+
+    def _validationBatch(self, chunk, read, params):
+        images, labels = zip(*[read(i) for i in chunk])
+        batch = self.makeBatch([mozart_utils.normalize(image) for image in images], list(labels), params)
+        batch['indices'] = chunk
+        return batch
+
+    def getValidation(self, params):
+        """
+        Returns the whole validation split as a single padded batch.
+
+        This needs memory for every sample at the width of the widest one;
+        prefer validationBatches(), which bounds it.
+        """
+        images, labels = self.validationSamples(params)
+        return self.makeBatch([mozart_utils.normalize(img) for img in images], labels, params), len(self.validation_list)
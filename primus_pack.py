@@ -0,0 +1,160 @@
+import argparse
+import json
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+import mozart_utils
+
+# File layout:
+#   MAGIC | images (uint8, every image flattened row by row) | index | labels | header (JSON) | header offset (uint64)
+# index rows are (image offset, width, label offset, label length), all int64.
+MAGIC = b'PRIMUSPK'
+VERSION = 1
+
+
+class PackedCorpus:
+    """
+    Read-only view of a corpus packed by pack_corpus().
+
+    The arrays are memory-mapped, so opening the file is instant and only
+    the samples that are read are loaded from disk.
+    """
+
+    def __init__(self, packed_path):
+        self.path = packed_path
+        with open(packed_path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{packed_path} is not a packed PrIMuS corpus")
+            f.seek(-8, 2)
+            header_offset = struct.unpack('<Q', f.read(8))[0]
+            f.seek(header_offset)
+            self.header = json.loads(f.read()[:-8].decode('utf-8'))
+
+        if self.header['version'] != VERSION:
+            raise ValueError(f"Unsupported packed corpus version {self.header['version']}")
+
+        self.height = self.header['height']
+        self.semantic = self.header['semantic']
+        self.distortions = self.header['distortions']
+        self.vocabulary = self.header['vocabulary']
+        self.names = self.header['names']
+        self.name2idx = {name: idx for idx, name in enumerate(self.names)}
+
+        num_samples = len(self.names)
+        self.images = np.memmap(packed_path, dtype=np.uint8, mode='r',
+                                offset=len(MAGIC), shape=(self.header['images_size'],))
+        self.index = np.memmap(packed_path, dtype=np.int64, mode='r',
+                               offset=self.header['index_offset'], shape=(num_samples, 4))
+        self.labels = np.memmap(packed_path, dtype=np.int32, mode='r',
+                                offset=self.header['labels_offset'], shape=(self.header['labels_size'],))
+        self.widths = np.asarray(self.index[:, 1])
+
+    def __reduce__(self):
+        # Pickling the memory maps would copy the whole corpus: the worker
+        # processes of the batch generator open the file again instead
+        return PackedCorpus, (self.path,)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.name2idx
+
+    def image(self, idx):
+        """ Resized grayscale uint8 image of a sample (not normalized). """
+        offset, width = self.index[idx, 0], self.index[idx, 1]
+        return np.asarray(self.images[offset:offset + self.height * width]).reshape(self.height, width)
+
+    def label(self, idx):
+        offset, length = self.index[idx, 2], self.index[idx, 3]
+        return self.labels[offset:offset + length].tolist()
+
+
+def pack_corpus(corpus_dirpath, corpus_filepath, dictionary_path, semantic, output_path,
+                img_height=128, distortions=False, num_workers=8):
+    """
+    Converts the samples listed in corpus_filepath into a single packed file.
+
+    Images are stored resized to img_height as uint8 and labels as the
+    integer codes of CTC_PriMuS.word2int, so reading a sample needs no
+    decoding, resizing or tokenization.
+    """
+    with open(corpus_filepath, 'r') as f:
+        names = f.read().splitlines()
+    with open(dictionary_path, 'r') as f:
+        vocabulary = f.read().splitlines()
+    word2int = {}
+    for word in vocabulary:
+        if word not in word2int:
+            word2int[word] = len(word2int)
+
+    def read(name):
+        sample_fullpath = corpus_dirpath + '/' + name + '/' + name
+        image_path = sample_fullpath + ('_distorted.jpg' if distortions else '.png')
+        image = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+        if image is None:
+            raise ValueError(f"Could not read {image_path}")
+        image = mozart_utils.resize(image, img_height)
+
+        with open(sample_fullpath + ('.semantic' if semantic else '.agnostic'), 'r') as gt_file:
+            tokens = gt_file.readline().rstrip().split(mozart_utils.word_separator())
+        return np.ascontiguousarray(image, dtype=np.uint8), np.asarray([word2int[t] for t in tokens], dtype=np.int32)
+
+    index = np.zeros((len(names), 4), dtype=np.int64)
+    labels = []
+    image_offset = 0
+    label_offset = 0
+
+    with open(output_path, 'wb') as out, ThreadPoolExecutor(num_workers) as executor:
+        out.write(MAGIC)
+        # map() keeps the order; images are streamed to the file as they are read
+        for idx, (image, label) in enumerate(executor.map(read, names)):
+            out.write(image.tobytes())
+            index[idx] = (image_offset, image.shape[1], label_offset, len(label))
+            image_offset += image.size
+            label_offset += len(label)
+            labels.append(label)
+            if (idx + 1) % 1000 == 0:
+                print(f'Packed {idx + 1}/{len(names)} samples')
+
+        # Align the index for the memory map
+        out.write(b'\0' * (-out.tell() % 8))
+        index_offset = out.tell()
+        out.write(index.tobytes())
+        labels_offset = out.tell()
+        out.write(np.concatenate(labels).astype(np.int32).tobytes() if labels else b'')
+
+        header_offset = out.tell()
+        header = {
+            'version': VERSION,
+            'height': img_height,
+            'semantic': semantic,
+            'distortions': distortions,
+            'vocabulary': vocabulary,
+            'names': names,
+            'images_size': image_offset,
+            'index_offset': index_offset,
+            'labels_offset': labels_offset,
+            'labels_size': label_offset,
+        }
+        out.write(json.dumps(header).encode('utf-8'))
+        out.write(struct.pack('<Q', header_offset))
+
+    print(f'Packed {len(names)} samples ({image_offset / 2**20:.1f} MiB of images) into {output_path}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack a PrIMuS corpus into a single memory-mappable file.')
+    parser.add_argument('-corpus', dest='corpus', type=str, required=True, help='Path to the corpus.')
+    parser.add_argument('-set', dest='set', type=str, required=True, help='Path to the set file.')
+    parser.add_argument('-vocabulary', dest='voc', type=str, required=True, help='Path to the vocabulary file.')
+    parser.add_argument('-output', dest='output', type=str, required=True, help='Path of the packed file.')
+    parser.add_argument('-semantic', dest='semantic', action="store_true", default=False)
+    parser.add_argument('-distortions', dest='distortions', action="store_true", default=False)
+    parser.add_argument('-img_height', dest='img_height', type=int, default=128)
+    args = parser.parse_args()
+
+    pack_corpus(args.corpus, args.set, args.voc, args.semantic, args.output, args.img_height, args.distortions)
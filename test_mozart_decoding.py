@@ -0,0 +1,49 @@
+import itertools
+import math
+
+import numpy as np
+import pytest
+
+import mozart_decoding
+
+
+def _exhaustive_decode(log_probs, prior=None, lm_weight=0.5, insertion_bonus=0.0):
+    # Sums the probability of every path into its label sequence, then adds
+    # the same language model score as prefix_beam_search
+    num_frames, num_classes = log_probs.shape
+    blank = num_classes - 1
+    totals = {}
+    for path in itertools.product(range(num_classes), repeat=num_frames):
+        labels = tuple(c for idx, c in enumerate(path) if c != blank and (idx == 0 or c != path[idx - 1]))
+        score = sum(log_probs[t, c] for t, c in enumerate(path))
+        totals[labels] = np.logaddexp(totals.get(labels, -math.inf), score)
+
+    def score(labels):
+        total = totals[labels] + insertion_bonus * len(labels)
+        if prior is not None:
+            boundary = prior.vocabulary_size
+            tokens = (boundary,) + labels + (boundary,)
+            total += lm_weight * sum(prior.log_probs[a, b] for a, b in zip(tokens[:-1], tokens[1:]))
+        return total
+
+    return list(max(totals, key=score))
+
+
+def _random_log_probs(rng, num_frames, num_classes, sharpness):
+    logits = rng.normal(0, sharpness, (num_frames, num_classes))
+    return logits - np.logaddexp.reduce(logits, axis=1, keepdims=True)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_prefix_beam_search_matches_exhaustive_search(seed):
+    rng = np.random.default_rng(seed)
+    vocabulary_size = 3
+    log_probs = _random_log_probs(rng, int(rng.integers(1, 6)), vocabulary_size + 1, sharpness=2.0)
+    # A beam wide enough for every prefix and no pruning make the search exact
+    exact = dict(beam_width=10**4, token_threshold=1e-300, max_candidates=vocabulary_size)
+    assert mozart_decoding.prefix_beam_search(log_probs, **exact) == _exhaustive_decode(log_probs)
+
+    counts = rng.integers(1, 10, (vocabulary_size + 1, vocabulary_size + 1)).astype(np.float64)
+    prior = mozart_decoding.TokenPrior(np.log(counts / counts.sum(axis=1, keepdims=True)))
+    assert (mozart_decoding.prefix_beam_search(log_probs, prior=prior, lm_weight=0.7, insertion_bonus=0.3, **exact)
+            == _exhaustive_decode(log_probs, prior, lm_weight=0.7, insertion_bonus=0.3))
@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+
+import mozart_model
+
+IMG_HEIGHT = 32
+VOCABULARY_SIZE = 12
+
+
+def _built_model(seed):
+    tf.keras.utils.set_random_seed(seed)
+    params = mozart_model.default_model_params(IMG_HEIGHT, VOCABULARY_SIZE)
+    params["conv_filter_n"] = [4, 8, 8, 8]
+    params["rnn_units"] = 8
+    model = mozart_model.CTC_CNN_Model(params)
+    model(np.zeros((1, IMG_HEIGHT, 16, 1), dtype=np.float32), training=False)
+    return model
+
+
+def _randomize(model, rng):
+    # Batch normalization statistics included, which training alone would move
+    for variable in model.weights:
+        variable.assign(rng.uniform(0.5, 1.5, variable.shape).astype(np.float32))
+
+
+def test_checkpoint_restores_every_variable(tmp_path):
+    model = _built_model(seed=0)
+    optimizer = tf.keras.optimizers.Adam(1e-3)
+    optimizer.build(model.trainable_variables)
+    _randomize(model, np.random.default_rng(0))
+    optimizer.iterations.assign(42)
+    # Saved as mozart_training.py saves it
+    path = tf.train.Checkpoint(optimizer=optimizer, model=model).save(str(tmp_path / 'model'))
+
+    # The batch normalization statistics are only reachable through the model, not the optimizer
+    names = {name for name, _ in tf.train.list_variables(path)}
+    assert any(name.startswith('model/conv_layer_1/moving_mean') for name in names)
+    assert any(name.startswith('model/conv_layer_1/moving_variance') for name in names)
+
+    restored = _built_model(seed=1)
+    restored_optimizer = tf.keras.optimizers.Adam(1e-3)
+    restored_optimizer.build(restored.trainable_variables)
+    mozart_model.restore_weights(restored, path, restored_optimizer)
+
+    assert len(restored.weights) == len(model.weights)
+    for saved, loaded in zip(model.weights, restored.weights):
+        assert saved.shape == loaded.shape
+        np.testing.assert_array_equal(saved.numpy(), loaded.numpy(), err_msg=saved.path)
+    assert int(restored_optimizer.iterations) == 42
+
+    # Inference only needs the model
+    inference = _built_model(seed=2)
+    mozart_model.restore_weights(inference, path)
+    images = np.random.default_rng(1).random((2, IMG_HEIGHT, 48, 1)).astype(np.float32)
+    np.testing.assert_allclose(inference(images, training=False), model(images, training=False), rtol=1e-6)
+
+
+def test_restore_rejects_partial_checkpoint(tmp_path):
+    model = _built_model(seed=0)
+    # Only the dense layer, like the checkpoints of a model whose other layers were not tracked
+    path = tf.train.Checkpoint(model=tf.train.Checkpoint(dense=model.dense)).save(str(tmp_path / 'model'))
+    with pytest.raises(ValueError):
+        mozart_model.restore_weights(_built_model(seed=1), path)
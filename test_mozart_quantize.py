@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+
+import mozart_export
+import mozart_model
+import mozart_quantize
+
+IMG_HEIGHT = 32
+VOCABULARY = ['clef-G2', 'note-C4_quarter', 'note-D4_quarter', 'note-E4_half', 'rest-quarter', 'barline']
+
+
+def _trained_like_model(seed):
+    # Model of the size mozart_quantize restores, with weights that are
+    # not those of a fresh model: every saved variable matters
+    tf.keras.utils.set_random_seed(seed)
+    model = mozart_model.CTC_CNN_Model(mozart_model.default_model_params(IMG_HEIGHT, len(VOCABULARY)))
+    model(np.zeros((1, IMG_HEIGHT, 16, 1), dtype=np.float32), training=False)
+    rng = np.random.default_rng(seed)
+    for layer in model.conv_layers[1::4]:
+        layer.moving_mean.assign(rng.normal(0, 0.1, layer.moving_mean.shape).astype(np.float32))
+        layer.moving_variance.assign(rng.uniform(0.5, 2, layer.moving_variance.shape).astype(np.float32))
+    model.dense.kernel.assign(model.dense.kernel * 8)  # Confident outputs, as a trained model gives
+    return model
+
+
+def _log_probs(model, image):
+    return tf.nn.log_softmax(model(image[np.newaxis, :, :, np.newaxis], training=False))[0].numpy()
+
+
+def test_quantized_model_matches_float_model(tmp_path):
+    voc_path = tmp_path / 'vocabulary.txt'
+    voc_path.write_text('\n'.join(VOCABULARY))
+    model = _trained_like_model(seed=0)
+    checkpoint_path = tf.train.Checkpoint(model=model).save(str(tmp_path / 'model'))
+    tflite_path = str(tmp_path / 'model.tflite')
+    mozart_quantize.quantize(checkpoint_path, tflite_path, 'dynamic', voc_file_path=str(voc_path), img_height=IMG_HEIGHT)
+
+    runner = tf.lite.Interpreter(model_path=tflite_path).get_signature_runner()
+    other_model = _trained_like_model(seed=1)
+    rng = np.random.default_rng(0)
+    errors, other_errors, agreement = [], [], []
+    for width in (64, 200):
+        image = rng.random((IMG_HEIGHT, width)).astype(np.float32)
+        expected = _log_probs(model, image)
+        quantized = runner(**{mozart_export.INPUT_NAME: image[np.newaxis, :, :, np.newaxis]})
+        quantized = quantized[mozart_export.LOG_PROBS_NAME][:, 0]  # Time-major
+        assert quantized.shape == expected.shape
+        errors.append(np.abs(quantized - expected).mean())
+        other_errors.append(np.abs(_log_probs(other_model, image) - expected).mean())
+        agreement.append(np.mean(quantized.argmax(axis=1) == expected.argmax(axis=1)))
+
+    # Quantization error only: far below the gap to a model with other weights
+    assert np.mean(errors) < 0.1 * np.mean(other_errors)
+    assert np.mean(agreement) > 0.9
+
+
+def test_quantize_rejects_partial_checkpoint(tmp_path):
+    voc_path = tmp_path / 'vocabulary.txt'
+    voc_path.write_text('\n'.join(VOCABULARY))
+    model = _trained_like_model(seed=0)
+    checkpoint_path = tf.train.Checkpoint(model=tf.train.Checkpoint(dense=model.dense)).save(str(tmp_path / 'model'))
+    with pytest.raises(ValueError):
+        mozart_quantize.quantize(checkpoint_path, str(tmp_path / 'model.tflite'), 'dynamic',
+                                 voc_file_path=str(voc_path), img_height=IMG_HEIGHT)
@@ -0,0 +1,50 @@
+import asyncio
+
+import numpy as np
+
+import mozart_server
+
+
+class FailingPredictor:
+    """ Fails like MusicScorePredictor, which reports every failure as a ValueError. """
+
+    def preprocess(self, image):
+        return image
+
+    def predict_preprocessed(self, images, batch_size):
+        raise ValueError('Prediction failed: out of memory')
+
+
+def _exchange(request, segment=None):
+    # Sends a raw request to a server running on a free port, returns the status code
+    async def run():
+        batcher = mozart_server.MicroBatcher([FailingPredictor()], max_latency=0)
+        batcher.start()
+        server = mozart_server.TranscriptionServer(batcher, segmentation_threads=1)
+        if segment is not None:
+            server._segment = segment
+        http_server = await asyncio.start_server(server.handle, '127.0.0.1', 0)
+        try:
+            reader, writer = await asyncio.open_connection(*http_server.sockets[0].getsockname()[:2])
+            writer.write(request)
+            await writer.drain()
+            response = await reader.read()
+            writer.close()
+        finally:
+            http_server.close()
+            await batcher.stop()
+            server.executor.shutdown()
+        return int(response.split(b' ', 2)[1]), server.errors
+
+    return asyncio.run(run())
+
+
+def test_malformed_request_is_a_client_error():
+    assert _exchange(b'GARBAGE\r\n\r\n') == (400, 1)
+    assert _exchange(b'POST /transcribe HTTP/1.1\r\nContent-Length: many\r\n\r\n') == (400, 1)
+    assert _exchange(b'POST /transcribe?format=pdf HTTP/1.1\r\nContent-Length: 1\r\n\r\nx') == (400, 1)
+
+
+def test_prediction_failure_is_a_server_error():
+    staves = lambda body: [np.zeros((128, 64), dtype=np.float32)]
+    assert _exchange(b'POST /transcribe HTTP/1.1\r\nContent-Length: 1\r\n\r\nx', staves) == (500, 1)
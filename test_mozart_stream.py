@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+
+import mozart_model
+import mozart_stream
+import mozart_utils
+
+IMG_HEIGHT = 32
+VOCABULARY = ['clef-G2', 'note-C4_quarter', 'note-D4_quarter', 'note-E4_half', 'rest-quarter', 'barline']
+
+
+def _staff(rng, width):
+    # Columns of changing brightness: a model reading random noise settles
+    # on one class, as it would on a blank staff
+    levels = rng.integers(0, 256, width // 24 + 1).repeat(24)[:width]
+    return (levels * rng.uniform(0.5, 1, (IMG_HEIGHT, width))).astype(np.uint8)
+
+
+@pytest.fixture
+def checkpoint(tmp_path):
+    # Saved as mozart_training.py saves it, from a model that is not stateful
+    voc_path = tmp_path / 'vocabulary.txt'
+    voc_path.write_text('\n'.join(VOCABULARY))
+    tf.keras.utils.set_random_seed(0)
+    model = mozart_model.CTC_CNN_Model(mozart_model.default_model_params(IMG_HEIGHT, len(VOCABULARY)))
+    model(np.zeros((1, IMG_HEIGHT, 16, 1), dtype=np.float32), training=False)
+    rng = np.random.default_rng(0)
+    for layer in model.conv_layers[1::4]:
+        layer.moving_mean.assign(rng.normal(0, 0.1, layer.moving_mean.shape).astype(np.float32))
+        layer.moving_variance.assign(rng.uniform(0.5, 2, layer.moving_variance.shape).astype(np.float32))
+    # The logits of a fresh model barely vary along the staff, and the blank
+    # wins everywhere: each class is standardized over a staff, so that every
+    # class wins some frames, as the tokens of a trained model do
+    image = mozart_utils.normalize(_staff(rng, 1000)).astype(np.float32)[np.newaxis, :, :, np.newaxis]
+    logits = model(image, training=False).numpy()[0]
+    mean, std = logits.mean(axis=0), logits.std(axis=0)
+    model.dense.kernel.assign(model.dense.kernel / std)
+    model.dense.bias.assign((model.dense.bias - mean) / std)
+    path = tf.train.Checkpoint(model=model).save(str(tmp_path / 'model'))
+    return model, path, str(voc_path)
+
+
+def test_streaming_restores_the_trained_model(checkpoint):
+    model, path, voc_path = checkpoint
+    transcriber = mozart_stream.StreamingTranscriber(path, voc_path, img_height=IMG_HEIGHT)
+    for saved, restored in zip(model.weights, transcriber.model.weights):
+        np.testing.assert_array_equal(saved.numpy(), restored.numpy())
+
+    image = np.random.default_rng(1).random((1, IMG_HEIGHT, 96, 1)).astype(np.float32)
+    transcriber.model.reset_states()
+    np.testing.assert_allclose(transcriber.model(image, training=False), model(image, training=False),
+                               rtol=1e-5, atol=1e-5)
+
+
+def test_streaming_matches_full_width_pass(checkpoint):
+    _, path, voc_path = checkpoint
+    transcriber = mozart_stream.StreamingTranscriber(path, voc_path, window=64, context=64, img_height=IMG_HEIGHT)
+    rng = np.random.default_rng(2)
+    # Pieces narrower than a window, and pieces spanning several
+    pieces = np.split(_staff(rng, 1087), [150, 187, 487], axis=1)
+    words = transcriber.predict(pieces)
+    assert len(words) > 5
+    assert words == transcriber.predict_full_width(pieces)
+
+
+def test_streaming_rejects_partial_checkpoint(checkpoint, tmp_path):
+    model, _, voc_path = checkpoint
+    path = tf.train.Checkpoint(model=tf.train.Checkpoint(dense=model.dense)).save(str(tmp_path / 'dense'))
+    with pytest.raises(ValueError):
+        mozart_stream.StreamingTranscriber(path, voc_path, img_height=IMG_HEIGHT)
@@ -0,0 +1,15 @@
+import numpy as np
+
+import mozart_utils
+
+
+def test_levenshtein_batch_matches_levenshtein():
+    rng = np.random.default_rng(0)
+    a_sequences = [[], [], [1, 2, 3]]
+    b_sequences = [[], [4], []]
+    for _ in range(200):
+        a_sequences.append(rng.integers(0, 4, rng.integers(0, 12)).tolist())
+        b_sequences.append(rng.integers(0, 4, rng.integers(0, 12)).tolist())
+    expected = [mozart_utils.levenshtein(a, b) for a, b in zip(a_sequences, b_sequences)]
+    assert mozart_utils.levenshtein_batch(a_sequences, b_sequences).tolist() == expected
+    assert mozart_utils.levenshtein_batch([], []).tolist() == []
@@ -0,0 +1,93 @@
+import cv2
+import numpy as np
+import pytest
+
+import mozart_augment
+import mozart_model
+import primus
+
+VOCABULARY = ['clef-G2', 'note-C4_quarter', 'barline']
+
+
+def _primus(tmp_path, sample_names, **kwargs):
+    corpus_path = tmp_path / 'list.txt'
+    corpus_path.write_text('\n'.join(sample_names))
+    voc_path = tmp_path / 'vocabulary.txt'
+    voc_path.write_text('\n'.join(VOCABULARY))
+    return primus.CTC_PriMuS(str(tmp_path), str(corpus_path), str(voc_path), semantic=True, **kwargs)
+
+
+def _write_samples(tmp_path, widths, height=64):
+    rng = np.random.default_rng(0)
+    for i, width in enumerate(widths):
+        sample_dir = tmp_path / f'sample-{i}'
+        sample_dir.mkdir()
+        cv2.imwrite(str(sample_dir / f'sample-{i}.png'), rng.integers(0, 256, (height, width), dtype=np.uint8))
+        (sample_dir / f'sample-{i}.semantic').write_text('\t'.join(VOCABULARY[:1 + i % len(VOCABULARY)]))
+    return [f'sample-{i}' for i in range(len(widths))]
+
+
+def test_validation_batches_read_chunks_lazily(tmp_path):
+    widths = [300, 120, 500, 80, 260, 410, 160]
+    names = _write_samples(tmp_path, widths)
+    corpus = _primus(tmp_path, names, val_split=1.0)
+    params = mozart_model.default_model_params(32, len(VOCABULARY))
+    max_bytes = 3 * 200 * params['img_height'] * 4
+
+    reads = []
+    read_sample = corpus.readSample
+
+    def counted_read_sample(sample_filepath, *args, **kwargs):
+        reads.append(sample_filepath)
+        return read_sample(sample_filepath, *args, **kwargs)
+
+    corpus.readSample = counted_read_sample
+    batches = corpus.validationBatches(params, max_bytes=max_bytes, cache=False)
+    first = next(batches)
+    assert sorted(reads) == sorted(corpus.validation_list[i] for i in first['indices'])
+    lazy = [first] + list(batches)
+    assert len(reads) == len(names)
+    assert corpus.validation_cache is None
+
+    cached = list(corpus.validationBatches(params, max_bytes=max_bytes))
+    assert len(lazy) == len(cached) > 1
+    for lazy_batch, cached_batch in zip(lazy, cached):
+        assert lazy_batch['indices'] == cached_batch['indices']
+        assert lazy_batch['targets'] == cached_batch['targets']
+        np.testing.assert_array_equal(lazy_batch['seq_lengths'], cached_batch['seq_lengths'])
+        np.testing.assert_array_equal(lazy_batch['inputs'], cached_batch['inputs'])
+        assert lazy_batch['inputs'].nbytes <= max_bytes
+
+
+def test_batch_generator_rejects_empty_shard(tmp_path):
+    corpus = _primus(tmp_path, ['sample-0', 'sample-1'])
+    params = mozart_model.default_model_params(32, len(VOCABULARY))
+    with pytest.raises(ValueError):
+        next(corpus.batchGenerator(params, shard_index=2, num_shards=4))
+    with pytest.raises(ValueError):
+        next(corpus.batchGenerator(params, shard_index=2, num_shards=4, max_pixels=10**6))
+
+
+def test_augmented_batches_are_reproducible(tmp_path):
+    names = _write_samples(tmp_path, [300, 120, 500, 80, 260, 410])
+    params = mozart_model.default_model_params(32, len(VOCABULARY))
+    params['batch_size'] = 3
+
+    corpus = _primus(tmp_path, names)
+
+    def first_batches(augmenter):
+        corpus.augmenter = augmenter
+        # Distorted in worker processes, whose order of completion varies
+        batches = corpus.batchGenerator(params, num_workers=2, shuffle_buffer=1, seed=7)
+        try:
+            return [next(batches) for _ in range(4)]
+        finally:
+            batches.close()
+
+    augmented = first_batches(mozart_augment.Augmenter(probability=1.0))
+    for batch, again in zip(augmented, first_batches(mozart_augment.Augmenter(probability=1.0))):
+        np.testing.assert_array_equal(batch['inputs'], again['inputs'])
+        assert batch['targets'] == again['targets']
+    plain = first_batches(None)
+    assert [batch['targets'] for batch in plain] == [batch['targets'] for batch in augmented]
+    assert any(not np.array_equal(batch['inputs'], clean['inputs']) for batch, clean in zip(augmented, plain))
@@ -0,0 +1,68 @@
+import io
+import json
+import os
+import random
+import re
+import xml.etree.ElementTree as ET
+from xml.dom import minidom
+
+import pytest
+
+import xmlencoder
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Data')
+VOCABULARY = os.path.join(DATA, 'vocabulary_semantic.txt')
+# Output of the minidom encoder that write_musicxml() replaced, on the
+# scores it encoded correctly: from the second measure on, it dropped the
+# pitch of the notes and the rests, and it did not know every key
+BASELINE = os.path.join(DATA, 'Tests', 'xmlencoder_baseline.json')
+
+
+def _upgrade(musicxml):
+    # The only changes made on purpose since: <alter> comes before <octave>,
+    # as the MusicXML schema requires, and durations are integers
+    musicxml = re.sub(r'(\n *<octave>[^<]*</octave>)(\n *<alter>[^<]*</alter>)', r'\2\1', musicxml)
+    return re.sub(r'<duration>(\d+)\.0</duration>', r'<duration>\1</duration>', musicxml)
+
+
+with open(BASELINE, 'r') as f:
+    BASELINE_CASES = json.load(f)
+
+
+@pytest.mark.parametrize('case', BASELINE_CASES)
+def test_create_musicxml_matches_baseline_encoder(case):
+    assert xmlencoder.create_musicxml(case['notation']) == _upgrade(case['musicxml'])
+
+
+# The streaming writer formats the element tree exactly as minidom does
+
+def _minidom_musicxml(nested_notation):
+    tree = xmlencoder.build_score_tree(nested_notation)
+    return minidom.parseString(ET.tostring(tree)).toprettyxml(indent="  ")
+
+
+def _random_scores(num_scores=20, seed=0):
+    with open(VOCABULARY, 'r') as f:
+        words = [word for word in f.read().splitlines() if word != 'barline']
+    rng = random.Random(seed)
+    scores = []
+    for _ in range(num_scores):
+        scores.append([rng.sample(words, rng.randint(0, 8)) for _ in range(rng.randint(1, 6))])
+    return scores
+
+
+SCORES = [
+    [],
+    [[]],
+    [['clef-G2', 'keySignature-BbM', 'timeSignature-3/4', 'note-Bb4_quarter.', 'note-C5_eighth', 'rest-quarter']],
+    [['clef-F4', 'timeSignature-C', 'note-C3_half', 'tie'], ['tie', 'note-C3_half', 'note-D3_half_fermata']],
+    [['clef-C3', 'gracenote-D4_sixteenth', 'note-E4_whole'], ['multirest-12'], ['rest-whole_fermata']],
+] + _random_scores()
+
+
+@pytest.mark.parametrize('nested_notation', SCORES)
+def test_write_musicxml_matches_minidom(nested_notation):
+    stream = io.StringIO()
+    xmlencoder.write_musicxml(nested_notation, stream)
+    assert stream.getvalue() == _minidom_musicxml(nested_notation)
+    assert xmlencoder.create_musicxml(iter(nested_notation)) == stream.getvalue()
@@ -1,5 +1,10 @@
 import xml.etree.ElementTree as ET
 
+import mozart_events
+
+# MusicXML <type> -> note value of the semantic encoding
+_type_names = {xml_type: name for name, _, xml_type in mozart_events.NOTE_TYPES}
+
 def parse_musicxml(file_path):
     tree = ET.parse(file_path)
     root = tree.getroot()
@@ -49,20 +54,17 @@ def parse_musicxml(file_path):
             for note in measure.findall("note"):
                 is_rest = note.find("rest") is not None
 
-                # Duration & Type
-                duration = int(note.find("duration").text)
+                # Type (the <duration> follows from it, and grace notes have none)
                 note_type = note.find("type").text
                 dotted = len(note.findall("dot"))
 
                 # Reverse lookup for duration
-                duration_map = {
-                    ("whole", 0): "_whole", ("whole", 1): "_whole.",
-                    ("half", 0): "_half", ("half", 1): "_half.",
-                    ("quarter", 0): "_quarter", ("quarter", 1): "_quarter.",
-                    ("eighth", 0): "_eighth", ("eighth", 1): "_eighth.",
-                    ("16th", 0): "_sixteenth", ("16th", 1): "_sixteenth."
-                }
-                duration_label = duration_map.get((note_type, dotted), f"_{note_type}")
+                duration_label = "_" + _type_names.get(note_type, note_type) + "." * dotted
+                if note.find("notations/fermata") is not None:
+                    duration_label += "_fermata"
+
+                if note.find("tie[@type='stop']") is not None:
+                    measure_data.append("tie")
 
                 if is_rest:
                     measure_data.append(f"rest{duration_label}")
@@ -78,7 +80,8 @@ def parse_musicxml(file_path):
                     alter_map = {0: "", 1: "#", -1: "b"}
                     pitch_name = f"{step}{alter_map[alter_value]}{octave}"
 
-                    measure_data.append(f"note-{pitch_name}{duration_label}")
+                    prefix = "gracenote" if note.find("grace") is not None else "note"
+                    measure_data.append(f"{prefix}-{pitch_name}{duration_label}")
 
             notation_data.append(measure_data)
 
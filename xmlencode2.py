@@ -1,6 +1,3 @@
-import music21 as ml
-from music21.clef import PitchClef
-
 # Duration dictionary
 note_time_dict = {
     "_quarter": [1, "quarter", 0],
@@ -59,7 +56,11 @@ time_sign_dict = {
     "C/": "C",  # Common time
 }
 
-def create_musicxml(nested_notation):
+def create_musicxml(nested_notation, output_path=None):
+    # music21 is slow to import, it is only loaded when a score is created
+    import music21 as ml
+    from music21.clef import PitchClef
+
     score = ml.stream.Score()
     part = ml.stream.Part()
     measure_number = 1
@@ -114,19 +115,21 @@ def create_musicxml(nested_notation):
         measure_number += 1
 
     score.append(part)
-    return score.write('musicxml', fp='C:/Users/Edwin/Documents/blahblah.musicxml')
+    return score.write('musicxml', fp=output_path)
+
 
+if __name__ == "__main__":
+    # Sample phrase input
+    phrase = [
+        ['clef-F4', "keySignature-CM",'timeSignature-4/4', 'note-E3_quarter', 'note-E3_half', 'note-D3_quarter'],
+        ['note-E3_half', 'note-D3_quarter', 'note-A2_quarter'],
+        ['note-C3_half', 'note-B2_quarter', 'note-G3_quarter'],
+        ['note-F3_half', 'note-F3_half'],
+        ['clef-F4', 'timeSignature-C/', 'note-D3_half', 'note-E3_quarter', 'note-A2_quarter'],
+        ['note-G3_quarter', 'note-A2_quarter', 'note-Bb2_quarter', 'note-F3_quarter'],
+        ['note-G3_half', 'note-A2_quarter', 'note-D3_quarter'],
+        ['note-G3_half', 'note-E3_half']
+    ]
 
-# Sample phrase input
-phrase = [
-    ['clef-F4', "keySignature-CM",'timeSignature-4/4', 'note-E3_quarter', 'note-E3_half', 'note-D3_quarter'],
-    ['note-E3_half', 'note-D3_quarter', 'note-A2_quarter'],
-    ['note-C3_half', 'note-B2_quarter', 'note-G3_quarter'],
-    ['note-F3_half', 'note-F3_half'],
-    ['clef-F4', 'timeSignature-C/', 'note-D3_half', 'note-E3_quarter', 'note-A2_quarter'],
-    ['note-G3_quarter', 'note-A2_quarter', 'note-Bb2_quarter', 'note-F3_quarter'],
-    ['note-G3_half', 'note-A2_quarter', 'note-D3_quarter'],
-    ['note-G3_half', 'note-E3_half']
-]
 
-create_musicxml(phrase)
+    create_musicxml(phrase, 'C:/Users/Edwin/Documents/blahblah.musicxml')
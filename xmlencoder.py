@@ -1,249 +1,63 @@
-import re
+import io
+import mozart_events
+import mozart_profile
 import xml.etree.ElementTree as ET
-from xml.dom import minidom
-# _xxxxx : [d,t,dot]
-note_time_dict= {
-            "_eighth":       [0.5,"eighth",0],
-            "_eighth.":      [0.75,"eighth",1],
-            "_eighth..":     [0.875,"eighth",2],
-            "_half":         [2,"half",0],
-            "_half.":        [3,"half",1],
-            "_quarter":      [1,"quarter",0],
-            "_quarter.":     [1.5,"quarter",2],
-            "_quarter..":    [1.75,"quarter",0],
-            "_sixteenth":    [0.25,"16th",0],
-            "_sixteenth.":   [0.375,"16th",1],
-            "_sixty_fourth": [0.0625,"64th",0],
-            "_thirty_second":[0.125,"32nd",0],
-            "_whole":        [4,"whole",0],
-            "_whole.":       [6,"whole",1]
-}
-# note-nbd : [step,octave,alter]
-note_pitch_dict= {
-    "-A1_": ["A",1,0],
-    "-A2_": ["A",2,0],
-    "-A#2_":["A",2,1],
-    "-Ab2_":["A",2,-1],
-    "-A3_": ["A",3,0],
-    "-A#3_":["A",3,1],
-    "-Ab3_":["A",3,-1],
-    "-A4_": ["A",4,0],
-    "-A#4_":["A",4,1],
-    "-Ab4_":["A",4,-1],
-    "-A#5_":["A",5,1],
-    "-Ab5_":["A",5,0],
-    "-B1_": ["B",1,0],
-    "-B2_": ["B",2,0],
-    "-B#2_":["B",2,1],
-    "-Bb2_":["B",2,-1],
-    "-B3_": ["B",3,0],
-    "-B#3_":["B",3,1],
-    "-Bb3_":["B",3,-1],
-    "-B4_": ["B",4,0],
-    "-B#4_":["B",4,1],
-    "-Bb4_":["B",4,-1],
-    "-B#5_":["B",5,1],
-    "-Bb5_":["B",5,0],
-    "-C2_": ["C",2,0],
-    "-C#2_":["C",2,1],
-    "-Cb2_":["C",2,-1],
-    "-C3_": ["C",3,0],
-    "-C#3_":["C",3,1],
-    "-Cb3_":["C",3,-1],
-    "-C4_": ["C",4,0],
-    "-C#4_":["C",4,1],
-    "-Cb4_":["C",4,-1],
-    "-C5_": ["C",5,0],
-    "-C#5_":["C",5,1],
-    "-Cb5_":["C",5,-1],
-    "-C6_": ["C",6,0],
-    "-C#6_":["C",6,1],
-    "-Cb6_":["C",6,-1],
-    "-D2_": ["D",2,0],
-    "-D#2_":["D",2,1],
-    "-Db2_":["D",2,-1],
-    "-D3_": ["D",3,0],
-    "-D#3_":["D",3,1],
-    "-Db3_":["D",3,-1],
-    "-D4_": ["D",4,0],
-    "-D#4_":["D",4,1],
-    "-Db4_":["D",4,-1],
-    "-D5_": ["D",5,0],
-    "-D#5_":["D",5,1],
-    "-Db5_":["D",5,-1],
-    "-D6_": ["D",6,0],
-    "-D#6_":["D",6,1],
-    "-Db6_":["D",6,-1],
-    "-E2_": ["E",2,0],
-    "-E#2_":["E",2,1],
-    "-Eb2_":["E",2,-1],
-    "-E3_": ["E",3,0],
-    "-E#3_":["E",3,1],
-    "-Eb3_":["E",3,-1],
-    "-E4_": ["E",4,0],
-    "-E#4_":["E",4,1],
-    "-Eb4_":["E",4,-1],
-    "-E5_": ["E",5,0],
-    "-E#5_":["E",5,1],
-    "-Eb5_":["E",5,-1],
-    "-E6_": ["E",6,0],
-    "-E#6_":["E",6,1],
-    "-Eb6_":["E",6,-1],
-    "-F2_": ["F",2,0],
-    "-F#2_":["F",2,1],
-    "-Fb2_":["F",2,-1],
-    "-F3_": ["F",3,0],
-    "-F#3_":["F",3,1],
-    "-Fb3_":["F",3,-1],
-    "-F4_": ["F",4,0],
-    "-F#4_":["F",4,1],
-    "-Fb4_":["F",4,-1],
-    "-F5_": ["F",5,0],
-    "-F#5_":["F",5,1],
-    "-Fb5_":["F",5,-1],
-    "-F6_": ["F",6,0],
-    "-F#6_":["F",6,1],
-    "-Fb6_":["F",6,-1],
-    "-G2_":  ["G",2,0],
-    "-G#2_":["G",2,1],
-    "-Gb2_":["G",2,-1],
-    "-G3_":  ["G",3,0],
-    "-G#3_":["G",3,1],
-    "-Gb3_":["G",3,-1],
-    "-G4_": ["G",4,0],
-    "-G#4_":["G",4,1],
-    "-Gb4_":["G",4,-1],
-    "-G5_": ["G",5,0],
-    "-G#5_":["G",5,1],
-    "-Gb5_":["G",5,-1],
-    "-G6_": ["G",6,0],
-    "-G#6_":["G",6,1],
-    "-Gb6_":["G",6,-1]
-}
-# rest-nnn : [d,t,dot]
-# duration is measured as a multiple of <duration> attribute
-# remember to add "rest-eighth_fermata","rest-eighth._fermata","rest-half_fermata","rest-half._fermata","rest-quadruple_whole","rest-quarter_fermata","rest-quarter._fermata","rest-quarter.._fermata","rest-sixteenth_fermata","rest-whole_fermata"
-rest_dict = {
-            "rest-eighth":       [0.5,"eighth",0],
-            "rest-eighth.":      [0.75,"eighth",1],
-            "rest-eighth..":     [0.875,"eighth",2],
-            "rest-half":         [2,"half",0],
-            "rest-half.":        [3,"half",1],
-            "rest-quarter":      [1,"quarter",0],
-            "rest-quarter.":     [1.5,"quarter",2],
-            "rest-quarter..":    [1.75,"quarter",0],
-            "rest-sixteenth":    [0.25,"16th",0],
-            "rest-sixteenth.":   [0.375,"16th",1],
-            "rest-sixty_fourth": [0.0625,"64th",0],
-            "rest-thirty_second":[0.125,"32nd",0],
-            "rest-whole":        [4,"whole",0],
-            "rest-whole.":       [6,"whole",1]
-}
-
-
-time_sign_dict = {
-    "timeSignature-11/4": [11,4],
-    "timeSignature-1/2":  [1,2],
-    "timeSignature-12/16":[12,16],
-    "timeSignature-12/4": [12,4],
-    "timeSignature-12/8": [12,8],
-    "timeSignature-1/4":  [1,3],
-    "timeSignature-2/1":  [2,1],
-    "timeSignature-2/2":  [2,2],
-    "timeSignature-2/3":  [2,3],
-    "timeSignature-2/4":  [2,4],
-    "timeSignature-24/16":[24,16],
-    "timeSignature-2/48": [2,48],
-    "timeSignature-2/8":  [2,8],
-    "timeSignature-3/1":  [3,1],
-    "timeSignature-3/2":  [3,2],
-    "timeSignature-3/4":  [3,4],
-    "timeSignature-3/6":  [3,6],
-    "timeSignature-3/8":  [3,8],
-    "timeSignature-4/1":  [4,1],
-    "timeSignature-4/2":  [4,2],
-    "timeSignature-4/4":  [4,4],
-    "timeSignature-4/8":  [4,8],
-    "timeSignature-5/4":  [5,4],
-    "timeSignature-5/8":  [5,8], 
-    "timeSignature-6/16": [6,16],
-    "timeSignature-6/2":  [6,2],
-    "timeSignature-6/4":  [6,4],
-    "timeSignature-6/8":  [6,8],
-    "timeSignature-7/4":  [7,4],
-    "timeSignature-8/12": [8,12],
-    "timeSignature-8/16": [8,16],
-    "timeSignature-8/2":  [8,2],
-    "timeSignature-8/4":  [8,4],
-    "timeSignature-8/8":  [8,8],
-    "timeSignature-9/16": [9,16],
-    "timeSignature-9/4":  [9,4],
-    "timeSignature-9/8":  [9,8],
-    "timeSignature-C":    [4,4],
-    "timeSignature-C/":   [4,4],
-}
-
-key_sign_dict = {
-    "keySignature-AbM": [-4,"major"],
-    "keySignature-AM":  [3,"major"],
-    "keySignature-BbM": [-2,"major"],
-    "keySignature-BM":  [5, "major"],
-    "keySignature-CM":  [0,"major"],
-    "keySignature-C#M": [7,"major"],
-    "keySignature-DbM": [-5,"major"],
-    "keySignature-DM":  [2,"major"],
-    "keySignature-EbM": [-3,"major"],
-    "keySignature-EM":  [4,"major"],
-    "keySignature-FM":  [-1,"major"],
-    "keySignature-F#M": [6,"major"],
-    "keySignature-GbM": [-6,"major"],
-    "keySignature-GM":  [1,"major"]
-
-}
-
-
-clef_dict = {
-    "clef-C1": ["C",1],
-    "clef-C2": ["C",2],
-    "clef-C3": ["C",3], 
-    "clef-C4": ["C",4],
-    "clef-C5": ["C",5],
-    "clef-F3": ["F",3],
-    "clef-F4": ["F",4],
-    "clef-F5": ["F",5],
-    "clef-G1": ["G",1],
-    "clef-G2": ["G",2]
-
-}
 
-def create_musicxml(nested_notation):
-    score_partwise = ET.Element('score-partwise', version="3.1")
 
-    # Add part-list section
-    part_list = ET.SubElement(score_partwise, 'part-list')
-    score_part = ET.SubElement(part_list, 'score-part', id="P1")
-    ET.SubElement(score_part, 'part-name').text = "Music"
+def _format_duration(duration):
+    # 16 rather than 16.0; the shortest values stay fractional (0.5)
+    return str(int(duration)) if duration == int(duration) else str(duration)
 
-    part = ET.SubElement(score_partwise, 'part', id="P1")
 
-    divisions = 8  # Default divisions
-    beats_per_measure = None  # Set from the time signature
-    first_measure = True  # To track first measure
-    measure_number = 1  # Track the measure number manually
+class MeasureEncoder:
+    """
+    Turns the measures of a score, one after the other, into <measure>
+    elements. The state carried from one measure to the next (divisions,
+    time signature, measure number, the note a tie starts from) lives here,
+    so measures can be encoded as they arrive.
+
+    Measures are given as tokens, or as token ids with the EventTable of
+    their vocabulary (mozart_events), which skips the parsing of the tokens.
+    """
+
+    def __init__(self):
+        self.divisions = 8  # Default divisions
+        self.beats_per_measure = None  # Set from the time signature
+        self.first_measure = True  # To track first measure
+        self.measure_number = 1  # Track the measure number manually
+        self.last_note = None  # <note> of the last note of the previous measure, where a tie across the barline starts
+        self.tied = False  # The next note ends a tie
+
+    def encode(self, measure):
+        """ The <measure> element of a list of semantic tokens. """
+        return self.encode_events([mozart_events.parse_token(token) for token in measure])
+
+    def encode_ids(self, ids, table):
+        """
+        The <measure> element of a measure given as token ids, as they come out of the decoder.
+
+        Parameters:
+            ids (list): Token ids, without the barlines.
+            table (mozart_events.EventTable): Events of the vocabulary the ids refer to.
+        """
+        rows = table.rows
+        return self.encode_events([rows[i] for i in ids])
+
+    def encode_events(self, events):
+        """ The <measure> element of a list of events (rows of mozart_events.EVENT_DTYPE). """
+        divisions = self.divisions
+        # Only a note of this measure or of the previous one can start a tie
+        tie_from, self.last_note = self.last_note, None
 
-    for measure in nested_notation:
         # Check if a multirest command exists in the measure
         multirest_count = None
-        for command in measure:
-            if command.startswith('multirest-'):
-                try:
-                    multirest_count = int(command.split('-')[1])
-                except ValueError:
-                    print(f"Error: Invalid multirest quantity in command {command}")
+        for event in events:
+            if event[0] == mozart_events.MULTIREST and event[8] > 0:
+                multirest_count = event[8]
 
         # If multirest found, create a measure with a multiple-rest tag
         if multirest_count:
-            current_measure = ET.SubElement(part, 'measure', number=str(measure_number))
+            current_measure = ET.Element('measure', number=str(self.measure_number))
             attributes = ET.SubElement(current_measure, "attributes")
             ET.SubElement(attributes, "divisions").text = str(divisions)
 
@@ -251,82 +65,215 @@ def create_musicxml(nested_notation):
             ET.SubElement(measure_style, "multiple-rest").text = str(multirest_count)
 
             # Skip the next (multirest_count - 1) measures in numbering
-            measure_number += multirest_count
+            self.measure_number += multirest_count
+            self.tied = False
 
             # Move to the next measure without processing further commands
-            continue
+            return current_measure
 
         # Create a new measure
-        current_measure = ET.SubElement(part, 'measure', number=str(measure_number))
+        current_measure = ET.Element('measure', number=str(self.measure_number))
         total_duration = 0  # Track measure duration
 
         # Add <attributes> only for the first measure (or when explicitly changed)
-        if first_measure:
+        if self.first_measure:
             attributes = ET.SubElement(current_measure, "attributes")
             ET.SubElement(attributes, "divisions").text = str(divisions)
 
-        for command in measure:
-            def extractor(pattern, string):
-                match = re.search(pattern, string)
-                return match.group(0) if match else None
-
-            if command.startswith('clef-') and first_measure:
-                clef_type = clef_dict.get(command)
-                if clef_type:
-                    clef_element = ET.SubElement(attributes, 'clef')
-                    ET.SubElement(clef_element, 'sign').text = clef_type[0]
-                    ET.SubElement(clef_element, 'line').text = str(clef_type[1])
-
-            elif command.startswith('keySignature-') and first_measure:
-                key_signature = key_sign_dict.get(command)
-                if key_signature:
-                    key_element = ET.SubElement(attributes, 'key')
-                    ET.SubElement(key_element, "fifths").text = str(key_signature[0])
-
-            elif command.startswith('timeSignature-') and first_measure:
-                time_signature = time_sign_dict.get(command)
-                if time_signature:
-                    beats_per_measure = time_signature[0]
-                    time_element = ET.SubElement(attributes, 'time')
-                    ET.SubElement(time_element, "beats").text = str(time_signature[0])
-                    ET.SubElement(time_element, "beat-type").text = str(time_signature[1])
-
-            elif command.startswith('note-') or command.startswith('rest-'):
-                pitch_match = extractor(r"(-.*?_)", command)
-                time_match = extractor(r"(_.*)", command)
-
-                note_pitch = note_pitch_dict.get(pitch_match) if pitch_match else None
-                note_time = (note_time_dict if command.startswith('note-') else rest_dict).get(time_match) if time_match else None
-
-                if note_time:
-                    note_duration = note_time[0] * divisions
+        for kind, step, octave, alter, duration, type_index, dots, fermata, value, value2 in events:
+            if kind == mozart_events.CLEF and self.first_measure:
+                clef_element = ET.SubElement(attributes, 'clef')
+                ET.SubElement(clef_element, 'sign').text = mozart_events.STEPS[step]
+                ET.SubElement(clef_element, 'line').text = str(value)
+
+            elif kind == mozart_events.KEY and self.first_measure:
+                key_element = ET.SubElement(attributes, 'key')
+                ET.SubElement(key_element, "fifths").text = str(value)
+
+            elif kind == mozart_events.TIME and self.first_measure:
+                self.beats_per_measure = value
+                time_element = ET.SubElement(attributes, 'time')
+                ET.SubElement(time_element, "beats").text = str(value)
+                ET.SubElement(time_element, "beat-type").text = str(value2)
+
+            elif kind == mozart_events.TIE:
+                if tie_from is not None:
+                    _start_tie(tie_from)
+                    self.tied = True
+
+            elif kind in (mozart_events.NOTE, mozart_events.GRACENOTE, mozart_events.REST):
+                note = ET.SubElement(current_measure, 'note')
+                if kind == mozart_events.GRACENOTE:
+                    # Grace notes take no time in the measure
+                    ET.SubElement(note, 'grace')
+
+                if kind == mozart_events.REST:
+                    ET.SubElement(note, 'rest')
+                else:
+                    pitch = ET.SubElement(note, 'pitch')
+                    ET.SubElement(pitch, 'step').text = mozart_events.STEPS[step]
+                    if alter != 0:
+                        ET.SubElement(pitch, "alter").text = str(alter)
+                    ET.SubElement(pitch, 'octave').text = str(octave)
+
+                if kind != mozart_events.GRACENOTE:
+                    note_duration = duration * divisions
                     total_duration += note_duration
 
                     # Ensure we don't exceed measure duration
-                    if beats_per_measure and total_duration > beats_per_measure * divisions:
-                        print(f"Warning: Note exceeds measure duration in measure {measure_number}")
-
-                    note = ET.SubElement(current_measure, 'note')
-
-                    if command.startswith('note-') and note_pitch:
-                        pitch = ET.SubElement(note, 'pitch')
-                        ET.SubElement(pitch, 'step').text = note_pitch[0]
-                        ET.SubElement(pitch, 'octave').text = str(note_pitch[1])
-                        if note_pitch[2] != 0:
-                            ET.SubElement(pitch, "alter").text = str(note_pitch[2])
-                    elif command.startswith('rest-'):
-                        ET.SubElement(note, 'rest')
-
-                    ET.SubElement(note, 'duration').text = str(note_duration)
-                    ET.SubElement(note, 'type').text = note_time[1]
-                    for _ in range(note_time[2]):
-                        ET.SubElement(note, "dot")
-
-        first_measure = False  # Attributes are only added in the first measure unless changed
-        measure_number += 1  # Increment measure number normally
-
-    # Convert to a pretty-printed string
-    rough_string = ET.tostring(score_partwise, encoding="unicode", method="xml")
-    reparsed = minidom.parseString(rough_string)
-    pretty_xml = reparsed.toprettyxml(indent="  ")
-    return pretty_xml
+                    if self.beats_per_measure and total_duration > self.beats_per_measure * divisions:
+                        print(f"Warning: Note exceeds measure duration in measure {self.measure_number}")
+                    ET.SubElement(note, 'duration').text = _format_duration(note_duration)
+
+                tie_stop = self.tied and kind == mozart_events.NOTE
+                if tie_stop:
+                    ET.SubElement(note, 'tie', type="stop")
+                ET.SubElement(note, 'type').text = mozart_events.NOTE_TYPES[type_index][2]
+                for _ in range(dots):
+                    ET.SubElement(note, "dot")
+                if tie_stop or fermata:
+                    notations = ET.SubElement(note, 'notations')
+                    if tie_stop:
+                        ET.SubElement(notations, 'tied', type="stop")
+                    if fermata:
+                        ET.SubElement(notations, 'fermata')
+
+                if kind == mozart_events.NOTE:
+                    tie_from = self.last_note = note
+                    self.tied = False
+                elif kind == mozart_events.REST:
+                    tie_from = self.last_note = None
+                    self.tied = False
+
+        self.first_measure = False  # Attributes are only added in the first measure unless changed
+        self.measure_number += 1  # Increment measure number normally
+        return current_measure
+
+
+def _start_tie(note):
+    # Marks an already encoded <note> as the start of a tie: <tie> goes
+    # before <type>, <tied> into the <notations> that end the note
+    children = list(note)
+    note.insert(children.index(note.find('type')), ET.Element('tie', type="start"))
+    notations = note.find('notations')
+    if notations is None:
+        notations = ET.SubElement(note, 'notations')
+    ET.SubElement(notations, 'tied', type="start")
+
+
+def _part_list():
+    part_list = ET.Element('part-list')
+    score_part = ET.SubElement(part_list, 'score-part', id="P1")
+    ET.SubElement(score_part, 'part-name').text = "Music"
+    return part_list
+
+
+def build_score_tree(nested_notation):
+    score_partwise = ET.Element('score-partwise', version="3.1")
+
+    # Add part-list section
+    score_partwise.append(_part_list())
+
+    part = ET.SubElement(score_partwise, 'part', id="P1")
+    encoder = MeasureEncoder()
+    for measure in nested_notation:
+        part.append(encoder.encode(measure))
+
+    return score_partwise
+
+
+def _escape(data):
+    # Same escaping as minidom
+    return data.replace("&", "&amp;").replace("<", "&lt;").replace("\"", "&quot;").replace(">", "&gt;")
+
+
+def _pretty_lines(element, indent, addindent, lines):
+    # Appends the element formatted like minidom's toprettyxml(): one element
+    # per line, text-only elements on a single line, empty ones as <tag/>
+    start = indent + "<" + element.tag + "".join(f' {name}="{_escape(value)}"' for name, value in element.attrib.items())
+    if len(element):
+        lines.append(start + ">\n")
+        for child in element:
+            _pretty_lines(child, indent + addindent, addindent, lines)
+        lines.append(f"{indent}</{element.tag}>\n")
+    elif element.text:
+        lines.append(f"{start}>{_escape(element.text)}</{element.tag}>\n")
+    else:
+        lines.append(start + "/>\n")
+    return lines
+
+
+class MusicXMLWriter:
+    """
+    Writes a MusicXML document to a text stream one measure at a time,
+    without keeping the score in memory.
+
+    The output is formatted like minidom's toprettyxml(). One measure is
+    held back until the next one is encoded, since a tie at the start of a
+    measure marks the last note of the previous one.
+
+    Parameters:
+        stream: Text stream to write to (an open file, io.StringIO, ...).
+        indent (str): Indentation of one level.
+    """
+
+    def __init__(self, stream, indent="  "):
+        self.stream = stream
+        self.indent = indent
+        self.encoder = MeasureEncoder()
+        self.measures = 0
+        self.pending = None  # Encoded measure not written yet
+        self.closed = False
+        lines = ['<?xml version="1.0" ?>\n', '<score-partwise version="3.1">\n']
+        _pretty_lines(_part_list(), indent, indent, lines)
+        # Finished by the first measure, or by close() as an empty element
+        lines.append(indent + '<part id="P1"')
+        stream.write("".join(lines))
+
+    def write_measure(self, measure):
+        """ Encodes and writes one measure, given as its list of semantic tokens. """
+        self._hold(self.encoder.encode(measure))
+
+    def write_measure_ids(self, ids, table):
+        """ Encodes and writes one measure, given as token ids of the vocabulary of table (mozart_events.EventTable). """
+        self._hold(self.encoder.encode_ids(ids, table))
+
+    def _hold(self, element):
+        if self.pending is not None:
+            self._write(self.pending)
+        self.pending = element
+
+    def _write(self, element):
+        lines = [">\n"] if self.measures == 0 else []
+        _pretty_lines(element, self.indent * 2, self.indent, lines)
+        self.stream.write("".join(lines))
+        self.measures += 1
+
+    def close(self):
+        """ Writes the end of the document; the stream itself is left open. """
+        if self.closed:
+            return
+        self.closed = True
+        if self.pending is not None:
+            self._write(self.pending)
+            self.pending = None
+        self.stream.write((f"{self.indent}</part>\n" if self.measures else "/>\n") + "</score-partwise>\n")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def write_musicxml(nested_notation, stream):
+    """ Writes the MusicXML document of an iterable of measures to a text stream, measure by measure. """
+    with mozart_profile.stage('xml/encode'), MusicXMLWriter(stream) as writer:
+        for measure in nested_notation:
+            writer.write_measure(measure)
+
+
+def create_musicxml(nested_notation):
+    stream = io.StringIO()
+    write_musicxml(nested_notation, stream)
+    return stream.getvalue()